@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ビザ選定エキスパートシステム ルール評価のコード生成の照合ツール
+
+知識ベースから生成した評価関数（engine/codegen.py、RULE_CODEGEN=1 で使われる）が
+インタプリタ（RuleEvaluator）と同じ結果になるかを、現在のルールと
+ランダムに作った合成知識ベースで確かめ、1回の評価あたりの時間を比べます。
+
+使い方:
+  python codegen_check.py [--rules rules.json] [--synthetic 200] [--seed 0] [--show-source]
+
+相違があれば終了コード1を返します。
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+
+from engine import InferenceEngine
+from engine.codegen import compile_evaluator, generate_evaluator_source, random_knowledge_base, validate_evaluator
+from knowledge import compile_knowledge_base, get_knowledge_base
+from knowledge.loader import parse_rules_data
+
+
+def time_evaluation(kb, compiled, repeat: int = 2000) -> float:
+    """診断の途中の状態で evaluate_all_rules 1回にかかる時間（マイクロ秒、最小値）"""
+    engine = InferenceEngine(kb)
+    question = engine.start_consultation()
+    rng = random.Random(0)
+    for _ in range(len(kb.rules_by_condition) // 3):
+        if question is None:
+            break
+        question = engine.answer_question(question, rng.choice(("yes", "no", "unknown")),
+                                          include_rules_status=False)["next_question"]
+    evaluator = engine.evaluator
+    evaluator.compiled = compiled
+    best = float("inf")
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            evaluator.evaluate_all_rules()
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return best * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ルール評価のコード生成の照合")
+    parser.add_argument("--rules", help="照合するルールファイル（省略時は現在の知識ベース）")
+    parser.add_argument("--synthetic", type=int, default=200, help="合成知識ベースの数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--show-source", action="store_true", help="生成したソースを表示")
+    args = parser.parse_args()
+
+    if args.rules:
+        with open(args.rules, encoding="utf-8") as f:
+            kb = compile_knowledge_base(parse_rules_data(json.load(f)))
+    else:
+        kb = get_knowledge_base()
+
+    if args.show_source:
+        print(generate_evaluator_source(kb)[0])
+
+    failures = 0
+    error = validate_evaluator(kb, trials=500, consultations=200, seed=args.seed)
+    print(f"rules ({len(kb.rules)} rules): {error or 'OK'}")
+    failures += error is not None
+
+    rng = random.Random(args.seed)
+    synthetic_failures = 0
+    for n in range(args.synthetic):
+        synthetic = random_knowledge_base(rng, n_rules=rng.randint(1, 60), n_base=rng.randint(1, 25))
+        error = validate_evaluator(synthetic, trials=50, consultations=10, seed=n)
+        if error:
+            print(f"synthetic #{n} ({synthetic.content_hash}): {error}")
+            synthetic_failures += 1
+    print(f"synthetic ({args.synthetic} rulebases): {'NG' if synthetic_failures else 'OK'}")
+    failures += synthetic_failures
+
+    interpreted = time_evaluation(kb, None)
+    generated = time_evaluation(kb, compile_evaluator(kb))
+    print(f"evaluate_all_rules: interpreter {interpreted:.1f}us, generated {generated:.1f}us "
+          f"({interpreted / generated:.1f}x)")
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
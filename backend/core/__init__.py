@@ -2,10 +2,11 @@
 Core - 共通定義モジュール
 """
 from .enums import FactStatus, RuleStatus
-from .models import Rule
+from .models import Rule, RuleQuery
 
 __all__ = [
     "FactStatus",
     "RuleStatus",
     "Rule",
+    "RuleQuery",
 ]
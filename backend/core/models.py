@@ -1,7 +1,7 @@
 """
 データモデル定義
 """
-from typing import List
+from typing import List, Optional, Set
 from dataclasses import dataclass
 
 
@@ -26,3 +26,31 @@ class Rule:
     def name(self) -> str:
         """actionを名前として使用"""
         return self.action
+
+
+@dataclass
+class RuleQuery:
+    """ルール一覧の絞り込み・ページ分割・返すフィールドの指定
+
+    ルール管理APIと診断の rules_status で共通に使う。
+    """
+    goal_only: bool = False                 # ゴールルールのみ
+    statuses: Optional[Set[str]] = None     # ルールの評価状態（診断中のみ。None=全て）
+    action_prefix: Optional[str] = None     # 結論の前方一致
+    fields: Optional[Set[str]] = None       # 返すフィールド（None=全て）
+    after: int = -1                         # この位置（rules.json順）より後から
+    limit: Optional[int] = None             # 最大件数（None=全て）
+
+    def matches(self, rule: Rule, status: Optional[str] = None) -> bool:
+        """ルールが絞り込み条件に合うか"""
+        if self.goal_only and not rule.is_goal_action:
+            return False
+        if self.action_prefix and not rule.action.startswith(self.action_prefix):
+            return False
+        if self.statuses is not None and status not in self.statuses:
+            return False
+        return True
+
+    def wants(self, field: str) -> bool:
+        """フィールドを返すか"""
+        return self.fields is None or field in self.fields
@@ -2,5 +2,22 @@
 Engine - 推論エンジンモジュール
 """
 from .inference import InferenceEngine
+from .pool import EnginePool, engine_pool
+from .explanation import Explainer, explain_conditions
+from .whatif import (
+    fork_with_answers, evaluate_what_if, precompute_answers, snapshot_for_answers, answers_of, remember_snapshot
+)
 
-__all__ = ["InferenceEngine"]
+__all__ = [
+    "InferenceEngine",
+    "EnginePool",
+    "engine_pool",
+    "Explainer",
+    "explain_conditions",
+    "fork_with_answers",
+    "evaluate_what_if",
+    "precompute_answers",
+    "snapshot_for_answers",
+    "answers_of",
+    "remember_snapshot",
+]
@@ -0,0 +1,298 @@
+"""
+ルール評価のコード生成 - 知識ベースの版ごとに専用のPython関数を作る
+
+RuleEvaluator.evaluate_all_rules はルールごとに条件のリストをたどり、
+AND/ORで分岐しながら実効値を調べる（インタプリタ）。ここでは知識ベースから
+「全ルールを1回評価する」関数のソースを生成し、compile() して内容ハッシュごとに
+キャッシュする。生成した関数では
+  - 条件の実効値を1回の評価につき1回だけ求め、ローカル変数に置く
+  - ルールの状態はローカル変数に展開し、条件・導出元のルールは番号で直接参照する
+  - AND/ORの判定は条件の数だけ展開した短絡評価の式にする
+結果（ステータスとchecked_conditions）はインタプリタと同じになる。
+ルールの評価順もインタプリタ（rule_statesの順）と同じにする。ORルールは
+同じ評価の中で先に更新された導出元のルールの状態を読むため、評価順を変えると
+1回の評価の結果が変わるため。
+
+環境変数:
+    RULE_CODEGEN: "1" なら RuleEvaluator が生成した関数を使う（デフォルトは "0"）
+"""
+import os
+import random
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from core import Rule, FactStatus, RuleStatus
+from knowledge import CompiledKnowledgeBase, compile_knowledge_base
+from .working_memory import WorkingMemory, RuleState
+
+
+RULE_CODEGEN_ENABLED = os.environ.get("RULE_CODEGEN", "0") == "1"
+
+MAX_CACHED_EVALUATORS = 8
+
+# 生成した関数: (findings, hypotheses, rule_statesの値のタプル) -> None
+CompiledEvaluator = Callable[[Dict[str, FactStatus], Dict[str, FactStatus], Tuple[RuleState, ...]], None]
+
+_NAMESPACE = {
+    "TRUE": FactStatus.TRUE,
+    "FALSE": FactStatus.FALSE,
+    "UNKNOWN": FactStatus.UNKNOWN,
+    "PENDING": FactStatus.PENDING,
+    "FIRED": RuleStatus.FIRED,
+    "BLOCKED": RuleStatus.BLOCKED,
+    "UNCERTAIN": RuleStatus.UNCERTAIN,
+    "RESOLVED": frozenset((RuleStatus.FIRED, RuleStatus.BLOCKED, RuleStatus.UNCERTAIN)),
+}
+
+
+def evaluated_rules(kb: CompiledKnowledgeBase) -> List[Rule]:
+    """評価されるルール（rule_statesの順）
+
+    InferenceEngine と同じく rule.id ごとに1つで、actionが重複する場合は
+    最初の位置に後のルールが入る。
+    """
+    by_id: Dict[str, Rule] = {}
+    for rule in kb.rules:
+        by_id[rule.id] = rule
+    return list(by_id.values())
+
+
+def generate_evaluator_source(kb: CompiledKnowledgeBase) -> Tuple[str, Tuple[str, ...]]:
+    """全ルールを評価する関数のソースと、関数が参照する条件のタプルを生成
+
+    条件の文字列はソースに埋め込まず、タプルの番号（k0, k1, ...）で参照する。
+    """
+    rules = evaluated_rules(kb)
+    state_index = {rule.id: i for i, rule in enumerate(rules)}
+
+    conditions: Dict[str, int] = {}
+    for rule in rules:
+        for cond in rule.conditions:
+            conditions.setdefault(cond, len(conditions))
+    keys = tuple(conditions)
+
+    lines = ["def evaluate_all_rules(findings, hypotheses, states):"]
+    emit = lines.append
+    emit("    f = findings.get")
+    emit("    h = hypotheses.get")
+    if keys:
+        emit("    " + ", ".join(f"k{i}" for i in range(len(keys))) + ", = KEYS")
+    if rules:
+        emit("    " + ", ".join(f"s{i}" for i in range(len(rules))) + ", = states")
+
+    # 条件の実効値（評価中に作業記憶は変わらないので、先に1回だけ求める）
+    for cond, c in conditions.items():
+        if cond in kb.derived_conditions:
+            emit(f"    v{c} = h(k{c})")
+            emit(f"    if v{c} is not TRUE and v{c} is not FALSE:")
+            emit(f"        x = f(k{c})")
+            emit("        if x is not None:")
+            emit(f"            v{c} = x")
+        else:
+            emit(f"    v{c} = f(k{c})")
+            emit(f"    if v{c} is None:")
+            emit(f"        v{c} = h(k{c})")
+        emit(f"    p{c} = v{c} or PENDING")
+
+    for r, rule in enumerate(rules):
+        codes = [conditions[cond] for cond in rule.conditions]
+        if codes:
+            emit(f"    c = s{r}.checked_conditions")
+            for c in codes:
+                emit(f"    c[k{c}] = p{c}")
+
+        if rule.is_or_rule:
+            emit(f"    if {_any(codes, 'is TRUE')}:")
+            emit(f"        s{r}.status = FIRED")
+            emit("    else:")
+            emit("        ok = True")
+            emit("        unknown = False")
+            for c in codes:
+                cond = keys[c]
+                emit("        if ok:")
+                emit(f"            if p{c} is UNKNOWN:")
+                emit("                unknown = True")
+                if cond in kb.derived_conditions:
+                    deriving = sorted({state_index[kb.rules[i].id] for i in kb.rules_by_action[cond]})
+                    resolved = " and ".join(f"s{d}.status in RESOLVED" for d in deriving)
+                    emit(f"                ok = {resolved}")
+                emit(f"            elif p{c} is PENDING:")
+                emit("                ok = False")
+            emit("        if ok:")
+            emit(f"            s{r}.status = UNCERTAIN if unknown else BLOCKED")
+        else:
+            emit(f"    if {_all(codes, 'is TRUE')}:")
+            emit(f"        s{r}.status = FIRED")
+            emit(f"    elif {_any(codes, 'is FALSE')}:")
+            emit(f"        s{r}.status = BLOCKED")
+            answered = _all(codes, "is not None", "is not PENDING")
+            emit(f"    elif ({_any(codes, 'is UNKNOWN')}) and {answered}:")
+            emit(f"        s{r}.status = UNCERTAIN")
+
+    emit("    return None")
+    return "\n".join(lines) + "\n", keys
+
+
+def _all(codes: List[int], *tests: str) -> str:
+    if not codes:
+        return "True"
+    return " and ".join(f"v{c} {test}" for c in codes for test in tests)
+
+
+def _any(codes: List[int], test: str) -> str:
+    if not codes:
+        return "False"
+    return " or ".join(f"v{c} {test}" for c in codes)
+
+
+def compile_evaluator(kb: CompiledKnowledgeBase) -> CompiledEvaluator:
+    """知識ベースの評価関数を生成してコンパイル（キャッシュしない）"""
+    source, keys = generate_evaluator_source(kb)
+    namespace = dict(_NAMESPACE, KEYS=keys)
+    exec(compile(source, f"<rules {kb.content_hash}>", "exec"), namespace)
+    return namespace["evaluate_all_rules"]
+
+
+class CompiledEvaluators:
+    """内容ハッシュごとの評価関数のキャッシュ（最近使った版だけ保持する）"""
+
+    def __init__(self, max_entries: int = MAX_CACHED_EVALUATORS):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CompiledEvaluator]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, kb: CompiledKnowledgeBase) -> CompiledEvaluator:
+        with self._lock:
+            evaluator = self._entries.get(kb.content_hash)
+            if evaluator is not None:
+                self._entries.move_to_end(kb.content_hash)
+                return evaluator
+
+        evaluator = compile_evaluator(kb)
+        with self._lock:
+            self._entries[kb.content_hash] = evaluator
+            self._entries.move_to_end(kb.content_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return evaluator
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+compiled_evaluators = CompiledEvaluators()
+
+
+# ========== インタプリタとの照合 ==========
+
+_FACT_VALUES = (None, FactStatus.TRUE, FactStatus.FALSE, FactStatus.UNKNOWN, FactStatus.PENDING)
+_RULE_STATUSES = tuple(RuleStatus)
+
+
+def random_knowledge_base(rng: random.Random, n_rules: int = 30, n_base: int = 15) -> CompiledKnowledgeBase:
+    """照合用の合成知識ベース
+
+    導出条件の連鎖・循環・actionの重複・同じ条件の重複・条件のないルールを含みうる。
+    """
+    base = [f"q{i}" for i in range(n_base)]
+    actions = [f"a{i}" for i in range(max(1, n_rules * 3 // 4))]
+    rules = []
+    for _ in range(n_rules):
+        size = rng.choice((0, 1, 1, 2, 2, 3, 3, 4, 5)) if rng.random() < 0.97 else 8
+        conditions = [rng.choice(actions) if rng.random() < 0.3 else rng.choice(base) for _ in range(size)]
+        rules.append(Rule(
+            conditions=conditions,
+            action=rng.choice(actions),
+            is_or_rule=rng.random() < 0.35,
+            is_goal_action=rng.random() < 0.3,
+        ))
+    return compile_knowledge_base(rules)
+
+
+def _random_state(rng: random.Random, kb: CompiledKnowledgeBase):
+    """ランダムな作業記憶とルールの状態（エンジンの到達しうる状態に限らない）"""
+    conditions = list(kb.rules_by_condition)
+    memory = WorkingMemory()
+    for cond in conditions:
+        if rng.random() < 0.5:
+            value = rng.choice(_FACT_VALUES)
+            if value is not None:
+                memory.findings[cond] = value
+        if rng.random() < 0.4:
+            value = rng.choice(_FACT_VALUES)
+            if value is not None:
+                memory.hypotheses[cond] = value
+    states = {}
+    for rule in kb.rules:
+        states[rule.id] = RuleState(
+            rule=rule,
+            status=rng.choice(_RULE_STATUSES),
+            checked_conditions={c: rng.choice(_FACT_VALUES[1:]) for c in conditions if rng.random() < 0.1},
+        )
+    return memory, states
+
+
+def _copy_states(states: Dict[str, RuleState]) -> Dict[str, RuleState]:
+    return {
+        rule_id: RuleState(rule=s.rule, status=s.status, checked_conditions=dict(s.checked_conditions))
+        for rule_id, s in states.items()
+    }
+
+
+def _same_states(a: Dict[str, RuleState], b: Dict[str, RuleState]) -> bool:
+    return all(
+        a[rid].status == b[rid].status and a[rid].checked_conditions == b[rid].checked_conditions
+        for rid in a
+    )
+
+
+def validate_evaluator(
+    kb: CompiledKnowledgeBase,
+    trials: int = 200,
+    consultations: int = 20,
+    seed: int = 0
+) -> Optional[str]:
+    """生成した関数をインタプリタと照合する（一致すればNone、違えば最初の相違の説明）
+
+    ランダムな作業記憶・ルール状態での1回の評価と、ランダムな回答での診断全体の両方を比べる。
+    """
+    from .evaluator import RuleEvaluator
+    from .inference import InferenceEngine
+
+    rng = random.Random(seed)
+    compiled = compile_evaluator(kb)
+
+    for trial in range(trials):
+        memory, states = _random_state(rng, kb)
+        expected = _copy_states(states)
+        interpreter = RuleEvaluator(memory, expected, kb)
+        interpreter.compiled = None
+        interpreter.evaluate_all_rules()
+        evaluator = RuleEvaluator(memory, states, kb)
+        evaluator.compiled = compiled
+        evaluator.evaluate_all_rules()
+        if not _same_states(expected, states):
+            return f"single evaluation differs (trial {trial})"
+
+    for n in range(consultations):
+        interpreted = InferenceEngine(kb)
+        generated = InferenceEngine(kb)
+        interpreted.evaluator.compiled = None
+        generated.evaluator.compiled = compiled
+        question = interpreted.start_consultation()
+        if generated.start_consultation() != question:
+            return f"first question differs (consultation {n})"
+        step = 0
+        while question is not None and step < len(kb.rules_by_condition):
+            answer = rng.choice(("yes", "no", "unknown"))
+            expected_result = interpreted.answer_question(question, answer, include_rules_status=False)
+            result = generated.answer_question(question, answer, include_rules_status=False)
+            if (result != expected_result
+                    or interpreted.working_memory.hypotheses != generated.working_memory.hypotheses
+                    or not _same_states(interpreted.rule_states, generated.rule_states)):
+                return f"consultation {n} differs at step {step} ({question!r} -> {answer})"
+            question = result["next_question"]
+            step += 1
+    return None
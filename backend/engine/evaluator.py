@@ -4,7 +4,9 @@
 from typing import Dict, List, Optional
 
 from core import Rule, FactStatus, RuleStatus
+from knowledge import CompiledKnowledgeBase
 from .working_memory import WorkingMemory, RuleState
+from .codegen import RULE_CODEGEN_ENABLED, compiled_evaluators
 
 
 class RuleEvaluator:
@@ -14,13 +16,15 @@ class RuleEvaluator:
         self,
         working_memory: WorkingMemory,
         rule_states: Dict[str, RuleState],
-        derived_conditions: set,
-        rules: List[Rule]
+        knowledge_base: CompiledKnowledgeBase
     ):
         self.working_memory = working_memory
         self.rule_states = rule_states
-        self.derived_conditions = derived_conditions
-        self.rules = rules
+        self.knowledge_base = knowledge_base
+        self.derived_conditions = knowledge_base.derived_conditions
+        # 知識ベースから生成した評価関数（RULE_CODEGEN=1 のとき。Noneなら下のインタプリタで評価する）
+        self.compiled = compiled_evaluators.get(knowledge_base) if RULE_CODEGEN_ENABLED else None
+        self._states: Optional[tuple] = None
 
     def get_effective_value(self, condition: str) -> Optional[FactStatus]:
         """条件の実効値を取得
@@ -44,10 +48,15 @@ class RuleEvaluator:
 
     def get_deriving_rules(self, condition: str) -> List[Rule]:
         """条件を導出するルールを取得"""
-        return [r for r in self.rules if r.action == condition]
+        return self.knowledge_base.deriving_rules(condition)
 
     def evaluate_all_rules(self):
         """全ルールを評価してステータスを更新"""
+        if self.compiled is not None:
+            if self._states is None:
+                self._states = tuple(self.rule_states.values())
+            self.compiled(self.working_memory.findings, self.working_memory.hypotheses, self._states)
+            return
         for rule_id, state in self.rule_states.items():
             self._evaluate_single_rule(state)
 
@@ -0,0 +1,122 @@
+"""
+説明生成 - 「なぜ成立したか / なぜ成立しなかったか」をルールの構造から求める
+"""
+from typing import Any, Dict, List, Optional, Set
+
+from core import Rule, FactStatus, RuleStatus
+
+
+class Explainer:
+    """現在のルール状態と作業記憶から説明を組み立てる
+
+    推論ログとは独立に、要求されたときだけルールの依存関係をたどる。
+    同じ条件の説明は1回の要求の中でメモ化して使い回す。
+    go_back後もその時点の状態から計算するため、常に現在の状態と一致する。
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.knowledge_base = engine.knowledge_base
+        self._memo: Dict[str, Dict[str, Any]] = {}
+
+    def _status_text(self, value: Optional[FactStatus]) -> str:
+        return self.engine.FACT_STATUS_DISPLAY.get(value, "unchecked")
+
+    def _rule_info(self, rule: Rule) -> Dict[str, Any]:
+        state = self.engine.rule_states.get(rule.id)
+        return {
+            "id": rule.id,
+            "operator": "OR" if rule.is_or_rule else "AND",
+            "status": state.status.value if state else RuleStatus.PENDING.value,
+        }
+
+    def explain(self, condition: str) -> Dict[str, Any]:
+        """条件の説明を取得
+
+        TRUEなら成立の根拠（回答と発火したルールの木）、
+        それ以外なら成立を妨げている葉（FALSE / UNKNOWN / 未回答）までの経路を返す。
+        """
+        return self._explain(condition, set())
+
+    def _explain(self, condition: str, in_progress: Set[str]) -> Dict[str, Any]:
+        if condition in self._memo:
+            return self._memo[condition]
+        if condition in in_progress:
+            # 循環参照（整合性チェックで検出されるが念のため）
+            return {"condition": condition, "status": "unchecked", "source": "cycle"}
+
+        in_progress.add(condition)
+        value = self.engine.evaluator.get_effective_value(condition)
+        if value == FactStatus.TRUE:
+            node = self._explain_true(condition, in_progress)
+        else:
+            node = self._explain_not_true(condition, value, in_progress)
+        in_progress.discard(condition)
+
+        self._memo[condition] = node
+        return node
+
+    def _explain_true(self, condition: str, in_progress: Set[str]) -> Dict[str, Any]:
+        """成立の根拠"""
+        node = {"condition": condition, "status": "true", "kind": "why"}
+        wm = self.engine.working_memory
+
+        fired = [
+            r for r in self.knowledge_base.deriving_rules(condition)
+            if self.engine.rule_states[r.id].status == RuleStatus.FIRED
+        ]
+        if fired:
+            node["source"] = "rule"
+            node["rules"] = []
+            for rule in fired:
+                info = self._rule_info(rule)
+                # ANDは全条件、ORは成立した条件だけが根拠になる
+                children = [self._explain(c, in_progress) for c in rule.conditions]
+                if rule.is_or_rule:
+                    children = [c for c in children if c["status"] == "true"]
+                info["conditions"] = children
+                node["rules"].append(info)
+            return node
+
+        if wm.findings.get(condition) == FactStatus.TRUE:
+            node["source"] = "finding"
+            return node
+
+        # 「わからない」と回答したが、それを条件とするANDルールが発火したためTRUEと推論された
+        node["source"] = "inferred"
+        node["inferred_from"] = [
+            self.knowledge_base.rules[i].id
+            for i in self.knowledge_base.rules_by_condition.get(condition, ())
+            if not self.knowledge_base.rules[i].is_or_rule
+            and self.engine.rule_states[self.knowledge_base.rules[i].id].status == RuleStatus.FIRED
+        ]
+        return node
+
+    def _explain_not_true(
+        self, condition: str, value: Optional[FactStatus], in_progress: Set[str]
+    ) -> Dict[str, Any]:
+        """成立を妨げている経路"""
+        node = {"condition": condition, "status": self._status_text(value), "kind": "why_not"}
+        deriving = self.knowledge_base.deriving_rules(condition)
+
+        if not deriving:
+            node["source"] = "finding" if condition in self.engine.working_memory.findings else "unanswered"
+            return node
+
+        node["source"] = "rule"
+        node["rules"] = []
+        for rule in deriving:
+            info = self._rule_info(rule)
+            children = [self._explain(c, in_progress) for c in rule.conditions]
+            # ANDは成立していない条件、ORは全条件（1つも成立していない）が妨げになる
+            info["conditions"] = [c for c in children if c["status"] != "true"]
+            node["rules"].append(info)
+        return node
+
+
+def explain_conditions(engine, conditions: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """複数の条件の説明を取得（省略時は全ゴール）"""
+    explainer = Explainer(engine)
+    if conditions is None:
+        conditions = [r.action for r in engine.knowledge_base.goal_rules]
+    return [explainer.explain(c) for c in conditions]
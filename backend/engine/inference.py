@@ -1,10 +1,11 @@
 """
 推論エンジン - バックワードチェイニング実装
 """
-from typing import Dict, List, Optional, Set, Any
+import heapq
+from typing import Dict, List, Optional, Set, Tuple, Any
 
-from core import Rule, FactStatus, RuleStatus
-from knowledge import get_all_rules, get_goal_rules, get_derived_conditions
+from core import Rule, RuleQuery, FactStatus, RuleStatus
+from knowledge import CompiledKnowledgeBase, GoalView, get_knowledge_base
 from .working_memory import WorkingMemory, RuleState
 from .evaluator import RuleEvaluator
 
@@ -14,6 +15,9 @@ class InferenceEngine:
 
     Smalltalk資料のConsultationクラスに相当。
     バックワードチェイニングによる推論を実装。
+
+    ルール・索引などの不変データはコンパイル済み知識ベースを全セッションで共有し、
+    セッションごとに持つのは作業記憶とルールの評価状態のみ。
     """
 
     MAX_EVALUATION_ITERATIONS = 10
@@ -25,33 +29,81 @@ class InferenceEngine:
         FactStatus.UNKNOWN: "unknown",
     }
 
-    def __init__(self):
+    def __init__(self, knowledge_base: Optional[CompiledKnowledgeBase] = None):
+        self.knowledge_base = knowledge_base or get_knowledge_base()
         self.working_memory = WorkingMemory()
-        self.rules = get_all_rules()
+        self.rules = self.knowledge_base.rules
         self.rule_states: Dict[str, RuleState] = {}
         self.current_question: Optional[str] = None
         self.current_goal: Optional[Rule] = None
-        self.derived_conditions = get_derived_conditions()
+        self.derived_conditions = self.knowledge_base.derived_conditions
         self.reasoning_log: List[str] = []
+        # 最後に go_back() した時点の回答数（戻っていなければNone）。
+        # 戻った後の状態は、その時点の回答と以後の回答の並びで決まる
+        self.rewound_at: Optional[int] = None
+        # ゴールのBDDにこのセッションの回答を当てはめた根ノード（get_goal_analysis で差分更新する）
+        self._goal_view: Optional[GoalView] = None
 
         for rule in self.rules:
             self.rule_states[rule.id] = RuleState(rule=rule)
 
+        self._reset_agenda()
+        self._bind_evaluator()
+
+    def _bind_evaluator(self):
         self.evaluator = RuleEvaluator(
             self.working_memory,
             self.rule_states,
-            self.derived_conditions,
-            self.rules
+            self.knowledge_base
         )
 
+    def clone(self) -> "InferenceEngine":
+        """同じ知識ベースを共有したまま、セッション状態だけを複製する"""
+        engine = InferenceEngine.__new__(InferenceEngine)
+        engine.knowledge_base = self.knowledge_base
+        engine.rules = self.rules
+        engine.derived_conditions = self.derived_conditions
+        engine.working_memory = WorkingMemory(
+            findings=dict(self.working_memory.findings),
+            hypotheses=dict(self.working_memory.hypotheses),
+            answer_history=list(self.working_memory.answer_history)
+        )
+        engine.rule_states = {
+            rule_id: RuleState(
+                rule=state.rule,
+                status=state.status,
+                checked_conditions=dict(state.checked_conditions)
+            )
+            for rule_id, state in self.rule_states.items()
+        }
+        engine.current_question = self.current_question
+        engine.current_goal = self.current_goal
+        engine.reasoning_log = list(self.reasoning_log)
+        engine.rewound_at = self.rewound_at
+        engine._goal_view = self._goal_view.copy() if self._goal_view is not None else None
+        engine._open_questions = dict(self._open_questions)
+        engine._agenda = list(self._agenda)
+        engine._on_agenda = set(self._on_agenda)
+        engine._bind_evaluator()
+        return engine
+
     def start_consultation(self) -> Optional[str]:
         """診断を開始"""
         self.reasoning_log.append("診断を開始します。全ゴールルールを並行評価します。")
         return self._get_next_question()
 
-    def answer_question(self, condition: str, answer: str) -> Dict[str, Any]:
-        """質問に回答"""
+    def answer_question(
+        self, condition: str, answer: str, rules_query: Optional[RuleQuery] = None,
+        include_rules_status: bool = True
+    ) -> Dict[str, Any]:
+        """質問に回答
+
+        rules_queryを指定するとrules_statusを絞り込む。
+        include_rules_status=False ならrules_statusを作らない（呼び出し側でエンコードする場合）。
+        """
         status = {"yes": FactStatus.TRUE, "no": FactStatus.FALSE}.get(answer, FactStatus.UNKNOWN)
+        hypotheses_before = dict(self.working_memory.hypotheses)
+        statuses_before = {rid: s.status for rid, s in self.rule_states.items()}
         self.working_memory.put_finding(condition, status)
         self.reasoning_log.append(f"回答: 「{condition}」→ {answer}")
 
@@ -66,6 +118,12 @@ class InferenceEngine:
                 all(self.rule_states[rid].status == prev_statuses[rid] for rid in self.rule_states)):
                 break
 
+        hypotheses = self.working_memory.hypotheses
+        self._invalidate_open_questions(
+            [condition] + [c for c in hypotheses.keys() | hypotheses_before.keys()
+                           if hypotheses.get(c) != hypotheses_before.get(c)],
+            [rid for rid, s in self.rule_states.items() if s.status != statuses_before[rid]]
+        )
         next_q = self._get_next_question()
         is_complete = next_q is None or self._is_diagnosis_complete()
 
@@ -73,19 +131,117 @@ class InferenceEngine:
             "next_question": next_q,
             "is_complete": is_complete,
             "derived_facts": list(self.working_memory.hypotheses.keys()),
-            "rules_status": self.get_rules_display_info()
         }
+        if include_rules_status:
+            result.update(self.build_rules_status(rules_query))
 
         if is_complete:
             result["diagnosis_result"] = self._generate_result()
 
         return result
 
+    def _reset_agenda(self):
+        """質問の候補（アジェンダ）を全ゴールで作り直す
+
+        _agenda はまだ質問が残っているかもしれないゴールの順番（goal_rulesの中の位置）のヒープ。
+        _open_questions はルールの位置 -> そのルールをたどって最初に見つかる未回答の条件
+        （なければNone）で、ルールの状態や条件の値が変わるまで使い回す。
+        """
+        self._open_questions: Dict[int, Optional[str]] = {}
+        self._agenda: List[int] = list(range(len(self.knowledge_base.goal_indices)))
+        self._on_agenda: Set[int] = set(self._agenda)
+
+    def _invalidate_open_questions(self, conditions: List[str], rule_ids: List[str]):
+        """値が変わった条件・状態が変わったルールから、条件をたどって影響するルールの結果を捨てる
+
+        影響するゴールはアジェンダに戻す。
+        """
+        kb = self.knowledge_base
+        stack = [i for cond in conditions for i in kb.rules_by_condition.get(cond, ())]
+        stack.extend(i for rid in rule_ids for i in kb.rules_by_action.get(rid, ()))
+        seen: Set[int] = set()
+        while stack:
+            index = stack.pop()
+            if index in seen:
+                continue
+            seen.add(index)
+            self._open_questions.pop(index, None)
+            position = kb.goal_positions.get(index)
+            if position is not None and position not in self._on_agenda:
+                heapq.heappush(self._agenda, position)
+                self._on_agenda.add(position)
+            stack.extend(kb.rules_by_condition.get(self.rules[index].action, ()))
+
     def _get_next_question(self) -> Optional[str]:
-        """次の質問を取得"""
-        goal_rules = get_goal_rules()
+        """次の質問を取得
+
+        アジェンダの先頭（rules.json順で最初のゴール）から、質問が見つかるまで取り出す。
+        質問が残っていないゴールはアジェンダから外し、関係する条件かルールが変わったときに戻す。
+        """
+        if not self.knowledge_base.is_acyclic:
+            return self._get_next_question_by_walk()
+
+        goal_indices = self.knowledge_base.goal_indices
+        while self._agenda:
+            position = self._agenda[0]
+            question = self._open_question(goal_indices[position])
+            if question:
+                self.current_question = question
+                self.current_goal = self.rules[goal_indices[position]]
+                return question
+            heapq.heappop(self._agenda)
+            self._on_agenda.discard(position)
+
+        self.current_goal = None
+        return None
+
+    def _open_question(self, index: int) -> Optional[str]:
+        """ルールの条件をたどって最初に見つかる未回答の条件（_find_next_question_for_rule と同じ順序）
+
+        ルールの条件の参照に循環がないので、結果はたどってきた経路によらない。
+        """
+        if index in self._open_questions:
+            return self._open_questions[index]
+
+        rule = self.rules[index]
+        state = self.rule_states[rule.id]
+        question = None
+        if state.status not in (RuleStatus.BLOCKED, RuleStatus.FIRED):
+            # このルールを評価中にマーク
+            if state.status == RuleStatus.PENDING:
+                state.status = RuleStatus.EVALUATING
+            question = self._first_open_condition(rule)
+
+        self._open_questions[index] = question
+        return question
+
+    def _first_open_condition(self, rule: Rule) -> Optional[str]:
+        for cond in rule.conditions:
+            val = self.evaluator.get_effective_value(cond)
+
+            if val is None or val == FactStatus.PENDING:
+                return cond
+
+            elif val == FactStatus.UNKNOWN and cond in self.derived_conditions:
+                for i in self.knowledge_base.rules_by_action.get(cond, ()):
+                    if self.rule_states[self.rules[i].id].status not in (RuleStatus.BLOCKED, RuleStatus.FIRED):
+                        sub_question = self._open_question(i)
+                        if sub_question:
+                            return sub_question
+
+            elif val == FactStatus.FALSE:
+                if not rule.is_or_rule:
+                    return None
+
+            elif val == FactStatus.TRUE:
+                if rule.is_or_rule:
+                    return None
 
-        for goal_rule in goal_rules:
+        return None
+
+    def _get_next_question_by_walk(self) -> Optional[str]:
+        """次の質問を全ゴールをたどって取得（条件の参照に循環がある知識ベース用）"""
+        for goal_rule in self.knowledge_base.goal_rules:
             if self.rule_states[goal_rule.id].status in (RuleStatus.BLOCKED, RuleStatus.FIRED):
                 continue
 
@@ -238,7 +394,7 @@ class InferenceEngine:
         """診断完了かチェック"""
         return all(
             RuleStatus.is_resolved(self.rule_states[g.id].status)
-            for g in get_goal_rules()
+            for g in self.knowledge_base.goal_rules
         )
 
     def _get_unknown_answered_conditions(self) -> List[str]:
@@ -256,7 +412,7 @@ class InferenceEngine:
         # 「わからない」と回答された質問を取得
         unknown_answered = self._get_unknown_answered_conditions()
 
-        for goal_rule in get_goal_rules():
+        for goal_rule in self.knowledge_base.goal_rules:
             state = self.rule_states.get(goal_rule.id)
 
             if state:
@@ -309,43 +465,105 @@ class InferenceEngine:
                     if cond not in result:
                         result.append(cond)
 
-    def get_rules_display_info(self) -> List[Dict[str, Any]]:
-        """推論画面表示用のルール情報を取得"""
-        result = []
+    def get_display_status_values(self) -> Tuple[Dict[str, str], List[str]]:
+        """推論画面表示用のルール情報のうち、セッションごとに変わる値
+
+        Returns:
+            (条件 -> 表示用ステータス, display_skeleton順のルールのステータス)
+        """
+        get_value = self.evaluator.get_effective_value
+        display = self.FACT_STATUS_DISPLAY
+        rule_states = self.rule_states
+
+        condition_status: Dict[str, str] = {}
+        rule_status: List[str] = []
+        for rule_id, _, _, conditions, _, _ in self.knowledge_base.display_skeleton:
+            for cond, _ in conditions:
+                if cond not in condition_status:
+                    condition_status[cond] = display.get(get_value(cond), "unchecked")
+            rule_status.append(rule_states[rule_id].status.value)
+        return condition_status, rule_status
 
-        # 元のルール順序でインデックスを取得
-        rule_index_map = {r.id: idx for idx, r in enumerate(self.rules)}
+    def get_rules_display_info(self) -> List[Dict[str, Any]]:
+        """推論画面表示用のルール情報を取得
 
-        for state in self.rule_states.values():
-            rule = state.rule
-            conditions_info = [
-                {
-                    "text": cond,
-                    "status": self.FACT_STATUS_DISPLAY.get(
-                        self.evaluator.get_effective_value(cond), "unchecked"
-                    ),
-                    "is_derived": cond in self.derived_conditions
-                }
-                for cond in rule.conditions
-            ]
+        ルールごとの固定部分は知識ベースで1回だけ作っておき（display_skeleton）、
+        ここではセッションごとの状態だけを埋める。
+        """
+        condition_status, rule_status = self.get_display_status_values()
+        return [
+            {
+                "id": rule_id,
+                "index": index,
+                "action": action,
+                "conditions": [
+                    {"text": cond, "status": condition_status[cond], "is_derived": is_derived}
+                    for cond, is_derived in conditions
+                ],
+                "conclusion": action,
+                "status": status,
+                "is_and_rule": is_and_rule,
+                "operator": operator
+            }
+            for (rule_id, index, action, conditions, is_and_rule, operator), status
+            in zip(self.knowledge_base.display_skeleton, rule_status)
+        ]
 
-            result.append({
-                "id": rule.id,
-                "index": rule_index_map.get(rule.id, 0),
-                "action": rule.action,
-                "conditions": conditions_info,
-                "conclusion": rule.action,
-                "status": state.status.value,
-                "is_and_rule": not rule.is_or_rule,
-                "operator": "AND" if not rule.is_or_rule else "OR"
-            })
-
-        # rules.json順でソート
-        result.sort(key=lambda r: r["index"])
-        return result
+    def get_rules_display_page(self, query: RuleQuery) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+        """絞り込み・ページ分割したルール情報を取得（指定されたフィールドだけを作る）
 
-    def go_back(self, steps: int = 1) -> Dict[str, Any]:
-        """前の質問に戻る"""
+        Returns:
+            (ルール情報のリスト, 次のページの開始位置の直前の位置。最後のページならNone)
+        """
+        result = []
+        for idx, rule in enumerate(self.rules):
+            if idx <= query.after:
+                continue
+            state = self.rule_states[rule.id]
+            if not query.matches(rule, state.status.value):
+                continue
+            if query.limit is not None and len(result) >= query.limit:
+                return result, result[-1]["index"] if result else None
+
+            info = {"index": idx}
+            if query.wants("id"):
+                info["id"] = rule.id
+            if query.wants("action"):
+                info["action"] = rule.action
+            if query.wants("conditions"):
+                info["conditions"] = [
+                    {
+                        "text": cond,
+                        "status": self.FACT_STATUS_DISPLAY.get(
+                            self.evaluator.get_effective_value(cond), "unchecked"
+                        ),
+                        "is_derived": cond in self.derived_conditions
+                    }
+                    for cond in rule.conditions
+                ]
+            if query.wants("conclusion"):
+                info["conclusion"] = rule.action
+            if query.wants("status"):
+                info["status"] = state.status.value
+            if query.wants("is_and_rule"):
+                info["is_and_rule"] = not rule.is_or_rule
+            if query.wants("operator"):
+                info["operator"] = "AND" if not rule.is_or_rule else "OR"
+            result.append(info)
+        return result, None
+
+    def build_rules_status(self, query: Optional[RuleQuery] = None) -> Dict[str, Any]:
+        """レスポンス用のルール情報（指定があれば絞り込んだページと次の開始位置）"""
+        if query is None:
+            return {"rules_status": self.get_rules_display_info()}
+        items, next_after = self.get_rules_display_page(query)
+        return {"rules_status": items, "rules_next_after": next_after}
+
+    def go_back(
+        self, steps: int = 1, rules_query: Optional[RuleQuery] = None,
+        include_rules_status: bool = True
+    ) -> Dict[str, Any]:
+        """前の質問に戻る（rules_query / include_rules_status は answer_question と同じ）"""
         if len(self.working_memory.answer_history) < steps:
             steps = len(self.working_memory.answer_history)
 
@@ -358,33 +576,43 @@ class InferenceEngine:
                 ]
 
                 self.working_memory.clear_after(target_cond)
+                self._reevaluate()
 
-                for state in self.rule_states.values():
-                    state.status = RuleStatus.PENDING
-                    state.checked_conditions.clear()
-
-                self.evaluator.evaluate_all_rules()
-                self._propagate_inferences()
-
-                # 戻った位置から再度質問を取得（ルールのEVALUATINGマークも行われる）
-                self._get_next_question()
-
-        return {
+        result = {
             "current_question": self.current_question,
             "answered_questions": [
                 {"condition": c, "answer": s.value}
                 for c, s in self.working_memory.answer_history
             ],
-            "rules_status": self.get_rules_display_info()
         }
+        if include_rules_status:
+            result.update(self.build_rules_status(rules_query))
+        return result
+
+    def _reevaluate(self):
+        """回答（findings）だけを残して、仮説とルールの状態を評価し直す（go_back() の後半）"""
+        self.working_memory.hypotheses.clear()
+        for state in self.rule_states.values():
+            state.status = RuleStatus.PENDING
+            state.checked_conditions.clear()
+        self._reset_agenda()
+
+        self.evaluator.evaluate_all_rules()
+        self._propagate_inferences()
+
+        # 戻った位置から再度質問を取得（ルールのEVALUATINGマークも行われる）
+        self._get_next_question()
+        self.rewound_at = len(self.working_memory.answer_history)
 
     def restart(self) -> Optional[str]:
         """最初からやり直し"""
         self.__init__()
         return self.start_consultation()
 
-    def get_current_state(self) -> Dict[str, Any]:
-        """現在の状態を取得"""
+    def get_current_state(
+        self, rules_query: Optional[RuleQuery] = None, include_rules_status: bool = True
+    ) -> Dict[str, Any]:
+        """現在の状態を取得（rules_query / include_rules_status は answer_question と同じ）"""
         is_complete = self.current_question is None or self._is_diagnosis_complete()
 
         result = {
@@ -393,12 +621,23 @@ class InferenceEngine:
                 {"condition": c, "answer": s.value}
                 for c, s in self.working_memory.answer_history
             ],
-            "rules_status": self.get_rules_display_info(),
-            "derived_facts": list(self.working_memory.hypotheses.keys()),
-            "is_complete": is_complete
         }
+        if include_rules_status:
+            result.update(self.build_rules_status(rules_query))
+        result["derived_facts"] = list(self.working_memory.hypotheses.keys())
+        result["is_complete"] = is_complete
 
         if is_complete:
             result["diagnosis_result"] = self._generate_result()
 
         return result
+
+    def get_goal_analysis(self) -> Dict[str, Any]:
+        """ゴールのBDDから読み出した各ゴールの状態と、まだ関係する質問"""
+        diagram = self.knowledge_base.goal_diagram
+        self._goal_view = diagram.view(self._goal_view, self.working_memory.findings)
+        goals = diagram.analyze_view(self._goal_view)
+        return {
+            "goals": goals,
+            "relevant_questions": diagram.relevant_questions_of(goals),
+        }
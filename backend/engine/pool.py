@@ -0,0 +1,73 @@
+"""
+エンジンプール - 最初の質問まで計算済みのエンジンを用意しておく
+"""
+import threading
+from collections import deque
+from typing import Deque, Optional
+
+from knowledge import CompiledKnowledgeBase, get_knowledge_base
+from .inference import InferenceEngine
+
+
+class EnginePool:
+    """開始済みエンジンのプール
+
+    最初の質問は同じ知識ベースなら全利用者で同じなので、知識ベースごとに
+    start_consultation() 済みのプロトタイプを1つ作り、セッションにはその複製を渡す。
+    複製もあらかじめ数個作っておき、/start・/restart ではプールから取り出すだけにする。
+    """
+
+    DEFAULT_SIZE = 4
+
+    def __init__(self, size: int = DEFAULT_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._knowledge_base: Optional[CompiledKnowledgeBase] = None
+        self._prototype: Optional[InferenceEngine] = None
+        self._ready: Deque[InferenceEngine] = deque()
+
+    def _prototype_for(self, knowledge_base: CompiledKnowledgeBase) -> InferenceEngine:
+        """知識ベースに対応するプロトタイプを取得（知識ベースが変わったら作り直す）"""
+        if self._knowledge_base is not knowledge_base:
+            prototype = InferenceEngine(knowledge_base)
+            prototype.start_consultation()
+            self._knowledge_base = knowledge_base
+            self._prototype = prototype
+            self._ready.clear()
+        return self._prototype
+
+    def acquire(self, knowledge_base: Optional[CompiledKnowledgeBase] = None) -> InferenceEngine:
+        """開始済みのエンジンを取り出す
+
+        現在の知識ベース以外（編集前の版など）を指定した場合はプールを使わずに作る。
+        """
+        current = get_knowledge_base()
+        if knowledge_base is not None and knowledge_base is not current:
+            engine = InferenceEngine(knowledge_base)
+            engine.start_consultation()
+            return engine
+
+        knowledge_base = current
+        with self._lock:
+            prototype = self._prototype_for(knowledge_base)
+            if self._ready:
+                return self._ready.popleft()
+        return prototype.clone()
+
+    def refill(self):
+        """プールを規定数まで補充（レスポンス送信後のバックグラウンド処理で呼ぶ）"""
+        with self._lock:
+            knowledge_base = self._knowledge_base
+            prototype = self._prototype
+            missing = self.size - len(self._ready)
+        if prototype is None:
+            return
+
+        engines = [prototype.clone() for _ in range(missing)]
+        with self._lock:
+            # 補充中に知識ベースが変わっていれば捨てる
+            if self._knowledge_base is knowledge_base:
+                self._ready.extend(engines[:self.size - len(self._ready)])
+
+
+engine_pool = EnginePool()
@@ -0,0 +1,179 @@
+"""
+What-if分析 - セッションを複製して別の回答を適用した場合の診断を求める
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from core import FactStatus
+from knowledge import CompiledKnowledgeBase
+from .inference import InferenceEngine
+from .pool import engine_pool
+
+
+ANSWER_BY_STATUS = {
+    FactStatus.TRUE: "yes",
+    FactStatus.FALSE: "no",
+    FactStatus.UNKNOWN: "unknown",
+}
+
+
+class PrefixSnapshotCache:
+    """回答列の先頭部分ごとのエンジン状態（LRU）
+
+    同じセッションの同じ位置から分岐するforkは、分岐点までの状態を共有する。
+    キャッシュ内のエンジンは変更せず、使うときは必ず clone() する。
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple, InferenceEngine]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple) -> Optional[InferenceEngine]:
+        with self._lock:
+            engine = self._entries.get(key)
+            if engine is not None:
+                self._entries.move_to_end(key)
+            return engine
+
+    def put(self, key: Tuple, engine: InferenceEngine):
+        with self._lock:
+            self._entries[key] = engine
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+prefix_cache = PrefixSnapshotCache()
+
+
+def snapshot_for_answers(
+    kb: CompiledKnowledgeBase,
+    answers: Sequence[Tuple[str, str]],
+    rewound_at: Optional[int] = None
+) -> InferenceEngine:
+    """answers を順に回答した時点のエンジン（キャッシュ共有、変更不可）
+
+    rewound_at を指定すると、最初の rewound_at 個まで回答して go_back() で戻った状態から
+    残りを回答したエンジンになる（InferenceEngine.rewound_at と同じ）。
+    キャッシュにある最も長い先頭部分の状態から続きを回答する。
+    """
+    answers = tuple(answers)
+    key = (kb.content_hash, answers, rewound_at)
+    snapshot = prefix_cache.get(key)
+    if snapshot is not None:
+        return snapshot
+
+    start = rewound_at or 0
+    cached = len(answers) - 1
+    while cached >= start:
+        base = prefix_cache.get((kb.content_hash, answers[:cached], rewound_at))
+        if base is not None:
+            snapshot = base.clone()
+            break
+        cached -= 1
+    else:
+        cached = start
+        if rewound_at is None:
+            snapshot = engine_pool.acquire(kb)
+        else:
+            snapshot = snapshot_for_answers(kb, answers[:rewound_at]).clone()
+            snapshot._reevaluate()
+
+    for condition, answer in answers[cached:]:
+        snapshot.answer_question(condition, answer)
+    prefix_cache.put(key, snapshot)
+    return snapshot
+
+
+def answers_of(engine: InferenceEngine) -> Tuple[Tuple[str, str], ...]:
+    """エンジンの回答履歴を (条件, 回答) の並びで返す"""
+    return tuple(
+        (condition, ANSWER_BY_STATUS.get(status, "unknown"))
+        for condition, status in engine.working_memory.answer_history
+    )
+
+
+def remember_snapshot(engine: InferenceEngine):
+    """エンジンを回答履歴の時点の状態としてキャッシュに入れる（以後は変更しないこと）"""
+    prefix_cache.put((engine.knowledge_base.content_hash, answers_of(engine), engine.rewound_at), engine)
+
+
+def fork_with_answers(engine: InferenceEngine, overrides: Dict[str, str]) -> InferenceEngine:
+    """回答の一部を差し替えた回答履歴でエンジンを複製（元のエンジンは変更しない）
+
+    履歴にある条件は同じ位置で回答を差し替え、履歴にない条件は末尾に追加する。
+    最初に差し替えた位置までの状態はキャッシュから共有する。
+    """
+    history = list(answers_of(engine))
+
+    divergence = len(history)
+    for i, (condition, _) in enumerate(history):
+        if condition in overrides:
+            divergence = i
+            break
+
+    # go_back() で戻った後の回答だけを差し替えるなら、戻った時点からの状態を使う
+    rewound_at = engine.rewound_at
+    if rewound_at is not None and divergence < rewound_at:
+        rewound_at = None
+    fork = snapshot_for_answers(engine.knowledge_base, history[:divergence], rewound_at).clone()
+    answered = set()
+    for condition, answer in history[divergence:]:
+        fork.answer_question(condition, overrides.get(condition, answer))
+        answered.add(condition)
+    for condition, answer in overrides.items():
+        if condition not in answered:
+            fork.answer_question(condition, answer)
+
+    return fork
+
+
+def summarize_fork(engine: InferenceEngine) -> Dict[str, Any]:
+    """forkした結果の要約（次の質問、ゴールの状態、完了していれば診断結果）"""
+    is_complete = engine.current_question is None or engine._is_diagnosis_complete()
+    result = {
+        "current_question": engine.current_question,
+        "is_complete": is_complete,
+        "answered_questions": [
+            {"condition": c, "answer": s.value}
+            for c, s in engine.working_memory.answer_history
+        ],
+        "goal_statuses": [
+            {"visa": g.action, "status": engine.rule_states[g.id].status.value}
+            for g in engine.knowledge_base.goal_rules
+        ],
+    }
+    if is_complete:
+        result["diagnosis_result"] = engine._generate_result()
+    return result
+
+
+def precompute_answers(engine: InferenceEngine) -> Dict[str, Dict[str, Any]]:
+    """現在の質問に yes / no / unknown と答えた場合それぞれの次の質問（元のエンジンは変更しない）
+
+    forkしたエンジンは回答の並びのキャッシュに入れるので、実際の回答がトークンモードの
+    セッションやwhat-ifで使われたときは再計算しない。診断結果の推論ログは含めない。
+    """
+    question = engine.current_question
+    if question is None:
+        return {}
+
+    results = {}
+    for answer in ANSWER_BY_STATUS.values():
+        fork = engine.clone()
+        result = fork.answer_question(question, answer, include_rules_status=False)
+        remember_snapshot(fork)
+        entry = {"current_question": result["next_question"], "is_complete": result["is_complete"]}
+        if result["is_complete"]:
+            entry["diagnosis_result"] = {
+                k: v for k, v in result["diagnosis_result"].items() if k != "reasoning_log"
+            }
+        results[answer] = entry
+    return results
+
+
+def evaluate_what_if(engine: InferenceEngine, scenarios: List[Dict[str, str]]) -> List[Dict[str, Any]]:
+    """複数のシナリオ（条件 -> 回答）をそれぞれforkして評価"""
+    return [summarize_fork(fork_with_answers(engine, overrides)) for overrides in scenarios]
@@ -9,6 +9,25 @@ from .store import (
     get_derived_conditions,
     reload_rules,
     save_rules,
+    get_rules_version,
+    get_knowledge_base,
+    insert_rule,
+    update_rule,
+    delete_rule,
+    reorder_rules,
+    find_rules_by_action,
+    find_rules_by_condition,
+    export_rules_data,
+)
+from .compiled import CompiledKnowledgeBase, compile_knowledge_base
+from .bdd import GoalDiagram, GoalView, compile_goal_diagram
+from .versions import RulebaseVersions, rulebase_versions
+from .notes import (
+    get_notes,
+    get_note,
+    get_notes_version,
+    update_notes,
+    flush_notes,
 )
 
 __all__ = [
@@ -19,4 +38,25 @@ __all__ = [
     "get_derived_conditions",
     "reload_rules",
     "save_rules",
+    "get_rules_version",
+    "get_knowledge_base",
+    "insert_rule",
+    "update_rule",
+    "delete_rule",
+    "reorder_rules",
+    "find_rules_by_action",
+    "find_rules_by_condition",
+    "export_rules_data",
+    "CompiledKnowledgeBase",
+    "compile_knowledge_base",
+    "GoalDiagram",
+    "GoalView",
+    "compile_goal_diagram",
+    "RulebaseVersions",
+    "rulebase_versions",
+    "get_notes",
+    "get_note",
+    "get_notes_version",
+    "update_notes",
+    "flush_notes",
 ]
@@ -0,0 +1,375 @@
+"""
+ゴールの二分決定図（BDD） - ゴールルールを質問を変数とする論理式としてコンパイルする
+
+全ゴールで1つの既約順序付きBDDを共有する（同じ部分式は同じノードになる）。
+変数の順序は、ゴールをrules.json順にたどって条件が現れる順（質問される順に近い）。
+
+セッションの回答を当てはめた図から、ゴールの状態・まだ関係する質問・
+最短で残り何問で決まるかを直接読み出せる。
+「わからない」と回答した条件は変数のまま残し、それ以外に未回答の変数が残らなければ
+そのゴールは「わからない」で確定したものとする。
+
+導出可能な条件の扱いは推論エンジンに合わせる:
+- 導出ルールから TRUE / FALSE が決まればそれを優先する
+  （FALSE はANDルールを含む場合のみ。ORルールだけでは導出しない）
+- 決まらなければ、その条件への直接の回答（はい / いいえ）を使う
+- 導出も回答もできない場合はその条件自体を質問の変数とする
+"""
+import threading
+from typing import Any, Dict, List, Mapping, Optional, Set, Tuple
+
+from core import Rule, FactStatus
+
+
+FALSE_NODE = 0
+TRUE_NODE = 1
+
+
+def _variable_order(kb) -> Tuple[str, ...]:
+    """変数の順序（ゴールから深さ優先でたどり、導出可能な条件は導出元の後に置く）"""
+    order: List[str] = []
+    seen: Set[str] = set()
+
+    def visit(condition: str, path: Set[str]):
+        if condition in seen or condition in path:
+            return
+        path.add(condition)
+        for i in kb.rules_by_action.get(condition, ()):
+            for cond in kb.rules[i].conditions:
+                visit(cond, path)
+        path.discard(condition)
+        seen.add(condition)
+        order.append(condition)
+
+    for goal in kb.goal_rules:
+        for cond in goal.conditions:
+            visit(cond, set())
+    # ゴールから到達しない条件も変数として持っておく
+    for rule in kb.rules:
+        for cond in rule.conditions:
+            visit(cond, set())
+        visit(rule.action, set())
+    return tuple(order)
+
+
+# ノード表がこの数を超えたら新しい表に切り替える（古い表は使っているセッションがなくなれば解放される）
+MAX_TABLE_NODES = 50000
+
+
+class _NodeTable:
+    """BDDのノード表と演算キャッシュ
+
+    ノードは整数ID（0: FALSE, 1: TRUE）。ノードは追加するだけで変更しないので、
+    作成済みのノードはロックなしで読める（追加は GoalDiagram のロックの中で行う）。
+    """
+
+    def __init__(self, terminal_var: int):
+        self.nodes: List[Tuple[int, int, int]] = [
+            (terminal_var, FALSE_NODE, FALSE_NODE),
+            (terminal_var, TRUE_NODE, TRUE_NODE),
+        ]
+        self._unique: Dict[Tuple[int, int, int], int] = {}
+        self._and_cache: Dict[Tuple[int, int], int] = {}
+        self._or_cache: Dict[Tuple[int, int], int] = {}
+
+    def mk(self, var: int, low: int, high: int) -> int:
+        if low == high:
+            return low
+        key = (var, low, high)
+        node = self._unique.get(key)
+        if node is None:
+            node = len(self.nodes)
+            self.nodes.append(key)
+            self._unique[key] = node
+        return node
+
+    def apply(self, is_and: bool, u: int, v: int) -> int:
+        if is_and:
+            if u == FALSE_NODE or v == FALSE_NODE:
+                return FALSE_NODE
+            if u == TRUE_NODE:
+                return v
+            if v == TRUE_NODE:
+                return u
+        else:
+            if u == TRUE_NODE or v == TRUE_NODE:
+                return TRUE_NODE
+            if u == FALSE_NODE:
+                return v
+            if v == FALSE_NODE:
+                return u
+        if u == v:
+            return u
+
+        key = (u, v) if u < v else (v, u)
+        cache = self._and_cache if is_and else self._or_cache
+        result = cache.get(key)
+        if result is not None:
+            return result
+
+        var_u, low_u, high_u = self.nodes[u]
+        var_v, low_v, high_v = self.nodes[v]
+        top = min(var_u, var_v)
+        if var_u != top:
+            low_u = high_u = u
+        if var_v != top:
+            low_v = high_v = v
+
+        result = self.mk(
+            top,
+            self.apply(is_and, low_u, low_v),
+            self.apply(is_and, high_u, high_v),
+        )
+        cache[key] = result
+        return result
+
+    def support(self, node: int) -> Set[int]:
+        """ノードが依存する変数"""
+        result: Set[int] = set()
+        stack = [node]
+        seen: Set[int] = set()
+        while stack:
+            n = stack.pop()
+            if n <= TRUE_NODE or n in seen:
+                continue
+            seen.add(n)
+            var, low, high = self.nodes[n]
+            result.add(var)
+            stack.append(low)
+            stack.append(high)
+        return result
+
+    def min_questions(self, node: int, unknown_vars: Set[int], memo: Dict[int, int]) -> int:
+        """最短であと何問で未回答の変数に依存しなくなるか
+
+        未回答の変数は有利な方の分岐、「わからない」と回答した変数は両方の分岐を考える。
+        """
+        if node <= TRUE_NODE:
+            return 0
+        cached = memo.get(node)
+        if cached is not None:
+            return cached
+
+        var, low, high = self.nodes[node]
+        low_count = self.min_questions(low, unknown_vars, memo)
+        high_count = self.min_questions(high, unknown_vars, memo)
+        if var in unknown_vars:
+            count = max(low_count, high_count)
+        else:
+            count = 1 + min(low_count, high_count)
+        memo[node] = count
+        return count
+
+
+class GoalView:
+    """セッションの回答を当てはめたゴールの根ノード（セッションごとに持つ）
+
+    回答が変わったら、その条件から導出をたどって影響する条件のノードだけを作り直す。
+    読み出しの結果は次に回答が変わるまで保持する。
+    """
+    __slots__ = ("table", "findings", "memo", "roots", "analysis")
+
+    def __init__(self, table: _NodeTable):
+        self.table = table
+        self.findings: Dict[str, FactStatus] = {}
+        self.memo: Dict[str, int] = {}     # 条件 -> ノード
+        self.roots: Dict[str, int] = {}    # ゴールのaction -> ノード
+        self.analysis: Optional[List[Dict[str, Any]]] = None
+
+    def copy(self) -> "GoalView":
+        view = GoalView(self.table)
+        view.findings = dict(self.findings)
+        view.memo = dict(self.memo)
+        view.roots = dict(self.roots)
+        view.analysis = self.analysis
+        return view
+
+
+class GoalDiagram:
+    """全ゴール共有のBDD
+
+    ノード表と演算キャッシュは全セッションで共有するため、同じ回答の組み合わせの
+    計算は2回目から表引きになる。セッションごとの根ノードは GoalView に持ち、
+    回答のたびに影響する部分だけを更新する。ノード表が MAX_TABLE_NODES を超えたら
+    新しい表に切り替え、古い表のセッションは次の更新で新しい表に作り直す。
+    """
+
+    def __init__(self, knowledge_base):
+        self.knowledge_base = knowledge_base
+        self.variables = _variable_order(knowledge_base)
+        self.var_index = {c: i for i, c in enumerate(self.variables)}
+        self._lock = threading.Lock()
+        self._table = _NodeTable(len(self.variables))
+
+    @property
+    def node_count(self) -> int:
+        return len(self._table.nodes)
+
+    # --- ルール構造から図を組み立てる（ロックの中で呼ぶ） ---
+
+    def _answer_node(self, table: _NodeTable, condition: str, answer: Optional[FactStatus]) -> int:
+        if answer == FactStatus.TRUE:
+            return TRUE_NODE
+        if answer == FactStatus.FALSE:
+            return FALSE_NODE
+        return table.mk(self.var_index[condition], FALSE_NODE, TRUE_NODE)
+
+    def _rule_node(self, table: _NodeTable, rule: Rule, findings: Mapping[str, FactStatus],
+                   memo: Dict[str, int], in_progress: Set[str]) -> int:
+        if rule.is_or_rule:
+            node = FALSE_NODE
+            for cond in rule.conditions:
+                node = table.apply(False, node, self._condition_node(table, cond, findings, memo, in_progress))
+                if node == TRUE_NODE:
+                    break
+        else:
+            node = TRUE_NODE
+            for cond in rule.conditions:
+                node = table.apply(True, node, self._condition_node(table, cond, findings, memo, in_progress))
+                if node == FALSE_NODE:
+                    break
+        return node
+
+    def _condition_node(self, table: _NodeTable, condition: str, findings: Mapping[str, FactStatus],
+                        memo: Dict[str, int], in_progress: Set[str]) -> int:
+        node = memo.get(condition)
+        if node is not None:
+            return node
+
+        kb = self.knowledge_base
+        answer = findings.get(condition)
+        rule_indices = kb.rules_by_action.get(condition, ())
+        if not rule_indices:
+            node = self._answer_node(table, condition, answer)
+        else:
+            if condition in in_progress:
+                raise ValueError(f"循環参照: 「{condition}」")
+            in_progress.add(condition)
+            derived = FALSE_NODE
+            for i in rule_indices:
+                derived = table.apply(
+                    False, derived, self._rule_node(table, kb.rules[i], findings, memo, in_progress)
+                )
+            in_progress.discard(condition)
+
+            if derived == TRUE_NODE:
+                node = TRUE_NODE
+            elif derived == FALSE_NODE:
+                if any(not kb.rules[i].is_or_rule for i in rule_indices):
+                    node = FALSE_NODE
+                else:
+                    node = self._answer_node(table, condition, answer)
+            elif answer in (FactStatus.TRUE, FactStatus.FALSE):
+                node = self._answer_node(table, condition, answer)
+            else:
+                node = derived
+
+        memo[condition] = node
+        return node
+
+    def _affected_conditions(self, changed: Set[str]) -> Set[str]:
+        """changedの条件と、それを条件にたどって導出されるaction"""
+        kb = self.knowledge_base
+        affected = set()
+        stack = list(changed)
+        while stack:
+            condition = stack.pop()
+            if condition in affected:
+                continue
+            affected.add(condition)
+            for i in kb.rules_by_condition.get(condition, ()):
+                stack.append(kb.rules[i].action)
+        return affected
+
+    def view(self, view: Optional[GoalView], findings: Mapping[str, FactStatus]) -> GoalView:
+        """回答を当てはめたゴールの根ノード（viewを渡すと、前回からの回答の差分だけ更新する）"""
+        goals = self.knowledge_base.goal_rules
+        with self._lock:
+            table = self._table
+            if view is None or view.table is not table:
+                view = GoalView(table)
+                affected = None
+            else:
+                changed = {
+                    c for c in findings.keys() | view.findings.keys()
+                    if findings.get(c) != view.findings.get(c)
+                }
+                if not changed:
+                    return view
+                affected = self._affected_conditions(changed)
+                for condition in affected:
+                    view.memo.pop(condition, None)
+
+            for goal in goals:
+                if affected is None or goal.action in affected:
+                    view.roots[goal.action] = self._rule_node(table, goal, findings, view.memo, set())
+            view.findings = dict(findings)
+            view.analysis = None
+
+            if len(table.nodes) > MAX_TABLE_NODES:
+                self._table = _NodeTable(len(self.variables))
+        return view
+
+    # --- 図からの読み出し（作成済みのノードを読むだけなのでロックしない） ---
+
+    def analyze_view(self, view: GoalView) -> List[Dict[str, Any]]:
+        """viewの各ゴールの状態（analyze と同じ。結果はviewに保持する）"""
+        if view.analysis is not None:
+            return view.analysis
+        table = view.table
+        unknown_vars = {
+            self.var_index[c] for c, s in view.findings.items()
+            if s == FactStatus.UNKNOWN and c in self.var_index
+        }
+
+        result = []
+        memo: Dict[int, int] = {}
+        for goal in self.knowledge_base.goal_rules:
+            node = view.roots[goal.action]
+            if node == TRUE_NODE:
+                status = "true"
+                questions: List[str] = []
+            elif node == FALSE_NODE:
+                status = "false"
+                questions = []
+            else:
+                questions = [
+                    self.variables[v] for v in sorted(table.support(node))
+                    if v not in unknown_vars
+                ]
+                status = "pending" if questions else "unknown"
+
+            result.append({
+                "visa": goal.action,
+                "rule_id": goal.id,
+                "status": status,
+                "relevant_questions": questions,
+                "min_remaining_questions": table.min_questions(node, unknown_vars, memo),
+            })
+        view.analysis = result
+        return result
+
+    def analyze(self, findings: Mapping[str, FactStatus]) -> List[Dict[str, Any]]:
+        """回答を当てはめた各ゴールの状態
+
+        status:
+            true / false: 確定
+            unknown: 「わからない」と回答した条件にのみ依存している（これ以上の質問では決まらない）
+            pending: まだ関係する未回答の質問がある
+        セッションで繰り返し使う場合は view() と analyze_view() で差分だけ更新する。
+        """
+        return self.analyze_view(self.view(None, findings))
+
+    def relevant_questions_of(self, analysis: List[Dict[str, Any]]) -> List[str]:
+        """analyze の結果から、まだいずれかの未確定ゴールに関係する質問（変数順）"""
+        questions = {cond for goal in analysis for cond in goal["relevant_questions"]}
+        return sorted(questions, key=self.var_index.__getitem__)
+
+    def relevant_questions(self, findings: Mapping[str, FactStatus]) -> List[str]:
+        """まだいずれかの未確定ゴールに関係する質問（変数順）"""
+        return self.relevant_questions_of(self.analyze(findings))
+
+
+def compile_goal_diagram(knowledge_base) -> GoalDiagram:
+    """知識ベースからゴールのBDDを作る"""
+    return GoalDiagram(knowledge_base)
@@ -0,0 +1,266 @@
+"""
+コンパイル済み知識ベース - 起動時のJSON解析と派生構造の構築を省略する
+
+rules.json の内容ハッシュをキーに、ルールと索引をまとめた
+バイナリ（rules.kb）を rules.json と同じディレクトリに書き出す。
+次回以降は1回の読み込みで復元し、rules.json が変わっていればJSONから作り直す。
+"""
+import hashlib
+import json
+import marshal
+import os
+import sys
+import tempfile
+from collections import deque
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from core import Rule
+from .loader import DATA_DIR, parse_rules_data, read_rules_file_bytes
+from .bdd import GoalDiagram, compile_goal_diagram
+
+
+KB_FILE = os.path.join(DATA_DIR, "rules.kb")
+
+# 形式を変えたら上げる（古い形式のファイルは無視して作り直す）
+KB_FORMAT_VERSION = 2
+KB_MAGIC = "visa-kb"
+
+
+@dataclass(frozen=True, eq=False)
+class CompiledKnowledgeBase:
+    """コンパイル済み知識ベース（不変）
+
+    ルールの位置（rules.json順のインデックス）で索引を持つ。
+    """
+    content_hash: str                               # ルール内容のハッシュ
+    rules: Tuple[Rule, ...]                         # rules.json順のルール
+    goal_indices: Tuple[int, ...]                   # ゴールルールの位置
+    derived_conditions: FrozenSet[str]              # 他のルールの結論である条件
+    base_conditions: FrozenSet[str]                 # 導出できない条件（質問）
+    rules_by_action: Dict[str, Tuple[int, ...]]     # action -> そのactionを導出するルールの位置
+    rules_by_condition: Dict[str, Tuple[int, ...]]  # 条件 -> その条件を使うルールの位置
+
+    @cached_property
+    def goal_rules(self) -> Tuple[Rule, ...]:
+        """ゴールルール（rules.json順）"""
+        return tuple(self.rules[i] for i in self.goal_indices)
+
+    @cached_property
+    def goal_positions(self) -> Dict[int, int]:
+        """ルールの位置 -> goal_rules の中での順番"""
+        return {index: position for position, index in enumerate(self.goal_indices)}
+
+    @cached_property
+    def conditions_by_code(self) -> Tuple[str, ...]:
+        """番号 -> 条件（条件文の順。同じ内容の知識ベースなら同じ番号になる）"""
+        return tuple(sorted(self.rules_by_condition))
+
+    @cached_property
+    def condition_codes(self) -> Dict[str, int]:
+        """条件 -> 番号（conditions_by_code の逆引き）"""
+        return {cond: code for code, cond in enumerate(self.conditions_by_code)}
+
+    @cached_property
+    def is_acyclic(self) -> bool:
+        """条件をたどって同じactionに戻るルールがないか（自分自身を条件に持つ場合も循環とする）"""
+        remaining = {}
+        dependents: Dict[str, List[str]] = {}
+        for action, indices in self.rules_by_action.items():
+            deps = {
+                cond for i in indices for cond in self.rules[i].conditions
+                if cond in self.rules_by_action
+            }
+            remaining[action] = len(deps)
+            for cond in deps:
+                dependents.setdefault(cond, []).append(action)
+
+        ready = deque(action for action, n in remaining.items() if n == 0)
+        resolved = 0
+        while ready:
+            action = ready.popleft()
+            resolved += 1
+            for dependent in dependents.get(action, ()):
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    ready.append(dependent)
+        return resolved == len(remaining)
+
+    @cached_property
+    def display_skeleton(self) -> Tuple[Tuple[str, int, str, Tuple[Tuple[str, bool], ...], bool, str], ...]:
+        """推論画面表示用のルール情報のうち、セッションによらない部分（rules.json順）
+
+        (id, index, action, ((条件, 導出可能か), ...), ANDルールか, 演算子) のタプル。
+        セッションのルール状態と同じく、actionが重複する場合は後のルールを使う。
+        """
+        by_id: Dict[str, int] = {}
+        for idx, rule in enumerate(self.rules):
+            by_id[rule.id] = idx
+        skeleton = []
+        for rule_id, idx in by_id.items():
+            rule = self.rules[idx]
+            skeleton.append((
+                rule_id,
+                idx,
+                rule.action,
+                tuple((cond, cond in self.derived_conditions) for cond in rule.conditions),
+                not rule.is_or_rule,
+                "AND" if not rule.is_or_rule else "OR",
+            ))
+        skeleton.sort(key=lambda r: r[1])
+        return tuple(skeleton)
+
+    @cached_property
+    def goal_diagram(self) -> GoalDiagram:
+        """ゴールのBDD（最初に使われたときに作る）"""
+        return compile_goal_diagram(self)
+
+    def deriving_rules(self, condition: str) -> List[Rule]:
+        """条件を導出するルールを取得"""
+        return [self.rules[i] for i in self.rules_by_action.get(condition, ())]
+
+
+def compute_content_hash(rules: List[Rule]) -> str:
+    """ルール内容のハッシュ（保存形式やストアの種類に依存しない）"""
+    canonical = json.dumps(
+        [[r.action, list(r.conditions), r.is_or_rule, r.is_goal_action] for r in rules],
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def compile_knowledge_base(rules: List[Rule], content_hash: Optional[str] = None) -> CompiledKnowledgeBase:
+    """ルールリストから知識ベースをコンパイル"""
+    rules = tuple(rules)
+
+    by_action: Dict[str, List[int]] = {}
+    by_condition: Dict[str, List[int]] = {}
+    for i, rule in enumerate(rules):
+        by_action.setdefault(rule.action, []).append(i)
+        for cond in rule.conditions:
+            positions = by_condition.setdefault(cond, [])
+            if not positions or positions[-1] != i:
+                positions.append(i)
+
+    rules_by_action = {k: tuple(v) for k, v in by_action.items()}
+    derived = frozenset(rules_by_action)
+
+    return CompiledKnowledgeBase(
+        content_hash=content_hash or compute_content_hash(list(rules)),
+        rules=rules,
+        goal_indices=tuple(i for i, r in enumerate(rules) if r.is_goal_action),
+        derived_conditions=derived,
+        base_conditions=frozenset(c for c in by_condition if c not in derived),
+        rules_by_action=rules_by_action,
+        rules_by_condition={k: tuple(v) for k, v in by_condition.items()},
+    )
+
+
+# ========== バイナリ形式 ==========
+
+def serialize_knowledge_base(kb: CompiledKnowledgeBase, source_hash: str) -> bytes:
+    """marshal形式にシリアライズ（文字列は文字列表への番号で参照する）"""
+    strings: List[str] = []
+    string_ids: Dict[str, int] = {}
+
+    def sid(text: str) -> int:
+        if text not in string_ids:
+            string_ids[text] = len(strings)
+            strings.append(text)
+        return string_ids[text]
+
+    rules = tuple(
+        (sid(r.action), tuple(sid(c) for c in r.conditions), r.is_or_rule, r.is_goal_action)
+        for r in kb.rules
+    )
+    body = (
+        kb.content_hash,
+        tuple(strings),
+        rules,
+        kb.goal_indices,
+        tuple((string_ids[k], v) for k, v in kb.rules_by_action.items()),
+        tuple((string_ids[k], v) for k, v in kb.rules_by_condition.items()),
+    )
+    return marshal.dumps((KB_MAGIC, KB_FORMAT_VERSION, source_hash, body))
+
+
+def deserialize_knowledge_base(data, source_hash: Optional[str] = None) -> Optional[CompiledKnowledgeBase]:
+    """marshal形式から復元（形式違い・ハッシュ不一致ならNone）
+
+    data にはbytesのほかmmapなどのバッファも渡せる。source_hash=Noneならハッシュを照合しない。
+    """
+    try:
+        magic, format_version, stored_hash, body = marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+        return None
+    if magic != KB_MAGIC or format_version != KB_FORMAT_VERSION:
+        return None
+    if source_hash is not None and stored_hash != source_hash:
+        return None
+
+    content_hash, strings, rules, goal_indices, by_action, by_condition = body
+    strings = [sys.intern(s) for s in strings]
+    rule_objs = tuple(
+        Rule(
+            conditions=[strings[c] for c in conds],
+            action=strings[action],
+            is_or_rule=is_or,
+            is_goal_action=is_goal
+        )
+        for action, conds, is_or, is_goal in rules
+    )
+    rules_by_action = {strings[k]: v for k, v in by_action}
+    rules_by_condition = {strings[k]: v for k, v in by_condition}
+    derived = frozenset(rules_by_action)
+
+    return CompiledKnowledgeBase(
+        content_hash=content_hash,
+        rules=rule_objs,
+        goal_indices=goal_indices,
+        derived_conditions=derived,
+        base_conditions=frozenset(c for c in rules_by_condition if c not in derived),
+        rules_by_action=rules_by_action,
+        rules_by_condition=rules_by_condition,
+    )
+
+
+def _write_kb_file(data: bytes):
+    """一時ファイルに書き出してからrenameで置き換える（書き込めなければ諦める）"""
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".rules.", suffix=".kb.tmp")
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, KB_FILE)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_compiled_knowledge_base() -> CompiledKnowledgeBase:
+    """rules.json に対応するコンパイル済み知識ベースを取得
+
+    rules.kb が存在し rules.json のハッシュと一致すればそれを使い、
+    なければJSONから作り直して rules.kb を書き出す。
+
+    Raises:
+        RuleLoadError: ルールファイルが存在しない、または読み込みに失敗した場合
+    """
+    source = read_rules_file_bytes()
+    source_hash = hashlib.blake2b(source, digest_size=16).hexdigest()
+
+    try:
+        with open(KB_FILE, 'rb') as f:
+            kb = deserialize_knowledge_base(f.read(), source_hash)
+        if kb is not None:
+            return kb
+    except OSError:
+        pass
+
+    kb = compile_knowledge_base(parse_rules_data(json.loads(source.decode('utf-8'))))
+    _write_kb_file(serialize_knowledge_base(kb, source_hash))
+    return kb
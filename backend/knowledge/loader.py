@@ -3,7 +3,7 @@
 """
 import os
 import json
-from typing import List
+from typing import List, Optional
 
 from core import Rule
 
@@ -18,18 +18,34 @@ class RuleLoadError(Exception):
     pass
 
 
-def load_rules_from_json() -> List[Rule]:
-    """JSONファイルからルールを読み込む
+def get_rules_file_stamp() -> Optional[tuple]:
+    """ルールファイルの (mtime_ns, size) を取得（存在しなければNone）"""
+    try:
+        st = os.stat(RULES_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def read_rules_file_bytes() -> bytes:
+    """ルールファイルの内容をバイト列で読み込む
 
     Raises:
-        RuleLoadError: ルールファイルが存在しない、または読み込みに失敗した場合
+        RuleLoadError: ルールファイルが存在しない場合
     """
     if not os.path.exists(RULES_FILE):
         raise RuleLoadError(f"ルールファイルが見つかりません: {RULES_FILE}")
 
-    with open(RULES_FILE, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    with open(RULES_FILE, 'rb') as f:
+        return f.read()
 
+
+def parse_rules_data(data: dict) -> List[Rule]:
+    """rules.json形式のdictからルールを生成
+
+    Raises:
+        RuleLoadError: 必須フィールドがない、またはルールが1件もない場合
+    """
     rules = []
     for idx, r in enumerate(data.get("rules", [])):
         if "conditions" not in r or "action" not in r:
@@ -49,6 +65,15 @@ def load_rules_from_json() -> List[Rule]:
     return rules
 
 
+def load_rules_from_json() -> List[Rule]:
+    """JSONファイルからルールを読み込む
+
+    Raises:
+        RuleLoadError: ルールファイルが存在しない、または読み込みに失敗した場合
+    """
+    return parse_rules_data(json.loads(read_rules_file_bytes().decode('utf-8')))
+
+
 def save_rules_to_json(rules_data: dict) -> None:
     """ルールをJSONファイルに保存
 
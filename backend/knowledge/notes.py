@@ -0,0 +1,153 @@
+"""
+条件補足ストア - condition_notes.json のメモリキャッシュと書き込み集約
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from types import MappingProxyType
+from typing import Dict, Iterable, Mapping, Optional
+
+from .loader import DATA_DIR
+
+
+NOTES_FILE = os.path.join(DATA_DIR, "condition_notes.json")
+
+# 書き込みを集約する待ち時間（秒）。この間の編集は1回のファイル書き込みにまとめる
+NOTES_FLUSH_DELAY = 0.5
+# 書き込みに失敗したときに再試行するまでの時間（秒）
+NOTES_RETRY_DELAY = 5.0
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_notes: Dict[str, str] = {}
+_file_stamp: Optional[tuple] = None  # (mtime_ns, size) 最後に読み書きした時点のファイル状態
+_loaded = False
+_dirty = False
+_flush_timer: Optional[threading.Timer] = None
+_version = 0
+
+
+def _stat_notes_file() -> Optional[tuple]:
+    """補足ファイルの (mtime_ns, size) を取得（存在しなければNone）"""
+    try:
+        st = os.stat(NOTES_FILE)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _refresh_if_stale():
+    """ファイルが外部で更新されていればメモリ上の補足を読み直す
+
+    未保存の編集がある間はメモリ上の内容を優先する。
+    """
+    global _notes, _file_stamp, _loaded, _version
+    if _dirty:
+        return
+    stamp = _stat_notes_file()
+    if _loaded and stamp == _file_stamp:
+        return
+
+    notes = {}
+    if stamp is not None:
+        with open(NOTES_FILE, 'r', encoding='utf-8') as f:
+            notes = json.load(f)
+
+    _notes = notes
+    _file_stamp = stamp
+    _loaded = True
+    _version += 1
+
+
+def _write_atomic(notes: Dict[str, str]):
+    """一時ファイルに書き出してからrenameで置き換える"""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, prefix=".condition_notes.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(notes, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, NOTES_FILE)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _schedule_flush(delay: float = NOTES_FLUSH_DELAY):
+    """遅延書き込みを予約（既に予約済みなら何もしない）"""
+    global _flush_timer
+    if _flush_timer is not None:
+        return
+    _flush_timer = threading.Timer(delay, flush_notes)
+    _flush_timer.daemon = True
+    _flush_timer.start()
+
+
+def get_notes() -> Mapping[str, str]:
+    """全補足を取得（読み取り専用ビュー）"""
+    with _lock:
+        _refresh_if_stale()
+        return MappingProxyType(_notes)
+
+
+def get_note(condition: str) -> str:
+    """特定の条件の補足を取得"""
+    with _lock:
+        _refresh_if_stale()
+        return _notes.get(condition, "")
+
+
+def get_notes_version() -> int:
+    """補足データのバージョン（変更のたびに増加）"""
+    with _lock:
+        _refresh_if_stale()
+        return _version
+
+
+def update_notes(updates: Mapping[str, str], deletes: Iterable[str] = ()) -> int:
+    """補足を更新・削除し、ファイルへの書き込みを予約する
+
+    Returns:
+        更新後のバージョン
+    """
+    global _notes, _dirty, _version
+    with _lock:
+        _refresh_if_stale()
+        # 読み取り中のビューに影響しないよう新しいdictに差し替える
+        notes = dict(_notes)
+        notes.update(updates)
+        for condition in deletes:
+            notes.pop(condition, None)
+        _notes = notes
+        _dirty = True
+        _version += 1
+        _schedule_flush()
+        return _version
+
+
+def flush_notes():
+    """未保存の補足をファイルに書き込む
+
+    タイマーのスレッドから呼ばれるので、書き込めなければログに出して再試行を予約する
+    （未保存の編集はメモリ上に残る）。
+    """
+    global _dirty, _file_stamp, _flush_timer
+    with _lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        if not _dirty:
+            return
+        try:
+            _write_atomic(_notes)
+        except OSError:
+            logger.exception("Failed to write %s; retrying in %gs", NOTES_FILE, NOTES_RETRY_DELAY)
+            _schedule_flush(NOTES_RETRY_DELAY)
+            return
+        _file_stamp = _stat_notes_file()
+        _dirty = False
@@ -0,0 +1,137 @@
+"""
+ワーカー間共有の知識ベース - メモリマップしたスナップショットファイル
+
+環境変数 KB_SHARED_DIR を指定すると有効になる（uvicorn --workers を複数にする場合向け）。
+
+- kb.header: 全ワーカーがmmapする固定長ヘッダー（世代番号など）
+- kb.<世代>.seg: コンパイル済み知識ベースの本体（marshal形式、読み取り専用でmmapする）
+
+ルールを編集したワーカーが新しい世代の本体を書き出してヘッダーを更新し、
+他のワーカーはmmap上の世代番号の変化を見て本体を読み替える（JSONの解析はしない）。
+"""
+import mmap
+import os
+import struct
+import tempfile
+from typing import Optional, Tuple
+
+from .compiled import CompiledKnowledgeBase, serialize_knowledge_base, deserialize_knowledge_base
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+KB_SHARED_DIR = os.environ.get("KB_SHARED_DIR")
+
+# magic, 世代番号, 本体のバイト数, 内容ハッシュ
+_HEADER = struct.Struct("<8sQQ32s")
+_HEADER_MAGIC = b"VISAKB01"
+
+# 古い世代の本体を残しておく数（切り替え中のワーカーが読み終えられるように）
+_KEEP_SEGMENTS = 2
+
+
+def is_enabled() -> bool:
+    return bool(KB_SHARED_DIR)
+
+
+def _header_path() -> str:
+    return os.path.join(KB_SHARED_DIR, "kb.header")
+
+
+def _segment_path(generation: int) -> str:
+    return os.path.join(KB_SHARED_DIR, f"kb.{generation}.seg")
+
+
+class SharedKnowledgeBase:
+    """共有スナップショットの読み書き"""
+
+    def __init__(self):
+        os.makedirs(KB_SHARED_DIR, exist_ok=True)
+        path = _header_path()
+        # ヘッダーファイルがなければゼロ埋めで作る（O_EXCLで他ワーカーとの競合を避ける）
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, b"\0" * _HEADER.size)
+            os.close(fd)
+        except FileExistsError:
+            pass
+
+        self._header_file = open(path, "r+b")
+        self._header = mmap.mmap(self._header_file.fileno(), _HEADER.size)
+        self.generation = 0
+
+    def read_header(self) -> Tuple[int, int, str]:
+        """(世代番号, 本体のバイト数, 内容ハッシュ) を取得（未公開なら世代0）"""
+        magic, generation, length, content_hash = _HEADER.unpack_from(self._header, 0)
+        if magic != _HEADER_MAGIC:
+            return 0, 0, ""
+        return generation, length, content_hash.rstrip(b"\0").decode("ascii")
+
+    def has_update(self) -> bool:
+        """自分が読み込んだ世代より新しいスナップショットがあるか"""
+        return self.read_header()[0] > self.generation
+
+    def load(self) -> Optional[CompiledKnowledgeBase]:
+        """最新のスナップショットをmmapして読み込む（未公開・読み込み失敗ならNone）"""
+        generation, length, _ = self.read_header()
+        if generation == 0:
+            return None
+        try:
+            with open(_segment_path(generation), "rb") as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            view = memoryview(segment)
+            try:
+                kb = deserialize_knowledge_base(view[:length])
+            finally:
+                view.release()
+        finally:
+            segment.close()
+
+        if kb is not None:
+            self.generation = generation
+        return kb
+
+    def publish(self, kb: CompiledKnowledgeBase) -> int:
+        """新しい世代としてスナップショットを公開
+
+        公開済みの最新世代と内容が同じなら書き出さず、その世代に合わせる。
+
+        Returns:
+            公開した（または合わせた）世代番号
+        """
+        if fcntl is not None:
+            fcntl.flock(self._header_file.fileno(), fcntl.LOCK_EX)
+        try:
+            current, _, current_hash = self.read_header()
+            if current and current_hash == kb.content_hash:
+                self.generation = current
+                return current
+
+            generation = current + 1
+            data = serialize_knowledge_base(kb, kb.content_hash)
+
+            fd, tmp_path = tempfile.mkstemp(dir=KB_SHARED_DIR, prefix=".kb.", suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, _segment_path(generation))
+
+            # 本体を置いてからヘッダーを書き換える
+            _HEADER.pack_into(
+                self._header, 0, _HEADER_MAGIC, generation, len(data), kb.content_hash.encode("ascii")
+            )
+            self._header.flush()
+            self.generation = generation
+
+            stale = _segment_path(generation - _KEEP_SEGMENTS)
+            if os.path.exists(stale):
+                os.remove(stale)
+            return generation
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self._header_file.fileno(), fcntl.LOCK_UN)
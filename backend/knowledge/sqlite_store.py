@@ -0,0 +1,308 @@
+"""
+SQLiteルールストア - ルール単位のトランザクション更新
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+from typing import List, Optional
+
+from core import Rule
+from .loader import DATA_DIR, RULES_FILE, RuleLoadError
+
+
+RULES_DB_FILE = os.environ.get("RULES_DB_FILE", os.path.join(DATA_DIR, "rules.db"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rules (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    position INTEGER NOT NULL,
+    action TEXT NOT NULL,
+    is_or_rule INTEGER NOT NULL DEFAULT 0,
+    is_goal_action INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_rules_position ON rules(position);
+CREATE INDEX IF NOT EXISTS idx_rules_action ON rules(action);
+
+CREATE TABLE IF NOT EXISTS rule_conditions (
+    rule_id INTEGER NOT NULL REFERENCES rules(id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    condition TEXT NOT NULL,
+    PRIMARY KEY (rule_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_rule_conditions_condition ON rule_conditions(condition);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+"""
+
+
+class SQLiteRuleStore:
+    """SQLiteによるルールストア
+
+    ルールは position（0始まりの連番）で rules.json と同じ順序を保持する。
+    書き込みは1ルール単位のトランザクションで行い、そのたびに version を増やす。
+    """
+
+    def __init__(self, path: str = RULES_DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA foreign_keys = ON")
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.executescript(_SCHEMA)
+
+    # ========== 内部ヘルパー ==========
+
+    def _begin(self):
+        # 他プロセスの書き込みと競合しないよう最初に書き込みロックを取る
+        self._conn.execute("BEGIN IMMEDIATE")
+
+    def _bump_version(self) -> int:
+        self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def _count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM rules").fetchone()[0]
+
+    def _rule_id_at(self, index: int) -> int:
+        row = self._conn.execute("SELECT id FROM rules WHERE position = ?", (index,)).fetchone()
+        if row is None:
+            raise IndexError(f"rule index out of range: {index}")
+        return row[0]
+
+    def _insert_row(self, position: int, rule_dict: dict):
+        cur = self._conn.execute(
+            "INSERT INTO rules (position, action, is_or_rule, is_goal_action) VALUES (?, ?, ?, ?)",
+            (position, rule_dict["action"],
+             int(rule_dict.get("is_or_rule", False)), int(rule_dict.get("is_goal_action", False)))
+        )
+        self._insert_conditions(cur.lastrowid, rule_dict["conditions"])
+
+    def _insert_conditions(self, rule_id: int, conditions: List[str]):
+        self._conn.executemany(
+            "INSERT INTO rule_conditions (rule_id, seq, condition) VALUES (?, ?, ?)",
+            [(rule_id, seq, cond) for seq, cond in enumerate(conditions)]
+        )
+
+    def _select_rules(self, where: str = "", params: tuple = ()) -> List[Rule]:
+        rows = self._conn.execute(
+            f"SELECT id, action, is_or_rule, is_goal_action FROM rules {where} ORDER BY position",
+            params
+        ).fetchall()
+        if not rows:
+            return []
+
+        conditions = {row[0]: [] for row in rows}
+        if where:
+            placeholders = ",".join("?" * len(rows))
+            cond_rows = self._conn.execute(
+                f"SELECT rule_id, condition FROM rule_conditions WHERE rule_id IN ({placeholders}) "
+                "ORDER BY rule_id, seq",
+                tuple(conditions)
+            )
+        else:
+            cond_rows = self._conn.execute(
+                "SELECT rule_id, condition FROM rule_conditions ORDER BY rule_id, seq"
+            )
+        for rule_id, cond in cond_rows:
+            conditions[rule_id].append(cond)
+
+        return [
+            Rule(
+                conditions=conditions[rule_id],
+                action=action,
+                is_or_rule=bool(is_or),
+                is_goal_action=bool(is_goal)
+            )
+            for rule_id, action, is_or, is_goal in rows
+        ]
+
+    def _run_write(self, func, *args):
+        """書き込み処理を1トランザクションで実行し、(結果, version) を返す"""
+        with self._lock:
+            self._begin()
+            try:
+                result = func(*args)
+                version = self._bump_version()
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return result, version
+
+    # ========== 読み込み ==========
+
+    def get_version(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._count() == 0
+
+    def load_rules(self) -> List[Rule]:
+        """全ルールをposition順に取得"""
+        with self._lock:
+            return self._select_rules()
+
+    def find_by_action(self, action: str) -> List[Rule]:
+        """actionでルールを検索（インデックス使用）"""
+        with self._lock:
+            return self._select_rules("WHERE action = ?", (action,))
+
+    def find_by_condition(self, condition: str) -> List[Rule]:
+        """条件に指定の文言を含むルールを検索（インデックス使用）"""
+        with self._lock:
+            return self._select_rules(
+                "WHERE id IN (SELECT rule_id FROM rule_conditions WHERE condition = ?)",
+                (condition,)
+            )
+
+    def export_rules_data(self) -> dict:
+        """rules.json と同じ形式のdictを出力"""
+        return {
+            "rules": [
+                {
+                    "conditions": r.conditions,
+                    "action": r.action,
+                    "is_or_rule": r.is_or_rule,
+                    "is_goal_action": r.is_goal_action
+                }
+                for r in self.load_rules()
+            ]
+        }
+
+    # ========== 書き込み ==========
+
+    def replace_all(self, rules_data: dict) -> int:
+        """全ルールを置き換える（rules.json形式のdictを受け取る）
+
+        Returns:
+            更新後のversion
+        """
+        def _replace():
+            self._conn.execute("DELETE FROM rules")
+            for position, rule_dict in enumerate(rules_data.get("rules", [])):
+                if "conditions" not in rule_dict or "action" not in rule_dict:
+                    raise RuleLoadError(f"ルール {position+1} に必須フィールドがありません")
+                self._insert_row(position, rule_dict)
+
+        return self._run_write(_replace)[1]
+
+    def insert_rule(self, index: Optional[int], rule_dict: dict) -> tuple:
+        """ルールを挿入（None=末尾）
+
+        Returns:
+            (実際の挿入位置, version)
+        """
+        def _insert():
+            count = self._count()
+            position = count if index is None else max(0, min(index, count))
+            self._conn.execute(
+                "UPDATE rules SET position = position + 1 WHERE position >= ?", (position,)
+            )
+            self._insert_row(position, rule_dict)
+            return position
+
+        return self._run_write(_insert)
+
+    def update_rule(self, index: int, rule_dict: dict) -> int:
+        """指定位置のルールを更新
+
+        Raises:
+            IndexError: 指定位置にルールがない場合
+        """
+        def _update():
+            rule_id = self._rule_id_at(index)
+            self._conn.execute(
+                "UPDATE rules SET action = ?, is_or_rule = ?, is_goal_action = ? WHERE id = ?",
+                (rule_dict["action"], int(rule_dict.get("is_or_rule", False)),
+                 int(rule_dict.get("is_goal_action", False)), rule_id)
+            )
+            self._conn.execute("DELETE FROM rule_conditions WHERE rule_id = ?", (rule_id,))
+            self._insert_conditions(rule_id, rule_dict["conditions"])
+
+        return self._run_write(_update)[1]
+
+    def delete_rule(self, index: int) -> tuple:
+        """指定位置のルールを削除
+
+        Returns:
+            (削除したaction, version)
+
+        Raises:
+            IndexError: 指定位置にルールがない場合
+        """
+        def _delete():
+            rule_id = self._rule_id_at(index)
+            action = self._conn.execute(
+                "SELECT action FROM rules WHERE id = ?", (rule_id,)
+            ).fetchone()[0]
+            self._conn.execute("DELETE FROM rules WHERE id = ?", (rule_id,))
+            self._conn.execute(
+                "UPDATE rules SET position = position - 1 WHERE position > ?", (index,)
+            )
+            return action
+
+        return self._run_write(_delete)
+
+    def reorder(self, actions: List[str]) -> int:
+        """指定したaction順に並べ替える（指定外のルールは元の順で末尾へ）
+
+        Returns:
+            更新後のversion
+        """
+        def _reorder():
+            rows = self._conn.execute("SELECT id, action FROM rules ORDER BY position").fetchall()
+            remaining = {}
+            for rule_id, action in rows:
+                remaining.setdefault(action, rule_id)
+
+            ordered_ids = []
+            for action in actions:
+                if action in remaining:
+                    ordered_ids.append(remaining.pop(action))
+            picked = set(ordered_ids)
+            ordered_ids.extend(rule_id for rule_id, _ in rows if rule_id not in picked)
+
+            self._conn.executemany(
+                "UPDATE rules SET position = ? WHERE id = ?",
+                [(position, rule_id) for position, rule_id in enumerate(ordered_ids)]
+            )
+
+        return self._run_write(_reorder)[1]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def import_json_file(store: SQLiteRuleStore, path: str = RULES_FILE) -> int:
+    """rules.json をSQLiteストアに取り込む"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return store.replace_all(json.load(f))
+
+
+def export_json_file(store: SQLiteRuleStore, path: str = RULES_FILE) -> None:
+    """SQLiteストアの内容を rules.json 形式で書き出す"""
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(store.export_rules_data(), f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    # 使い方: python -m knowledge.sqlite_store import|export [rules.json]
+    if len(sys.argv) < 2 or sys.argv[1] not in ("import", "export"):
+        print("usage: python -m knowledge.sqlite_store import|export [rules.json]")
+        sys.exit(1)
+    json_path = sys.argv[2] if len(sys.argv) > 2 else RULES_FILE
+    db = SQLiteRuleStore()
+    if sys.argv[1] == "import":
+        print(f"imported: version={import_json_file(db, json_path)}")
+    else:
+        export_json_file(db, json_path)
+        print(f"exported: {json_path}")
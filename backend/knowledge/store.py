@@ -1,14 +1,62 @@
 """
 ルールストア - ルールの保存・取得機能
+
+RULE_STORE=sqlite を指定すると、rules.json の代わりにSQLiteストアを使用する。
+KB_SHARED_DIR を指定すると、コンパイル済み知識ベースをワーカー間で共有する（knowledge/shared.py）。
 """
-from typing import List
+import os
+import threading
+from typing import List, Optional, Tuple
 
 from core import Rule
-from .loader import load_rules_from_json, save_rules_to_json
+from .loader import save_rules_to_json, get_rules_file_stamp
+from .compiled import CompiledKnowledgeBase, compile_knowledge_base, load_compiled_knowledge_base
+from .versions import rulebase_versions
+from . import shared
+
+
+# ストアのバックエンド（"json" または "sqlite"）
+RULE_STORE_BACKEND = os.environ.get("RULE_STORE", "json").lower()
+
+_sqlite_store = None
+if RULE_STORE_BACKEND == "sqlite":
+    from .sqlite_store import SQLiteRuleStore, import_json_file
+
+    _sqlite_store = SQLiteRuleStore()
+    if _sqlite_store.is_empty():
+        # 初回起動時は rules.json から取り込む
+        import_json_file(_sqlite_store)
 
 
+def _load_knowledge_base() -> CompiledKnowledgeBase:
+    if _sqlite_store is not None:
+        return compile_knowledge_base(_sqlite_store.load_rules())
+    return load_compiled_knowledge_base()
+
+
+# コンパイル済み知識ベース（RULESと常に同じ内容）
+_knowledge_base: CompiledKnowledgeBase = _load_knowledge_base()
+
 # グローバルルールストア（初回アクセス時にロード）
-RULES: List[Rule] = load_rules_from_json()
+RULES: List[Rule] = list(_knowledge_base.rules)
+
+# ストア側のバージョン（SQLiteモードのみ。他プロセスの更新検出に使う）
+_source_version = _sqlite_store.get_version() if _sqlite_store is not None else None
+
+# ルールのバージョン（RULESが変わるたびに増加。共有モードでは共有スナップショットの世代番号）
+_rules_version = 1
+
+_shared_kb = None
+if shared.is_enabled():
+    _shared_kb = shared.SharedKnowledgeBase()
+    # 他のワーカーが公開済みの内容と同じなら、その世代に合わせる
+    _rules_version = _shared_kb.publish(_knowledge_base)
+
+# 最後に読み込んだ時点の rules.json の状態（JSONモードのみ）
+_rules_file_stamp = get_rules_file_stamp() if _sqlite_store is None else None
+
+# 編集処理の排他制御（読み込み→変更→保存の間に他の編集が割り込まないようにする）
+_edit_lock = threading.RLock()
 
 
 def get_all_rules() -> List[Rule]:
@@ -16,47 +64,275 @@ def get_all_rules() -> List[Rule]:
     return RULES.copy()
 
 
+def get_knowledge_base() -> CompiledKnowledgeBase:
+    """現在のコンパイル済み知識ベースを取得"""
+    return _knowledge_base
+
+
 def get_goal_rules() -> List[Rule]:
     """ゴールルール（最終結論を導くルール）を取得（rules.json順）"""
-    return [r for r in RULES if r.is_goal_action]
+    return list(_knowledge_base.goal_rules)
 
 
 def get_all_base_conditions() -> set:
     """全ての基本条件（他のルールの結論ではないもの）を取得"""
-    all_conditions = set()
-    all_actions = {r.action for r in RULES}
-
-    for rule in RULES:
-        for cond in rule.conditions:
-            if cond not in all_actions:
-                all_conditions.add(cond)
-
-    return all_conditions
+    return set(_knowledge_base.base_conditions)
 
 
 def get_derived_conditions() -> set:
     """導出可能な条件（他のルールの結論であるもの）を取得"""
-    return {r.action for r in RULES}
+    return set(_knowledge_base.derived_conditions)
+
 
+def get_rules_version() -> int:
+    """ルールのバージョンを取得"""
+    return _rules_version
 
-def reload_rules() -> List[Rule]:
+
+def _replace_rules(
+    new_rules: List[Rule],
+    source_version: Optional[int] = None,
+    knowledge_base: Optional[CompiledKnowledgeBase] = None,
+    publish: bool = True
+):
+    """RULESをin-place更新し、知識ベースを作り直してバージョンを進める
+
+    共有モードでは新しい知識ベースを他のワーカーに公開する（publish=False なら公開しない）。
+    """
+    global _rules_version, _knowledge_base, _source_version
+    # 使用中の版と同じ内容なら、その版を使い回す
+    _knowledge_base = rulebase_versions.intern(knowledge_base or compile_knowledge_base(new_rules))
+    RULES[:] = _knowledge_base.rules
+    if source_version is not None:
+        _source_version = source_version
+
+    if _shared_kb is not None:
+        if publish:
+            _shared_kb.publish(_knowledge_base)
+        _rules_version = _shared_kb.generation
+    else:
+        _rules_version += 1
+
+
+def _sync_shared_snapshot() -> bool:
+    """他のワーカーが公開した新しいスナップショットがあれば切り替える"""
+    global _rules_file_stamp, _source_version
+    if _shared_kb is None or not _shared_kb.has_update():
+        return False
+    kb = _shared_kb.load()
+    if kb is None:
+        return False
+    _replace_rules(list(kb.rules), knowledge_base=kb, publish=False)
+    # 公開元がストアに書き込んだ内容と同じなので、ストアからは読み直さない
+    if _sqlite_store is not None:
+        _source_version = _sqlite_store.get_version()
+    else:
+        _rules_file_stamp = get_rules_file_stamp()
+    return True
+
+
+def reload_rules(force: bool = False) -> List[Rule]:
     """ルールを再読み込み（編集後に呼び出す）
 
+    rules.json が前回の読み込みから変わっていなければ何もしない（force=Trueで常に再読み込み）。
+
     注意: リストをin-place更新することで、
     他モジュールからimportされた参照も最新データを指すようになる
     """
-    global RULES
-    new_rules = load_rules_from_json()
-    RULES.clear()
-    RULES.extend(new_rules)
-    return RULES
+    global _rules_file_stamp
+    with _edit_lock:
+        if not force and _sync_shared_snapshot():
+            return RULES
+
+        if _sqlite_store is not None:
+            # 他プロセスが更新していなければ読み直さない
+            version = _sqlite_store.get_version()
+            if force or version != _source_version:
+                _replace_rules(_sqlite_store.load_rules(), version)
+            return RULES
+
+        stamp = get_rules_file_stamp()
+        if force or stamp is None or stamp != _rules_file_stamp:
+            kb = load_compiled_knowledge_base()
+            _replace_rules(list(kb.rules), knowledge_base=kb)
+            _rules_file_stamp = stamp
+        return RULES
 
 
 def save_rules(rules_data: dict) -> None:
-    """ルールをJSONファイルに保存
+    """ルールを保存（全件置き換え）
 
     Raises:
         例外が発生した場合はそのまま伝播
     """
-    save_rules_to_json(rules_data)
-    reload_rules()
+    with _edit_lock:
+        if _sqlite_store is not None:
+            _sqlite_store.replace_all(rules_data)
+        else:
+            save_rules_to_json(rules_data)
+        reload_rules(force=True)
+
+
+def _rule_from_dict(rule_dict: dict) -> Rule:
+    return Rule(
+        conditions=list(rule_dict["conditions"]),
+        action=rule_dict["action"],
+        is_or_rule=rule_dict.get("is_or_rule", False),
+        is_goal_action=rule_dict.get("is_goal_action", False)
+    )
+
+
+def _build_rules_data(rules: List[Rule]) -> dict:
+    return {
+        "rules": [
+            {
+                "conditions": r.conditions,
+                "action": r.action,
+                "is_or_rule": r.is_or_rule,
+                "is_goal_action": r.is_goal_action
+            }
+            for r in rules
+        ]
+    }
+
+
+def _save_json_rules(rules: List[Rule]):
+    save_rules_to_json(_build_rules_data(rules))
+    reload_rules(force=True)
+
+
+def _apply_sqlite_edit(new_rules: List[Rule], version: int) -> bool:
+    """SQLiteへの1件編集の結果をRULESに反映
+
+    他プロセスの編集が間に入っていた場合はストアから読み直してFalseを返す。
+    """
+    if version == _source_version + 1:
+        _replace_rules(new_rules, version)
+        return True
+    _replace_rules(_sqlite_store.load_rules(), version)
+    return False
+
+
+def insert_rule(index: Optional[int], rule_dict: dict) -> Tuple[int, Optional[CompiledKnowledgeBase]]:
+    """ルールを1件挿入（None=末尾）
+
+    Returns:
+        (実際の挿入位置, 編集前の知識ベース)
+        編集前の知識ベースは、他のワーカーの編集を読み直した後の、実際に編集した版。
+        編集と同時に他のプロセスがSQLiteストアを編集していた場合はNone（編集前の版が分からない）。
+    """
+    with _edit_lock:
+        reload_rules()
+        before = _knowledge_base
+        if _sqlite_store is not None:
+            position, version = _sqlite_store.insert_rule(index, rule_dict)
+            new_rules = RULES.copy()
+            new_rules.insert(position, _rule_from_dict(rule_dict))
+            if not _apply_sqlite_edit(new_rules, version):
+                before = None
+            return position, before
+
+        position = len(RULES) if index is None else max(0, min(index, len(RULES)))
+        new_rules = RULES.copy()
+        new_rules.insert(position, _rule_from_dict(rule_dict))
+        _save_json_rules(new_rules)
+        return position, before
+
+
+def update_rule(index: int, rule_dict: dict) -> Tuple[str, Optional[CompiledKnowledgeBase]]:
+    """指定位置のルールを1件更新
+
+    Returns:
+        (更新前のルールのaction, 編集前の知識ベース（insert_rule と同じ）)
+
+    Raises:
+        IndexError: 指定位置にルールがない場合
+    """
+    with _edit_lock:
+        reload_rules()
+        before = _knowledge_base
+        if index < 0 or index >= len(RULES):
+            raise IndexError(f"rule index out of range: {index}")
+
+        new_rules = RULES.copy()
+        previous = new_rules[index]
+        new_rules[index] = _rule_from_dict(rule_dict)
+        if _sqlite_store is not None:
+            version = _sqlite_store.update_rule(index, rule_dict)
+            if not _apply_sqlite_edit(new_rules, version):
+                before = None
+        else:
+            _save_json_rules(new_rules)
+        return previous.action, before
+
+
+def delete_rule(index: int) -> Tuple[str, Optional[CompiledKnowledgeBase]]:
+    """指定位置のルールを1件削除
+
+    Returns:
+        (削除したルールのaction, 編集前の知識ベース（insert_rule と同じ）)
+
+    Raises:
+        IndexError: 指定位置にルールがない場合
+    """
+    with _edit_lock:
+        reload_rules()
+        before = _knowledge_base
+        if index < 0 or index >= len(RULES):
+            raise IndexError(f"rule index out of range: {index}")
+
+        new_rules = RULES.copy()
+        deleted = new_rules.pop(index)
+        if _sqlite_store is not None:
+            _, version = _sqlite_store.delete_rule(index)
+            if not _apply_sqlite_edit(new_rules, version):
+                before = None
+        else:
+            _save_json_rules(new_rules)
+        return deleted.action, before
+
+
+def reorder_rules(actions: List[str]) -> int:
+    """指定したaction順に並べ替える（指定外のルールは元の順で末尾へ）
+
+    Returns:
+        並べ替え後のルール数
+    """
+    with _edit_lock:
+        reload_rules()
+        rules_map = {r.action: r for r in RULES}
+
+        reordered = []
+        for action in actions:
+            if action in rules_map:
+                reordered.append(rules_map.pop(action))
+        reordered.extend(rules_map.values())
+
+        if _sqlite_store is not None:
+            version = _sqlite_store.reorder(actions)
+            _replace_rules(_sqlite_store.load_rules(), version)
+        else:
+            _save_json_rules(reordered)
+        return len(reordered)
+
+
+def find_rules_by_action(action: str) -> List[Rule]:
+    """actionでルールを検索"""
+    if _sqlite_store is not None:
+        return _sqlite_store.find_by_action(action)
+    return _knowledge_base.deriving_rules(action)
+
+
+def find_rules_by_condition(condition: str) -> List[Rule]:
+    """指定の条件を含むルールを検索"""
+    if _sqlite_store is not None:
+        return _sqlite_store.find_by_condition(condition)
+    kb = _knowledge_base
+    return [kb.rules[i] for i in kb.rules_by_condition.get(condition, ())]
+
+
+def export_rules_data() -> dict:
+    """rules.json と同じ形式のdictを取得"""
+    if _sqlite_store is not None:
+        return _sqlite_store.export_rules_data()
+    return _build_rules_data(RULES)
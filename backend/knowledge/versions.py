@@ -0,0 +1,67 @@
+"""
+知識ベースの版管理 - 診断中のセッションが使っている版を参照カウントで保持する
+
+セッションは開始時の知識ベース（不変）を最後まで使う。ルールを編集しても
+使用中の版はここに残り、使うセッションがなくなった時点で手放す。
+編集を元に戻した場合などは、同じ内容の使用中の版をそのまま使い回す。
+"""
+import threading
+from typing import Any, Dict, List, Optional
+
+from .compiled import CompiledKnowledgeBase
+
+
+class RulebaseVersions:
+    """使用中の知識ベース（内容ハッシュ -> [知識ベース, 参照数]）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, List[Any]] = {}
+
+    def pin(self, kb: CompiledKnowledgeBase):
+        """セッションが使い始めた版を登録"""
+        with self._lock:
+            entry = self._entries.get(kb.content_hash)
+            if entry is None:
+                self._entries[kb.content_hash] = [kb, 1]
+            else:
+                entry[1] += 1
+
+    def release(self, kb: CompiledKnowledgeBase):
+        """セッションが使い終わった版を解放（参照がなくなれば手放す）"""
+        with self._lock:
+            entry = self._entries.get(kb.content_hash)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._entries[kb.content_hash]
+
+    def intern(self, kb: CompiledKnowledgeBase) -> CompiledKnowledgeBase:
+        """同じ内容の版が使用中ならそちらを返す（索引・BDD・プールを共有できる）"""
+        with self._lock:
+            entry = self._entries.get(kb.content_hash)
+        return entry[0] if entry is not None else kb
+
+    def find(self, content_hash: str) -> Optional[CompiledKnowledgeBase]:
+        """使用中の版を内容ハッシュで探す"""
+        with self._lock:
+            entry = self._entries.get(content_hash)
+        return entry[0] if entry is not None else None
+
+    def stats(self, current: CompiledKnowledgeBase) -> List[Dict[str, Any]]:
+        """使用中の版の一覧"""
+        with self._lock:
+            entries = list(self._entries.values())
+        return [
+            {
+                "content_hash": kb.content_hash,
+                "rule_count": len(kb.rules),
+                "sessions": count,
+                "is_current": kb is current,
+            }
+            for kb, count in entries
+        ]
+
+
+rulebase_versions = RulebaseVersions()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ビザ選定エキスパートシステム 負荷テストスクリプト
+
+模擬利用者の診断（開始→回答の繰り返し→終了）を指定した並行数で実行し、
+スループット・エンドポイントごとのレイテンシ（パーセンタイル）・エラー率・
+セッションのメモリ増加量を表示します。回答は test_scenarios.py と同じ重み付きランダムです。
+
+使い方:
+  python load_test.py [オプション]
+
+  例:
+    python load_test.py                          # プロセス内（ASGI）で100診断、並行数10
+    python load_test.py -n 500 -c 50 --memory    # メモリ増加量も計測
+    python load_test.py --url http://localhost:8000
+
+--url を省略するとサーバーを起動せずにアプリを直接呼び出します（httpx が必要です）。
+--memory はプロセス内のみ有効です（tracemalloc を使うため計測中は遅くなります）。
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import tracemalloc
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+import httpx
+
+# 回答の選択肢と重み（yes:no:unknown = 3:3:4、test_scenarios.py と同じ）
+ANSWERS = ["yes", "no", "unknown"]
+ANSWER_WEIGHTS = [3, 3, 4]
+
+MAX_QUESTIONS = 50  # 無限ループ防止
+
+
+class LoadStats:
+    """エンドポイントごとのレイテンシとエラー数"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.completed = 0
+        self.failed = 0
+
+    async def call(self, client: httpx.AsyncClient, method: str, path: str, name: str, **kwargs):
+        """リクエストを送り、所要時間とエラーを記録（失敗時はNone）"""
+        start = time.perf_counter()
+        try:
+            resp = await client.request(method, path, **kwargs)
+        except httpx.HTTPError:
+            self.latencies[name].append(time.perf_counter() - start)
+            self.errors[name] += 1
+            return None
+        self.latencies[name].append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            self.errors[name] += 1
+            return None
+        return resp.json()
+
+
+async def run_consultation(client: httpx.AsyncClient, stats: LoadStats, rng: random.Random, end_session: bool):
+    """1回分の診断を実行"""
+    session_id = str(uuid.uuid4())
+    data = await stats.call(client, "POST", "/api/consultation/start", "start", json={"session_id": session_id})
+    if data is None:
+        stats.failed += 1
+        return
+
+    question_count = 0
+    while data.get("current_question") and not data.get("is_complete") and question_count < MAX_QUESTIONS:
+        question_count += 1
+        answer = rng.choices(ANSWERS, weights=ANSWER_WEIGHTS, k=1)[0]
+        data = await stats.call(
+            client, "POST", "/api/consultation/answer", "answer",
+            json={"session_id": session_id, "answer": answer}
+        )
+        if data is None:
+            stats.failed += 1
+            return
+
+    if end_session:
+        await stats.call(client, "DELETE", f"/api/consultation/session/{session_id}", "end")
+    stats.completed += 1
+
+
+async def run_load(client: httpx.AsyncClient, stats: LoadStats, total: int, concurrency: int,
+                   seed: int, end_session: bool):
+    """total回の診断を最大concurrency並行で実行"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def worker(i: int):
+        async with semaphore:
+            await run_consultation(client, stats, random.Random(seed + i), end_session)
+
+    await asyncio.gather(*(worker(i) for i in range(total)))
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def print_report(stats: LoadStats, elapsed: float, memory: Dict[str, float]):
+    total_requests = sum(len(v) for v in stats.latencies.values())
+    total_errors = sum(stats.errors.values())
+
+    print("=" * 72)
+    print("負荷テスト結果")
+    print("=" * 72)
+    print(f"  診断: 完了 {stats.completed}, 失敗 {stats.failed}, 所要時間 {elapsed:.2f}秒")
+    print(f"  スループット: {stats.completed / elapsed:.1f} 診断/秒, {total_requests / elapsed:.1f} リクエスト/秒")
+    error_rate = total_errors / total_requests * 100 if total_requests else 0.0
+    print(f"  エラー: {total_errors}/{total_requests} ({error_rate:.2f}%)")
+
+    print("\n--- エンドポイント別レイテンシ (ms) ---")
+    print(f"  {'endpoint':<10}{'count':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}{'errors':>8}")
+    for name, values in stats.latencies.items():
+        values = sorted(values)
+        print(
+            f"  {name:<10}{len(values):>8}"
+            f"{percentile(values, 50) * 1000:>9.2f}{percentile(values, 90) * 1000:>9.2f}"
+            f"{percentile(values, 99) * 1000:>9.2f}{values[-1] * 1000:>9.2f}"
+            f"{stats.errors.get(name, 0):>8}"
+        )
+
+    if memory:
+        print("\n--- メモリ ---")
+        print(f"  残っているセッション数: {memory['sessions']}")
+        print(f"  増加量: {memory['growth'] / 1024:.1f} KiB（ピーク {memory['peak'] / 1024:.1f} KiB）")
+        if memory["sessions"]:
+            print(f"  1セッションあたり: {memory['growth'] / memory['sessions'] / 1024:.1f} KiB")
+
+
+async def main_async(args):
+    stats = LoadStats()
+    memory: Dict[str, float] = {}
+
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        sessions = None
+    else:
+        from main import app
+        from routes.consultation import sessions
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app), base_url="http://loadtest", timeout=args.timeout
+        )
+
+    async with client:
+        # 知識ベースの読み込みやエンジンプールの準備を計測から外す
+        await run_consultation(client, LoadStats(), random.Random(args.seed), end_session=True)
+
+        if args.memory and sessions is not None:
+            tracemalloc.start()
+            baseline = tracemalloc.get_traced_memory()[0]
+            sessions_before = len(sessions)
+
+        start = time.perf_counter()
+        await run_load(client, stats, args.sessions, args.concurrency, args.seed, args.end_session)
+        elapsed = time.perf_counter() - start
+
+        if args.memory and sessions is not None:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            memory = {
+                "sessions": len(sessions) - sessions_before,
+                "growth": current - baseline,
+                "peak": peak - baseline,
+            }
+
+    print_report(stats, elapsed, memory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="診断APIの負荷テスト")
+    parser.add_argument("--url", help="対象サーバー（省略時はプロセス内でアプリを直接呼び出す）")
+    parser.add_argument("-n", "--sessions", type=int, default=100, help="診断の回数（デフォルト100）")
+    parser.add_argument("-c", "--concurrency", type=int, default=10, help="並行数（デフォルト10）")
+    parser.add_argument("--seed", type=int, default=0, help="回答のランダムシード")
+    parser.add_argument("--timeout", type=float, default=30.0, help="リクエストのタイムアウト秒")
+    parser.add_argument("--memory", action="store_true", help="セッションのメモリ増加量を計測（プロセス内のみ）")
+    parser.add_argument("--end-session", action="store_true", help="診断ごとにセッションを終了する")
+    args = parser.parse_args()
+
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,9 @@ from fastapi.middleware.cors import CORSMiddleware
 from routes.consultation import router as consultation_router
 from routes.rules import router as rules_router
 from routes.conditions import router as conditions_router
+from routes.admin import router as admin_router
+from knowledge import flush_notes
+from services.event_log import event_log
 
 app = FastAPI(
     title="ビザ選定エキスパートシステム",
@@ -27,6 +30,15 @@ app.add_middleware(
 app.include_router(consultation_router)
 app.include_router(rules_router)
 app.include_router(conditions_router)
+app.include_router(admin_router)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # 書き込み待ちの補足を保存
+    flush_notes()
+    # キューに残っている診断イベントを書き出す
+    event_log.close()
 
 
 @app.get("/")
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ビザ選定エキスパートシステム 記録・再生による性能比較ツール
+
+診断イベントログ（services/event_log.py）に記録された実際の回答の並びを取り出し、
+任意のルール（rules.json）と現在のエンジンでサーバーなしに再生します。
+ステップごとのレイテンシ・不動点計算の反復回数・質問の並び・診断結果を保存し、
+基準の結果と比較した差分を表示します。
+
+使い方:
+  python replay.py extract [-o sequences.json] [--events DIR]
+  python replay.py run sequences.json [-o result.json] [--rules rules.json] [--repeat 5]
+                       [--baseline baseline.json] [--threshold 1.2]
+  python replay.py compare baseline.json result.json [--threshold 1.2]
+
+  例:
+    python replay.py extract -o sequences.json
+    python replay.py run sequences.json -o baseline.json               # 変更前に基準を作る
+    python replay.py run sequences.json --rules new_rules.json --baseline baseline.json
+
+「戻る」は回答の並びから取り消し、最終的に有効だった回答だけを再生します。
+再生中に記録にない質問が出た場合（ルールが変わった場合など）は、そこで打ち切ります。
+比較で質問の並び・診断結果が変わったセッションがあるか、レイテンシが閾値を超えて
+遅くなった場合は終了コード1を返します。
+"""
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from engine import InferenceEngine
+from knowledge import compile_knowledge_base, get_knowledge_base
+from knowledge.loader import parse_rules_data
+from services.event_log import EVENT_LOG_DIR, EVENT_LOG_FILE
+
+MAX_QUESTIONS = 50  # 無限ループ防止
+MIN_SLOWDOWN_SECONDS = 0.001  # セッション単位で遅くなったとみなす最小の差（短いセッションの揺らぎを除く）
+
+
+# ========== 記録の取り出し ==========
+
+def iter_event_files(directory: str) -> List[str]:
+    """ローテーション済みのファイル（古い順）と現在のファイル"""
+    if not os.path.isdir(directory):
+        return []
+    base, ext = os.path.splitext(EVENT_LOG_FILE)
+    rotated = sorted(
+        f for f in os.listdir(directory)
+        if f.startswith(base + ".") and f.endswith(ext) and f != EVENT_LOG_FILE
+    )
+    files = [os.path.join(directory, f) for f in rotated]
+    if os.path.exists(os.path.join(directory, EVENT_LOG_FILE)):
+        files.append(os.path.join(directory, EVENT_LOG_FILE))
+    return files
+
+
+def iter_events(files: List[str]) -> Iterator[Dict[str, Any]]:
+    for path in files:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # 書き込み途中で終了した行など
+                    continue
+
+
+def extract_sequences(events: Iterator[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """イベントからセッションごとの回答の並びを組み立てる
+
+    開始・やり直しごとに別の並びとし、「戻る」で取り消された回答は除く。
+    """
+    sequences: List[Dict[str, Any]] = []
+    current: Dict[str, Dict[str, Any]] = {}
+
+    def finish(session_id: str):
+        seq = current.pop(session_id, None)
+        if seq is not None and seq["answers"]:
+            sequences.append(seq)
+
+    for event in events:
+        session_id = event.get("session_id")
+        event_type = event.get("type")
+        if event_type in ("start", "restart"):
+            finish(session_id)
+            current[session_id] = {
+                "session_id": session_id,
+                "rules_hash": event.get("rules_hash"),
+                "answers": [],
+            }
+        elif event_type == "answer" and session_id in current:
+            current[session_id]["answers"].append([event["condition"], event["answer"]])
+        elif event_type == "back" and session_id in current:
+            answers = current[session_id]["answers"]
+            del answers[max(0, len(answers) - event.get("steps", 1)):]
+        elif event_type == "end":
+            finish(session_id)
+
+    for session_id in list(current):
+        finish(session_id)
+    return sequences
+
+
+# ========== 再生 ==========
+
+def load_knowledge_base(rules_path: Optional[str]):
+    """再生に使う知識ベース（省略時は現在のルール）"""
+    if not rules_path:
+        return get_knowledge_base()
+    with open(rules_path, encoding="utf-8") as f:
+        return compile_knowledge_base(parse_rules_data(json.load(f)))
+
+
+def _count_iterations(engine: InferenceEngine) -> Dict[str, int]:
+    """エンジンの不動点計算の反復回数を数える
+
+    評価の反復は evaluate_all_rules、伝播の反復は _propagate_uncertain_actions の
+    呼び出し回数（どちらも反復ごとに1回呼ばれる）。
+    """
+    counts = {"evaluation": 0, "propagation": 0}
+    evaluate_all_rules = engine.evaluator.evaluate_all_rules
+    propagate_uncertain_actions = engine._propagate_uncertain_actions
+
+    def counted_evaluate():
+        counts["evaluation"] += 1
+        return evaluate_all_rules()
+
+    def counted_propagate():
+        counts["propagation"] += 1
+        return propagate_uncertain_actions()
+
+    engine.evaluator.evaluate_all_rules = counted_evaluate
+    engine._propagate_uncertain_actions = counted_propagate
+    return counts
+
+
+def replay_sequence(kb, answers: List[List[str]]) -> Dict[str, Any]:
+    """1セッション分の回答を再生"""
+    recorded = dict((condition, answer) for condition, answer in answers)
+    engine = InferenceEngine(kb)
+    counts = _count_iterations(engine)
+
+    start = time.perf_counter()
+    question = engine.start_consultation()
+    start_seconds = time.perf_counter() - start
+
+    steps = []
+    result: Dict[str, Any] = {"is_complete": question is None}
+    while question and len(steps) < MAX_QUESTIONS:
+        answer = recorded.get(question)
+        if answer is None:
+            break
+        counts["evaluation"] = counts["propagation"] = 0
+        start = time.perf_counter()
+        result = engine.answer_question(question, answer)
+        seconds = time.perf_counter() - start
+        steps.append({
+            "condition": question,
+            "answer": answer,
+            "seconds": seconds,
+            "evaluation_iterations": counts["evaluation"],
+            "propagation_iterations": counts["propagation"],
+        })
+        if result["is_complete"]:
+            break
+        question = result["next_question"]
+
+    diagnosis = result.get("diagnosis_result") or {}
+    return {
+        "start_seconds": start_seconds,
+        "steps": steps,
+        "unanswered": None if result["is_complete"] else question,
+        "is_complete": result["is_complete"],
+        "diagnosis": {
+            "applicable_visas": [v["visa"] for v in diagnosis.get("applicable_visas", [])],
+            "conditional_visas": [v["visa"] for v in diagnosis.get("conditional_visas", [])],
+        },
+    }
+
+
+def run_replay(kb, sequences: List[Dict[str, Any]], repeat: int) -> List[Dict[str, Any]]:
+    """全セッションをrepeat回再生し、ステップごとに最小の所要時間を残す
+
+    計測のばらつきを減らすため、再生中はガベージコレクションを止める。
+    """
+    results = []
+    gc.collect()
+    gc.disable()
+    try:
+        for seq in sequences:
+            results.append(_replay_best(kb, seq, repeat))
+    finally:
+        gc.enable()
+    return results
+
+
+def _replay_best(kb, seq: Dict[str, Any], repeat: int) -> Dict[str, Any]:
+    best = None
+    for _ in range(repeat):
+        replayed = replay_sequence(kb, seq["answers"])
+        if best is None:
+            best = replayed
+            continue
+        best["start_seconds"] = min(best["start_seconds"], replayed["start_seconds"])
+        for step, other in zip(best["steps"], replayed["steps"]):
+            step["seconds"] = min(step["seconds"], other["seconds"])
+    best["session_id"] = seq["session_id"]
+    best["recorded_rules_hash"] = seq.get("rules_hash")
+    return best
+
+
+# ========== 比較 ==========
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _questions(session: Dict[str, Any]) -> List[str]:
+    return [step["condition"] for step in session["steps"]]
+
+
+def _step_seconds(report: Dict[str, Any]) -> List[float]:
+    return sorted(step["seconds"] for s in report["sessions"] for step in s["steps"])
+
+
+def _iteration_totals(report: Dict[str, Any]) -> Tuple[int, int]:
+    steps = [step for s in report["sessions"] for step in s["steps"]]
+    return (sum(s["evaluation_iterations"] for s in steps), sum(s["propagation_iterations"] for s in steps))
+
+
+def compare_reports(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> Dict[str, Any]:
+    """基準と今回の再生結果の差分
+
+    セッションは記録の順序で対応させる（同じ記録から再生したもの同士を比べる）。
+    """
+    questions_changed = []
+    diagnosis_changed = []
+    iterations_changed = []
+    slower = []
+    for base, cur in zip(baseline["sessions"], current["sessions"]):
+        if _questions(base) != _questions(cur) or base["unanswered"] != cur["unanswered"]:
+            questions_changed.append(cur["session_id"])
+        if base["diagnosis"] != cur["diagnosis"] or base["is_complete"] != cur["is_complete"]:
+            diagnosis_changed.append(cur["session_id"])
+        if ([(s["evaluation_iterations"], s["propagation_iterations"]) for s in base["steps"]] !=
+                [(s["evaluation_iterations"], s["propagation_iterations"]) for s in cur["steps"]]):
+            iterations_changed.append(cur["session_id"])
+
+        base_total = sum(s["seconds"] for s in base["steps"])
+        cur_total = sum(s["seconds"] for s in cur["steps"])
+        if (_questions(base) == _questions(cur) and base_total > 0 and cur_total / base_total > threshold
+                and cur_total - base_total > MIN_SLOWDOWN_SECONDS):
+            slower.append({"session_id": cur["session_id"], "ratio": cur_total / base_total})
+
+    slower.sort(key=lambda s: -s["ratio"])
+    base_seconds = _step_seconds(baseline)
+    cur_seconds = _step_seconds(current)
+    latency = {
+        name: (percentile(base_seconds, p), percentile(cur_seconds, p))
+        for name, p in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))
+    }
+    return {
+        "session_count": (len(baseline["sessions"]), len(current["sessions"])),
+        "rules_hash": (baseline.get("rules_hash"), current.get("rules_hash")),
+        "latency": latency,
+        "iterations": (_iteration_totals(baseline), _iteration_totals(current)),
+        "questions_changed": questions_changed,
+        "diagnosis_changed": diagnosis_changed,
+        "iterations_changed": iterations_changed,
+        "slower_sessions": slower,
+        "latency_regressed": latency["p50"][0] > 0 and latency["p50"][1] / latency["p50"][0] > threshold,
+    }
+
+
+def print_summary(report: Dict[str, Any]):
+    steps = [step for s in report["sessions"] for step in s["steps"]]
+    seconds = _step_seconds(report)
+    evaluation, propagation = _iteration_totals(report)
+    print("=" * 72)
+    print("再生結果")
+    print("=" * 72)
+    print(f"  ルール: {report['rules_hash']}")
+    print(f"  セッション: {len(report['sessions'])}, 回答: {len(steps)}, "
+          f"完了: {sum(1 for s in report['sessions'] if s['is_complete'])}, "
+          f"打ち切り: {sum(1 for s in report['sessions'] if s['unanswered'])}")
+    print(f"  回答のレイテンシ (ms): p50 {percentile(seconds, 50) * 1000:.3f}, "
+          f"p90 {percentile(seconds, 90) * 1000:.3f}, p99 {percentile(seconds, 99) * 1000:.3f}, "
+          f"max {percentile(seconds, 100) * 1000:.3f}")
+    print(f"  反復回数: 評価 {evaluation}, 伝播 {propagation}")
+
+
+def print_diff(diff: Dict[str, Any], threshold: float):
+    print("=" * 72)
+    print("基準との比較")
+    print("=" * 72)
+    base_hash, cur_hash = diff["rules_hash"]
+    print(f"  ルール: {base_hash} -> {cur_hash}{'（同じ）' if base_hash == cur_hash else ''}")
+    print(f"  セッション: {diff['session_count'][0]} -> {diff['session_count'][1]}")
+
+    print("\n--- 回答のレイテンシ (ms) ---")
+    print(f"  {'':<6}{'基準':>10}{'今回':>10}{'比':>8}")
+    for name, (base, cur) in diff["latency"].items():
+        ratio = f"{cur / base:.2f}" if base else "-"
+        print(f"  {name:<6}{base * 1000:>10.3f}{cur * 1000:>10.3f}{ratio:>8}")
+
+    (base_eval, base_prop), (cur_eval, cur_prop) = diff["iterations"]
+    print("\n--- 反復回数 ---")
+    print(f"  評価: {base_eval} -> {cur_eval}")
+    print(f"  伝播: {base_prop} -> {cur_prop}")
+    print(f"  反復回数が変わったセッション: {len(diff['iterations_changed'])}")
+
+    print("\n--- 結果の変化 ---")
+    print(f"  質問の並びが変わったセッション: {len(diff['questions_changed'])}")
+    for session_id in diff["questions_changed"][:10]:
+        print(f"    {session_id}")
+    print(f"  診断結果が変わったセッション: {len(diff['diagnosis_changed'])}")
+    for session_id in diff["diagnosis_changed"][:10]:
+        print(f"    {session_id}")
+
+    print(f"\n--- {threshold:.2f}倍より遅くなったセッション: {len(diff['slower_sessions'])} ---")
+    for s in diff["slower_sessions"][:10]:
+        print(f"    {s['session_id']}  x{s['ratio']:.2f}")
+
+
+def has_regression(diff: Dict[str, Any]) -> bool:
+    return bool(diff["questions_changed"] or diff["diagnosis_changed"] or diff["latency_regressed"])
+
+
+# ========== コマンド ==========
+
+def _load_json(path: str):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+
+
+def cmd_extract(args) -> int:
+    files = iter_event_files(args.events)
+    if not files:
+        print(f"イベントログがありません: {args.events}")
+        return 1
+    sequences = extract_sequences(iter_events(files))
+    _write_json(args.output, sequences)
+    print(f"{len(files)}ファイルから{len(sequences)}セッションの回答を {args.output} に書き出しました")
+    return 0
+
+
+def cmd_run(args) -> int:
+    kb = load_knowledge_base(args.rules)
+    sequences = _load_json(args.sequences)
+    # 計測前に知識ベースの遅延構築分を済ませる
+    if sequences:
+        replay_sequence(kb, sequences[0]["answers"])
+
+    report = {
+        "rules_hash": kb.content_hash,
+        "repeat": args.repeat,
+        "sessions": run_replay(kb, sequences, args.repeat),
+    }
+    if args.output:
+        _write_json(args.output, report)
+    print_summary(report)
+
+    if args.baseline:
+        diff = compare_reports(_load_json(args.baseline), report, args.threshold)
+        print()
+        print_diff(diff, args.threshold)
+        return 1 if has_regression(diff) else 0
+    return 0
+
+
+def cmd_compare(args) -> int:
+    diff = compare_reports(_load_json(args.baseline), _load_json(args.result), args.threshold)
+    print_diff(diff, args.threshold)
+    return 1 if has_regression(diff) else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="診断の記録を再生して性能を比較")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("extract", help="イベントログから回答の並びを取り出す")
+    p.add_argument("--events", default=EVENT_LOG_DIR, help="イベントログのディレクトリ")
+    p.add_argument("-o", "--output", default="sequences.json", help="出力ファイル（デフォルト sequences.json）")
+    p.set_defaults(func=cmd_extract)
+
+    p = sub.add_parser("run", help="回答の並びを再生する")
+    p.add_argument("sequences", help="extract で書き出したファイル")
+    p.add_argument("--rules", help="再生に使う rules.json（省略時は現在のルール）")
+    p.add_argument("--repeat", type=int, default=5, help="再生の回数（ステップごとに最小値を使う、デフォルト5）")
+    p.add_argument("-o", "--output", help="再生結果の出力ファイル（次回の基準に使う）")
+    p.add_argument("--baseline", help="比較する基準の再生結果")
+    p.add_argument("--threshold", type=float, default=1.2, help="遅くなったとみなす比（デフォルト1.2）")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("compare", help="2つの再生結果を比較する")
+    p.add_argument("baseline", help="基準の再生結果")
+    p.add_argument("result", help="比較する再生結果")
+    p.add_argument("--threshold", type=float, default=1.2, help="遅くなったとみなす比（デフォルト1.2）")
+    p.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+運用向けのAPIエンドポイント（セッションのメモリ使用量・診断イベントログの状況など）
+"""
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from routes.consultation import sessions
+from services.event_log import event_log
+from services.session_memory import sessions_memory_report, memory_snapshots, MEMORY_SNAPSHOTS_ENABLED
+
+router = APIRouter(prefix="/api/admin", tags=["admin"])
+
+
+@router.get("/sessions/memory")
+async def get_sessions_memory(top: int = Query(10, ge=0, le=100, description="大きい順に返すセッション数")):
+    """診断セッションの数と、セッションごとのおおよその大きさ
+
+    診断の処理と同じイベントループ上で数えるので、集計中にセッションが変わることはない。
+    """
+    return sessions_memory_report(list(sessions.items()), top)
+
+
+if MEMORY_SNAPSHOTS_ENABLED:
+    # 計測中は全体が遅くなるので、開始・停止は MEMORY_SNAPSHOTS=1 のときだけ公開する
+    @router.post("/memory/snapshots")
+    async def take_memory_snapshot(label: Optional[str] = None):
+        """tracemalloc のスナップショットを取る（最初の1回で計測を開始する）"""
+        return memory_snapshots.take(label)
+
+    @router.delete("/memory/snapshots")
+    async def stop_memory_tracing():
+        """スナップショットを捨てて tracemalloc を止める"""
+        memory_snapshots.stop()
+        return {"status": "stopped"}
+
+
+@router.get("/events")
+async def get_event_log_stats():
+    """診断イベントログの書き込み状況（キューの件数・書き出した件数・捨てた件数）"""
+    return event_log.stats()
+
+
+@router.get("/memory/snapshots")
+async def list_memory_snapshots():
+    """保持しているスナップショットの一覧"""
+    return {"snapshots": memory_snapshots.list()}
+
+
+@router.get("/memory/snapshots/diff")
+async def diff_memory_snapshots(
+    before: int = Query(..., description="比較元のスナップショットID"),
+    after: int = Query(..., description="比較先のスナップショットID"),
+    limit: int = Query(20, ge=1, le=200),
+):
+    """2つのスナップショットの間に増えたメモリ（ソースの行ごと）"""
+    try:
+        return memory_snapshots.diff(before, after, limit)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Snapshot not found")
@@ -1,36 +1,22 @@
 """
 条件（質問）管理関連のAPIエンドポイント
 """
-import csv
-import io
-import json
-import os
-from fastapi import APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from typing import List
+
+from fastapi import APIRouter, HTTPException, UploadFile, File, Request, Query
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 
-from knowledge import get_all_rules
+from knowledge import (
+    get_all_rules, get_notes, get_note as get_condition_note, update_notes,
+    reload_rules, get_rules_version, get_notes_version
+)
+from services.http_cache import conditional_response, conditional_stream_response, encode_json
+from services.csv_stream import iter_csv_chunks, parse_csv_upload, add_row_error
+from services.search_index import search_indexes, paginate
 
 router = APIRouter(prefix="/api/conditions", tags=["conditions"])
 
-# データファイルのパス
-DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data")
-NOTES_FILE = os.path.join(DATA_DIR, "condition_notes.json")
-
-
-def load_notes() -> dict:
-    """補足データを読み込む"""
-    if not os.path.exists(NOTES_FILE):
-        return {}
-    with open(NOTES_FILE, 'r', encoding='utf-8') as f:
-        return json.load(f)
-
-
-def save_notes(notes: dict):
-    """補足データを保存"""
-    with open(NOTES_FILE, 'w', encoding='utf-8') as f:
-        json.dump(notes, f, ensure_ascii=False, indent=2)
-
 
 def get_all_conditions() -> set:
     """全ルールから全条件を抽出"""
@@ -41,13 +27,18 @@ def get_all_conditions() -> set:
     return conditions
 
 
-@router.get("")
-async def list_conditions():
-    """全条件一覧を取得（補足付き）"""
+def get_conditions_version() -> tuple:
+    """条件一覧のバージョン（ルールと補足のバージョンの組）"""
+    reload_rules()
+    return (get_rules_version(), get_notes_version())
+
+
+def build_conditions_json() -> bytes:
+    """条件一覧（補足付き）のJSONを生成"""
     conditions = sorted(get_all_conditions())
-    notes = load_notes()
+    notes = get_notes()
 
-    return {
+    return encode_json({
         "conditions": [
             {
                 "text": cond,
@@ -55,6 +46,35 @@ async def list_conditions():
             }
             for cond in conditions
         ]
+    })
+
+
+@router.get("")
+async def list_conditions(request: Request):
+    """全条件一覧を取得（補足付き）"""
+    return conditional_response(
+        request, "conditions", get_conditions_version(), build_conditions_json
+    )
+
+
+@router.get("/search")
+async def search_conditions(
+    q: str = Query(..., min_length=1),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """条件文・補足の文字列で条件を検索（文字n-gram、関連度順）"""
+    reload_rules()
+    results = search_indexes.search_conditions(q)
+    notes = get_notes()
+
+    return {
+        "query": q,
+        **paginate(results, offset, limit),
+        "conditions": [
+            {"text": cond, "note": notes.get(cond, ""), "score": round(score, 4)}
+            for cond, score in results[offset:offset + limit]
+        ]
     }
 
 
@@ -65,66 +85,51 @@ class UpdateNoteRequest(BaseModel):
 
 @router.put("/note")
 async def update_note(request: UpdateNoteRequest):
-    """条件の補足を更新"""
-    notes = load_notes()
+    """条件の補足を更新
 
+    ファイルへの書き込みは遅延され、連続した編集は1回の書き込みにまとめられる
+    """
     if request.note.strip():
-        notes[request.condition] = request.note.strip()
+        update_notes({request.condition: request.note.strip()})
     else:
         # 空の場合は削除
-        notes.pop(request.condition, None)
+        update_notes({}, deletes=[request.condition])
 
-    save_notes(notes)
     return {"status": "updated", "condition": request.condition}
 
 
 @router.get("/export")
-async def export_conditions_csv():
-    """条件と補足をCSV形式でエクスポート"""
+async def export_conditions_csv(request: Request):
+    """条件と補足をCSV形式でエクスポート（チャンク単位でストリーミング）"""
+    version = get_conditions_version()
     conditions = sorted(get_all_conditions())
-    notes = load_notes()
-
-    output = io.StringIO()
-    output.write('\ufeff')  # BOM for Excel
-
-    writer = csv.writer(output)
-    writer.writerow(["condition", "note"])
-
-    for cond in conditions:
-        writer.writerow([cond, notes.get(cond, "")])
-
-    output.seek(0)
-
-    return StreamingResponse(
-        iter([output.getvalue()]),
+    notes = get_notes()
+    return conditional_stream_response(
+        request, "conditions_csv", version,
+        lambda: iter_csv_chunks(
+            ["condition", "note"],
+            ([cond, notes.get(cond, "")] for cond in conditions)
+        ),
         media_type="text/csv; charset=utf-8",
         headers={"Content-Disposition": "attachment; filename=condition_notes.csv"}
     )
 
 
-@router.post("/import")
-async def import_conditions_csv(file: UploadFile = File(...)):
-    """CSVファイルから補足をインポート"""
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="CSVファイルを選択してください")
-
-    content = await file.read()
-
-    try:
-        text = content.decode('utf-8-sig')
-    except UnicodeDecodeError:
-        text = content.decode('cp932')
-
-    reader = csv.DictReader(io.StringIO(text))
+def parse_note_rows(rows) -> tuple:
+    """CSVの行を補足の更新・削除に振り分け、行単位で検証する
 
+    Returns:
+        (更新する補足, 削除する条件, エラーメッセージ（上限あり）, エラー件数)
+    """
     updates = {}  # 更新する補足
     deletes = []  # 削除する条件
     errors = []
+    error_count = 0
 
-    for row_num, row in enumerate(reader, start=2):
+    for row_num, row in rows:
         try:
-            condition = row.get("condition", "").strip()
-            note = row.get("note", "").strip()
+            condition = (row.get("condition") or "").strip()
+            note = (row.get("note") or "").strip()
 
             if not condition:
                 continue
@@ -135,26 +140,49 @@ async def import_conditions_csv(file: UploadFile = File(...)):
                 deletes.append(condition)
 
         except Exception as e:
-            errors.append(f"行{row_num}: {str(e)}")
+            error_count += 1
+            add_row_error(errors, row_num, str(e))
+
+    return updates, deletes, errors, error_count
+
 
-    if errors:
-        return {"status": "error", "errors": errors}
+@router.post("/import")
+async def import_conditions_csv(file: UploadFile = File(...)):
+    """CSVファイルから補足をインポート"""
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="CSVファイルを選択してください")
 
-    # 既存のノートを更新
-    existing_notes = load_notes()
-    existing_notes.update(updates)
+    # アップロードされたファイルを1行ずつ読み込む（BOM付きUTF-8 → Shift-JISの順に試す）
+    updates, deletes, errors, error_count = await run_in_threadpool(
+        parse_csv_upload, file.file, parse_note_rows
+    )
 
-    # 空になった条件を削除
-    for condition in deletes:
-        existing_notes.pop(condition, None)
+    if error_count:
+        return {"status": "error", "errors": errors, "error_count": error_count}
 
-    save_notes(existing_notes)
+    # 既存のノートを更新し、空になった条件を削除
+    update_notes(updates, deletes=deletes)
 
     return {"status": "imported", "count": len(updates)}
 
 
+class NotesRequest(BaseModel):
+    conditions: List[str]
+
+
+MAX_BULK_NOTES = 1000
+
+
+@router.post("/notes")
+async def get_notes_bulk(request: NotesRequest):
+    """複数の条件の補足をまとめて取得（補足のない条件は空文字列）"""
+    if len(request.conditions) > MAX_BULK_NOTES:
+        raise HTTPException(status_code=400, detail=f"Too many conditions (max {MAX_BULK_NOTES})")
+    notes = get_notes()
+    return {"notes": {cond: notes.get(cond, "") for cond in request.conditions}}
+
+
 @router.get("/note/{condition:path}")
 async def get_note(condition: str):
     """特定の条件の補足を取得"""
-    notes = load_notes()
-    return {"condition": condition, "note": notes.get(condition, "")}
+    return {"condition": condition, "note": get_condition_note(condition)}
@@ -1,27 +1,120 @@
 """
 診断関連のAPIエンドポイント
+
+環境変数:
+    SESSION_IDLE_TIMEOUT: この秒数だけ使われなかったセッションを破棄する（デフォルトは3600、0なら破棄しない）
 """
-from typing import Dict
-from fastapi import APIRouter, HTTPException
+import os
+import time
+from typing import Dict, List, Optional
+from fastapi import APIRouter, HTTPException, BackgroundTasks, Depends, Header, Query, WebSocket, WebSocketDisconnect
 
-from engine import InferenceEngine
-from knowledge import reload_rules
-from schemas import StartRequest, AnswerRequest, GoBackRequest
-from services.validation import check_rules_integrity
+from engine import InferenceEngine, engine_pool, explain_conditions, evaluate_what_if, precompute_answers
+from knowledge import reload_rules, rulebase_versions
+from schemas import StartRequest, AnswerRequest, GoBackRequest, WhatIfRequest
+from services.validation import check_rules_integrity_cached
+from services.consultation_channel import RuleStatusTracker, channel_registry
+from services.listing import RulesStatusParams, rules_status_response
+from services.display_json import consultation_response
+from services.condition_notes import note_scope, notes_response
+from services.event_log import event_log, result_event_data, completion_event_data
+from services.session_tokens import (
+    SESSION_TOKENS_ENABLED, session_tokens, SessionTokenError, RulebaseNotAvailableError
+)
 
 router = APIRouter(prefix="/api/consultation", tags=["consultation"])
 
 # セッション管理（実運用ではRedisなどを使用）
+# SESSION_MODE=token のときは使わず、状態は署名付きトークンでクライアントに預ける
 sessions: Dict[str, InferenceEngine] = {}
+_last_used: Dict[str, float] = {}  # セッションを最後に使った時刻（time.monotonic()）
 
+TOKEN_HEADER = "X-Session-Token"
 
-@router.post("/start")
-async def start_consultation(request: StartRequest):
-    """診断を開始"""
+SESSION_IDLE_TIMEOUT = float(os.environ.get("SESSION_IDLE_TIMEOUT", "3600"))
+EXPIRE_CHECK_INTERVAL = 60.0  # 使われていないセッションを探す間隔（秒）
+
+_next_expire_check = 0.0
+
+
+def _touch_session(session_id: str):
+    """セッションを使ったことを記録し、一定間隔で使われていないセッションを破棄する"""
+    global _next_expire_check
+    now = time.monotonic()
+    _last_used[session_id] = now
+    if SESSION_IDLE_TIMEOUT > 0 and now >= _next_expire_check:
+        _next_expire_check = now + EXPIRE_CHECK_INTERVAL
+        _expire_idle_sessions(now - SESSION_IDLE_TIMEOUT)
+
+
+def _expire_idle_sessions(cutoff: float):
+    """cutoff より前から使われていないセッションを破棄する（固定していた知識ベースの版を解放する）
+
+    ページを閉じるなどで DELETE /session/{session_id} が届かなかったセッションのため。
+    """
+    for session_id in [sid for sid, used in _last_used.items() if used < cutoff]:
+        del _last_used[session_id]
+        engine = sessions.pop(session_id, None)
+        if engine is not None:
+            rulebase_versions.release(engine.knowledge_base)
+            event_log.record("end", session_id, reason="expired")
+
+
+def _set_session(session_id: str, engine: InferenceEngine):
+    """セッションにエンジンを割り当てる（使用する知識ベースの版を固定する）"""
+    rulebase_versions.pin(engine.knowledge_base)
+    previous = sessions.get(session_id)
+    sessions[session_id] = engine
+    if previous is not None:
+        rulebase_versions.release(previous.knowledge_base)
+    _touch_session(session_id)
+
+
+def _keep_session(session_id: str, engine: InferenceEngine):
+    """セッションを保持（トークンモードではサーバーに保持しない）"""
+    if not SESSION_TOKENS_ENABLED:
+        _set_session(session_id, engine)
+
+
+def _get_session(session_id: str, session_token: Optional[str]) -> InferenceEngine:
+    """セッションのエンジンを取得（トークンモードではトークンから復元した複製）
+
+    Raises:
+        HTTPException: セッションがない、またはトークンが不正な場合
+    """
+    if not SESSION_TOKENS_ENABLED:
+        if session_id not in sessions:
+            raise HTTPException(status_code=404, detail="Session not found")
+        _touch_session(session_id)
+        return sessions[session_id]
+
+    if not session_token:
+        raise HTTPException(status_code=401, detail="Session token required")
+    try:
+        return session_tokens.restore(session_id, session_token)
+    except RulebaseNotAvailableError:
+        raise HTTPException(status_code=409, detail="Rules changed since the session token was issued")
+    except SessionTokenError:
+        raise HTTPException(status_code=401, detail="Invalid session token")
+
+
+def _session_token(session_id: str, engine: InferenceEngine, remember: bool = True) -> Dict:
+    """レスポンスに含めるセッショントークン（トークンモードのみ）"""
+    if not SESSION_TOKENS_ENABLED:
+        return {}
+    return {"session_token": session_tokens.issue(session_id, engine, remember)}
+
+
+def _start_session(session_id: str) -> InferenceEngine:
+    """整合性チェックを行ってからセッションを開始
+
+    Raises:
+        HTTPException: ルールに問題がある場合
+    """
     reload_rules()
 
     # 整合性チェック - エラーがあれば診断を開始できない
-    issues = check_rules_integrity()
+    issues = check_rules_integrity_cached()
     if issues:
         issue_messages = [i["message"] for i in issues]
         raise HTTPException(
@@ -32,89 +125,361 @@ async def start_consultation(request: StartRequest):
             }
         )
 
-    engine = InferenceEngine()
-    first_question = engine.start_consultation()
+    # 最初の質問まで計算済みのエンジンをプールから取り出す
+    engine = engine_pool.acquire()
+    _keep_session(session_id, engine)
+    return engine
 
-    sessions[request.session_id] = engine
 
-    return {
+def _record_start(event_type: str, session_id: str, engine: InferenceEngine):
+    """開始・やり直しのイベントを記録"""
+    event_log.record(
+        event_type, session_id,
+        rules_hash=engine.knowledge_base.content_hash,
+        next_question=engine.current_question,
+    )
+
+
+def _record_answer(session_id: str, condition: str, answer: str, result: Dict):
+    """回答のイベント（完了したら完了イベントも）を記録"""
+    event_log.record("answer", session_id, condition=condition, answer=answer, **result_event_data(result))
+    if result["is_complete"] and result.get("diagnosis_result"):
+        event_log.record("complete", session_id, **completion_event_data(result["diagnosis_result"]))
+
+
+def _lookahead(engine: InferenceEngine, enabled: bool) -> Dict:
+    """次の質問への3通りの回答それぞれの結果（lookahead=true のときのみ）"""
+    if not enabled:
+        return {}
+    return {"lookahead": precompute_answers(engine)}
+
+
+LOOKAHEAD_QUERY = Query(False, description="次の質問に yes / no / unknown と答えた場合の結果も返す")
+
+
+def _rules_status(engine: InferenceEngine, rules_params: RulesStatusParams) -> Dict:
+    """rules_statusのレスポンス項目（パラメータの指定があれば絞り込む）"""
+    content_hash = engine.knowledge_base.content_hash
+    rules_query = rules_params.to_query(content_hash)
+    if rules_query is None:
+        return rules_status_response({}, content_hash)
+    return rules_status_response(engine.build_rules_status(rules_query), content_hash)
+
+
+@router.post("/start")
+async def start_consultation(
+    request: StartRequest, background_tasks: BackgroundTasks,
+    rules_params: RulesStatusParams = Depends(), lookahead: bool = LOOKAHEAD_QUERY,
+    include_notes: Optional[str] = Depends(note_scope)
+):
+    """診断を開始"""
+    engine = _start_session(request.session_id)
+    first_question = engine.current_question
+    _record_start("start", request.session_id, engine)
+    background_tasks.add_task(engine_pool.refill)
+
+    return consultation_response({
         "session_id": request.session_id,
         "current_question": first_question,
-        "rules_status": engine.get_rules_display_info(),
-        "is_complete": first_question is None
-    }
+        **_rules_status(engine, rules_params),
+        "is_complete": first_question is None,
+        **notes_response(engine, first_question, include_notes),
+        **_lookahead(engine, lookahead),
+        **_session_token(request.session_id, engine)
+    }, engine)
 
 
 @router.post("/answer")
-async def answer_question(request: AnswerRequest):
+async def answer_question(
+    request: AnswerRequest, rules_params: RulesStatusParams = Depends(),
+    session_token: Optional[str] = Header(None, alias=TOKEN_HEADER), lookahead: bool = LOOKAHEAD_QUERY,
+    include_notes: Optional[str] = Depends(note_scope)
+):
     """質問に回答"""
-    if request.session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    engine = sessions[request.session_id]
+    engine = _get_session(request.session_id, session_token)
 
     if not engine.current_question:
         raise HTTPException(status_code=400, detail="No current question")
 
-    result = engine.answer_question(engine.current_question, request.answer)
+    rules_query = rules_params.to_query(engine.knowledge_base.content_hash)
+    condition = engine.current_question
+    result = engine.answer_question(
+        condition, request.answer, rules_query, include_rules_status=rules_query is not None
+    )
+    _record_answer(request.session_id, condition, request.answer, result)
 
     response = {
         "session_id": request.session_id,
         "current_question": result["next_question"],
-        "rules_status": result["rules_status"],
+        **rules_status_response(result, engine.knowledge_base.content_hash),
         "derived_facts": result["derived_facts"],
         "is_complete": result["is_complete"]
     }
 
+    response.update(notes_response(engine, result["next_question"], include_notes))
     if result["is_complete"]:
         response["diagnosis_result"] = result.get("diagnosis_result")
+    else:
+        response.update(_lookahead(engine, lookahead))
+    response.update(_session_token(request.session_id, engine))
 
-    return response
+    return consultation_response(response, engine)
 
 
 @router.post("/back")
-async def go_back(request: GoBackRequest):
+async def go_back(
+    request: GoBackRequest, rules_params: RulesStatusParams = Depends(),
+    session_token: Optional[str] = Header(None, alias=TOKEN_HEADER),
+    include_notes: Optional[str] = Depends(note_scope)
+):
     """前の質問に戻る"""
-    if request.session_id not in sessions:
-        raise HTTPException(status_code=404, detail="Session not found")
-
-    engine = sessions[request.session_id]
-    result = engine.go_back(request.steps)
+    engine = _get_session(request.session_id, session_token)
+    rules_query = rules_params.to_query(engine.knowledge_base.content_hash)
+    result = engine.go_back(request.steps, rules_query, include_rules_status=rules_query is not None)
+    event_log.record("back", request.session_id, steps=request.steps, **result_event_data(result))
 
-    return {
+    return consultation_response({
         "session_id": request.session_id,
         "current_question": result["current_question"],
         "answered_questions": result["answered_questions"],
-        "rules_status": result["rules_status"]
-    }
+        **rules_status_response(result, engine.knowledge_base.content_hash),
+        **notes_response(engine, result["current_question"], include_notes),
+        **_session_token(request.session_id, engine, remember=False)
+    }, engine)
 
 
 @router.post("/restart")
-async def restart_consultation(request: StartRequest):
+async def restart_consultation(
+    request: StartRequest, background_tasks: BackgroundTasks,
+    rules_params: RulesStatusParams = Depends(), lookahead: bool = LOOKAHEAD_QUERY,
+    include_notes: Optional[str] = Depends(note_scope)
+):
     """最初からやり直し"""
-    engine = InferenceEngine()
-    first_question = engine.start_consultation()
+    engine = engine_pool.acquire()
+    first_question = engine.current_question
 
-    sessions[request.session_id] = engine
+    _keep_session(request.session_id, engine)
+    _record_start("restart", request.session_id, engine)
+    background_tasks.add_task(engine_pool.refill)
 
-    return {
+    return consultation_response({
         "session_id": request.session_id,
         "current_question": first_question,
-        "rules_status": engine.get_rules_display_info(),
-        "is_complete": first_question is None
-    }
+        **_rules_status(engine, rules_params),
+        "is_complete": first_question is None,
+        **notes_response(engine, first_question, include_notes),
+        **_lookahead(engine, lookahead),
+        **_session_token(request.session_id, engine)
+    }, engine)
 
 
 @router.get("/state/{session_id}")
-async def get_state(session_id: str):
+async def get_state(
+    session_id: str, rules_params: RulesStatusParams = Depends(),
+    session_token: Optional[str] = Header(None, alias=TOKEN_HEADER),
+    include_notes: Optional[str] = Depends(note_scope)
+):
     """現在の状態を取得"""
-    if session_id not in sessions:
+    engine = _get_session(session_id, session_token)
+    rules_query = rules_params.to_query(engine.knowledge_base.content_hash)
+    state = engine.get_current_state(rules_query, include_rules_status=rules_query is not None)
+    state.update(rules_status_response(state, engine.knowledge_base.content_hash))
+    state.pop("rules_next_after", None)
+
+    return consultation_response({
+        "session_id": session_id,
+        **state,
+        **notes_response(engine, state["current_question"], include_notes),
+        **_session_token(session_id, engine, remember=False)
+    }, engine)
+
+
+@router.delete("/session/{session_id}")
+async def end_session(session_id: str):
+    """セッションを終了（使っていた知識ベースの版を解放する）"""
+    if SESSION_TOKENS_ENABLED:
+        # サーバーには何も保持していない
+        event_log.record("end", session_id)
+        return {"status": "ended", "session_id": session_id}
+
+    engine = sessions.pop(session_id, None)
+    _last_used.pop(session_id, None)
+    if engine is None:
         raise HTTPException(status_code=404, detail="Session not found")
+    rulebase_versions.release(engine.knowledge_base)
+    event_log.record("end", session_id)
+    return {"status": "ended", "session_id": session_id}
+
 
-    engine = sessions[session_id]
-    state = engine.get_current_state()
+@router.get("/explain/{session_id}")
+async def explain(
+    session_id: str, condition: Optional[List[str]] = Query(None),
+    session_token: Optional[str] = Header(None, alias=TOKEN_HEADER)
+):
+    """条件が成立した根拠・成立しなかった理由を取得（condition省略時は全ゴール）"""
+    engine = _get_session(session_id, session_token)
+    kb = engine.knowledge_base
+    for cond in condition or []:
+        if cond not in kb.derived_conditions and cond not in kb.rules_by_condition:
+            raise HTTPException(status_code=404, detail=f"Condition not found: {cond}")
 
     return {
         "session_id": session_id,
-        **state
+        "explanations": explain_conditions(engine, condition)
+    }
+
+
+@router.get("/goals/{session_id}")
+async def get_goals(session_id: str, session_token: Optional[str] = Header(None, alias=TOKEN_HEADER)):
+    """ゴールごとの状態・関係する残りの質問・最短の残り質問数を取得"""
+    engine = _get_session(session_id, session_token)
+    return {
+        "session_id": session_id,
+        **engine.get_goal_analysis()
+    }
+
+
+@router.post("/whatif")
+async def what_if(request: WhatIfRequest, session_token: Optional[str] = Header(None, alias=TOKEN_HEADER)):
+    """回答を差し替えた場合の診断を取得（元のセッションは変更しない）"""
+    engine = _get_session(request.session_id, session_token)
+
+    for overrides in request.scenarios:
+        invalid = [a for a in overrides.values() if a not in ("yes", "no", "unknown")]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Invalid answer: {invalid[0]}")
+
+    return {
+        "session_id": request.session_id,
+        "scenarios": evaluate_what_if(engine, request.scenarios)
     }
+
+
+async def _receive_message(websocket: WebSocket) -> Dict:
+    """診断チャネルのメッセージを1つ受信（JSONオブジェクトでなければ400）"""
+    try:
+        message = await websocket.receive_json()
+    except (ValueError, KeyError, TypeError):
+        # JSONとして解析できない、またはバイナリのメッセージ
+        raise HTTPException(status_code=400, detail="Invalid JSON message")
+    if not isinstance(message, dict):
+        raise HTTPException(status_code=400, detail="Message must be a JSON object")
+    return message
+
+
+@router.websocket("/ws/{session_id}")
+async def consultation_channel(websocket: WebSocket, session_id: str):
+    """診断用のWebSocketチャネル
+
+    受信: {"type": "start" | "restart" | "answer" | "back" | "state", "answer": ..., "steps": ...}
+    送信: 次の質問と、前回送信時から状態が変わったルールのみ（rules_changed）。
+          start / restart / state では全ルールを送る（rules_status）。
+    セッションはHTTPのエンドポイントと共通（sessions）。
+    トークンモードでは接続中だけエンジンを保持し、接続時のクエリパラメータ token から復元する。
+    送信するメッセージには続きをHTTPで行うためのトークン（session_token）を含める。
+    """
+    await websocket.accept()
+    channel_registry.register(session_id, websocket)
+    tracker = RuleStatusTracker()
+    channel_sessions = {} if SESSION_TOKENS_ENABLED else sessions
+
+    async def send_snapshot(engine: InferenceEngine):
+        state = engine.get_current_state()
+        tracker.reset()
+        tracker.changes(state["rules_status"])
+        await websocket.send_json({
+            "type": "state", "session_id": session_id, **state,
+            **_session_token(session_id, engine, remember=False)
+        })
+
+    try:
+        if SESSION_TOKENS_ENABLED and websocket.query_params.get("token"):
+            try:
+                channel_sessions[session_id] = _get_session(session_id, websocket.query_params["token"])
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status_code": e.status_code, "detail": e.detail})
+
+        if session_id in channel_sessions:
+            await send_snapshot(channel_sessions[session_id])
+
+        while True:
+            try:
+                message = await _receive_message(websocket)
+                msg_type = message.get("type")
+
+                if msg_type == "start":
+                    engine = _start_session(session_id)
+                    channel_sessions[session_id] = engine
+                    _record_start("start", session_id, engine)
+                    await send_snapshot(engine)
+                    engine_pool.refill()
+                    continue
+
+                if msg_type == "restart":
+                    engine = engine_pool.acquire()
+                    _keep_session(session_id, engine)
+                    channel_sessions[session_id] = engine
+                    _record_start("restart", session_id, engine)
+                    await send_snapshot(engine)
+                    engine_pool.refill()
+                    continue
+
+                if session_id not in channel_sessions:
+                    raise HTTPException(status_code=404, detail="Session not found")
+                engine = channel_sessions[session_id]
+                if not SESSION_TOKENS_ENABLED:
+                    _touch_session(session_id)
+
+                if msg_type == "state":
+                    await send_snapshot(engine)
+                    continue
+
+                if msg_type == "answer":
+                    if not engine.current_question:
+                        raise HTTPException(status_code=400, detail="No current question")
+                    condition = engine.current_question
+                    answer = message.get("answer", "unknown")
+                    if not isinstance(answer, str):
+                        raise HTTPException(status_code=400, detail="Invalid answer")
+                    result = engine.answer_question(condition, answer)
+                    _record_answer(session_id, condition, answer, result)
+                    update = {
+                        "type": "update",
+                        "session_id": session_id,
+                        "current_question": result["next_question"],
+                        "rules_changed": tracker.changes(result["rules_status"]),
+                        "derived_facts": result["derived_facts"],
+                        "is_complete": result["is_complete"]
+                    }
+                    if result["is_complete"]:
+                        update["diagnosis_result"] = result.get("diagnosis_result")
+                    update.update(_session_token(session_id, engine, remember=False))
+                    await websocket.send_json(update)
+                    continue
+
+                if msg_type == "back":
+                    try:
+                        steps = int(message.get("steps", 1))
+                    except (TypeError, ValueError):
+                        raise HTTPException(status_code=400, detail="Invalid steps")
+                    result = engine.go_back(steps)
+                    event_log.record("back", session_id, steps=steps, **result_event_data(result))
+                    await websocket.send_json({
+                        "type": "update",
+                        "session_id": session_id,
+                        "current_question": result["current_question"],
+                        "answered_questions": result["answered_questions"],
+                        "rules_changed": tracker.changes(result["rules_status"]),
+                        **_session_token(session_id, engine, remember=False)
+                    })
+                    continue
+
+                raise HTTPException(status_code=400, detail=f"Unknown message type: {msg_type}")
+
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "status_code": e.status_code, "detail": e.detail})
+
+    except WebSocketDisconnect:
+        pass
+    finally:
+        channel_registry.unregister(session_id, websocket)
@@ -1,19 +1,25 @@
 """
 ルール管理関連のAPIエンドポイント
 """
-import csv
-import io
-from fastapi import APIRouter, HTTPException, UploadFile, File
-from fastapi.responses import StreamingResponse
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, UploadFile, File, Request, Query
+from starlette.concurrency import run_in_threadpool
 
 from knowledge import (
-    get_all_rules, RULES, save_rules, reload_rules
+    get_all_rules, RULES, save_rules, reload_rules,
+    insert_rule, update_rule as update_stored_rule, delete_rule as delete_stored_rule,
+    reorder_rules as reorder_stored_rules, export_rules_data, get_rules_version,
+    get_knowledge_base, rulebase_versions
 )
 from schemas import RuleRequest, DeleteRequest, ReorderRequest, ImportApplyRequest
-from services.validation import check_rules_integrity
-from services.rule_helpers import (
-    rules_to_dict_list, build_rules_data, request_to_dict
-)
+from services.validation import check_rules_integrity_cached, incremental_validator
+from services.rule_helpers import rule_to_dict, rules_to_dict_list, request_to_dict
+from services.http_cache import conditional_response, conditional_stream_response, encode_json
+from services.csv_stream import iter_csv_chunks, parse_csv_upload, add_row_error
+from services.consultation_channel import channel_registry
+from services.search_index import search_indexes, paginate
+from services.listing import MAX_PAGE_SIZE, encode_cursor, rule_list_query
 
 # CSV列定義
 CSV_COLUMNS = ["No", "action", "condition1", "condition2", "condition3", "condition4",
@@ -23,19 +29,75 @@ MAX_CONDITIONS = 4
 router = APIRouter(prefix="/api", tags=["rules"])
 
 
+async def notify_rules_updated():
+    """接続中の診断チャネルにルールの更新を通知"""
+    await channel_registry.broadcast({"type": "rules_updated", "rules_version": get_rules_version()})
+
+
 @router.get("/rules")
-async def get_rules():
-    """ルール一覧を取得（rules.json順）"""
+async def get_rules(
+    request: Request,
+    goal_only: bool = False,
+    action_prefix: Optional[str] = None,
+    fields: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """ルール一覧を取得（rules.json順）
+
+    パラメータの指定がなければ、ルールのバージョンごとにエンコード済みレスポンスを
+    キャッシュし、ETagで304を返す。
+    指定があれば絞り込み（goal_only, action_prefix）・フィールド指定（fields）・
+    カーソルによるページ分割（limit, cursor）を行う。
+    """
     reload_rules()
-    rules = get_all_rules()
-    return {"rules": rules_to_dict_list(rules)}
+    if not (goal_only or action_prefix or fields or limit or cursor):
+        return conditional_response(
+            request, "rules", get_rules_version(),
+            lambda: encode_json({"rules": rules_to_dict_list(get_all_rules())})
+        )
+
+    kb = get_knowledge_base()
+    query = rule_list_query(goal_only, action_prefix, fields, limit, cursor, kb.content_hash)
+
+    items = []
+    next_cursor = None
+    for idx, rule in enumerate(kb.rules):
+        if idx <= query.after or not query.matches(rule):
+            continue
+        if query.limit is not None and len(items) >= query.limit:
+            next_cursor = encode_cursor(kb.content_hash, items[-1]["index"])
+            break
+        info = rule_to_dict(rule)
+        items.append({"index": idx, **{k: v for k, v in info.items() if query.wants(k)}})
+
+    return {"rules": items, "next_cursor": next_cursor}
+
+
+@router.get("/rules/search")
+async def search_rules(
+    q: str = Query(..., min_length=1),
+    offset: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """結論・条件の文字列でルールを検索（文字n-gram、関連度順）"""
+    reload_rules()
+    results = search_indexes.search_rules(q)
+    kb = get_knowledge_base()
+
+    items = []
+    for action, score in results[offset:offset + limit]:
+        for i in kb.rules_by_action.get(action, ()):
+            items.append({"index": i, "score": round(score, 4), **rule_to_dict(kb.rules[i])})
+
+    return {"query": q, **paginate(results, offset, limit), "rules": items}
 
 
 @router.get("/validation/check")
 async def validate_rules():
     """ルールの整合性チェック"""
     reload_rules()
-    issues = check_rules_integrity()
+    issues = check_rules_integrity_cached()
     return {"status": "ok", "message": "問題ありません"} if not issues else {"status": "issues_found", "issues": issues}
 
 
@@ -45,98 +107,70 @@ async def create_rule(rule: RuleRequest):
 
     insert_after: 挿入位置（0=先頭、N=N番目の後、None=末尾）
     """
-    reload_rules()
-    rules_data = build_rules_data(RULES)
-    new_rule = request_to_dict(rule)
-
-    # 挿入位置を決定
-    if rule.insert_after is not None:
-        insert_index = rule.insert_after
-        if insert_index < 0:
-            insert_index = 0
-        elif insert_index > len(rules_data["rules"]):
-            insert_index = len(rules_data["rules"])
-        rules_data["rules"].insert(insert_index, new_rule)
-    else:
-        insert_index = len(rules_data["rules"])
-        rules_data["rules"].append(new_rule)
-
-    save_rules(rules_data)
-    return {"status": "created", "action": rule.action, "position": insert_index}
+    insert_index, before = insert_rule(rule.insert_after, request_to_dict(rule))
+    validation = incremental_validator.apply_edit(before, [rule.action])
+    await notify_rules_updated()
+    return {"status": "created", "action": rule.action, "position": insert_index, "validation": validation}
 
 
 @router.put("/rules")
 async def update_rule(rule: RuleRequest):
     """既存ルールを更新（indexで対象を特定）"""
-    reload_rules()
-
     if rule.index is None:
         raise HTTPException(status_code=400, detail="index is required for update")
 
-    if rule.index < 0 or rule.index >= len(RULES):
-        raise HTTPException(status_code=404, detail="Rule not found at specified index")
-
     # インデックス位置のルールだけを更新
-    rules_data = build_rules_data(RULES)
-    rules_data["rules"][rule.index] = request_to_dict(rule)
+    try:
+        previous_action, before = update_stored_rule(rule.index, request_to_dict(rule))
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Rule not found at specified index")
 
-    save_rules(rules_data)
-    return {"status": "updated", "action": rule.action, "index": rule.index}
+    validation = incremental_validator.apply_edit(before, [rule.action, previous_action])
+    await notify_rules_updated()
+    return {"status": "updated", "action": rule.action, "index": rule.index, "validation": validation}
 
 
 @router.post("/rules/delete")
 async def delete_rule(request: DeleteRequest):
     """ルールを削除（indexで特定）"""
-    reload_rules()
-
-    if request.index < 0 or request.index >= len(RULES):
-        raise HTTPException(status_code=404, detail="Rule not found at specified index")
-
     # インデックス位置のルールだけを削除
-    rules_data = build_rules_data(RULES)
-    deleted_action = rules_data["rules"][request.index]["action"]
-    del rules_data["rules"][request.index]
+    try:
+        deleted_action, before = delete_stored_rule(request.index)
+    except IndexError:
+        raise HTTPException(status_code=404, detail="Rule not found at specified index")
 
-    save_rules(rules_data)
-    return {"status": "deleted", "index": request.index, "action": deleted_action}
+    validation = incremental_validator.apply_edit(before, [deleted_action])
+    await notify_rules_updated()
+    return {"status": "deleted", "index": request.index, "action": deleted_action, "validation": validation}
 
 
 @router.post("/rules/reorder")
 async def reorder_rules(request: ReorderRequest):
     """ルールの順序を変更"""
-    reload_rules()
-    rules_map = {r.action: r for r in RULES}
-
-    reordered = []
-    for action in request.actions:
-        if action in rules_map:
-            reordered.append(rules_map.pop(action))
-    reordered.extend(rules_map.values())
-
-    save_rules(build_rules_data(reordered))
-    return {"status": "reordered", "count": len(reordered)}
+    count = reorder_stored_rules(request.actions)
+    await notify_rules_updated()
+    return {"status": "reordered", "count": count}
 
 
 @router.post("/rules/reload")
 async def reload_all_rules():
     """ルールをJSONファイルから再読み込み"""
-    reload_rules()
+    reload_rules(force=True)
+    await notify_rules_updated()
     return {"status": "reloaded", "count": len(RULES)}
 
 
-@router.get("/rules/export")
-async def export_rules_csv():
-    """ルールをCSV形式でエクスポート"""
-    reload_rules()
-    rules = get_all_rules()
-
-    # UTF-8 BOM付きCSVを生成
-    output = io.StringIO()
-    output.write('\ufeff')  # BOM for Excel
+@router.get("/rules/versions")
+async def get_rule_versions():
+    """診断中のセッションが使用している知識ベースの版"""
+    return {
+        "rules_version": get_rules_version(),
+        "versions": rulebase_versions.stats(get_knowledge_base())
+    }
 
-    writer = csv.writer(output)
-    writer.writerow(CSV_COLUMNS)
 
+def iter_rule_csv_rows(rules: list):
+    """ルールをCSVの行として1行ずつ生成"""
     for idx, rule in enumerate(rules):
         row = [idx + 1, rule.action]
 
@@ -147,56 +181,66 @@ async def export_rules_csv():
         row.append("OR" if rule.is_or_rule else "AND")
         row.append("TRUE" if rule.is_goal_action else "FALSE")
 
-        writer.writerow(row)
+        yield row
 
-    output.seek(0)
 
-    return StreamingResponse(
-        iter([output.getvalue()]),
+@router.get("/rules/export")
+async def export_rules_csv(request: Request):
+    """ルールをCSV形式でエクスポート（チャンク単位でストリーミング）"""
+    reload_rules()
+    rules = get_all_rules()
+    return conditional_stream_response(
+        request, "rules_csv", get_rules_version(),
+        lambda: iter_csv_chunks(CSV_COLUMNS, iter_rule_csv_rows(rules)),
         media_type="text/csv; charset=utf-8",
         headers={"Content-Disposition": "attachment; filename=rules.csv"}
     )
 
 
-@router.post("/rules/import")
-async def import_rules_csv(file: UploadFile = File(...)):
-    """CSVファイルからルールをインポート"""
-    if not file.filename.endswith('.csv'):
-        raise HTTPException(status_code=400, detail="CSVファイルを選択してください")
-
-    content = await file.read()
+@router.get("/rules/export/json")
+async def export_rules_json():
+    """ルールを rules.json 形式でエクスポート"""
+    reload_rules()
+    return export_rules_data()
 
-    # BOM対応でデコード
-    try:
-        text = content.decode('utf-8-sig')
-    except UnicodeDecodeError:
-        text = content.decode('cp932')  # Shift-JIS fallback
 
-    reader = csv.DictReader(io.StringIO(text))
+def parse_rule_rows(rows) -> tuple:
+    """CSVの行をルールdictに変換し、行単位で検証する
 
+    Returns:
+        (ルールdictのリスト, エラーメッセージ（上限あり）, エラー件数)
+    """
     new_rules = []
     errors = []
+    error_count = 0
 
-    for row_num, row in enumerate(reader, start=2):
+    for row_num, row in rows:
         try:
             # 条件を収集（空でないもの）
             conditions = []
             for i in range(1, MAX_CONDITIONS + 1):
-                cond = row.get(f"condition{i}", "").strip()
+                cond = (row.get(f"condition{i}") or "").strip()
                 if cond:
                     conditions.append(cond)
 
             if not conditions:
-                errors.append(f"行{row_num}: 条件が1つも指定されていません")
+                error_count += 1
+                add_row_error(errors, row_num, "条件が1つも指定されていません")
                 continue
 
-            action = row.get("action", "").strip()
+            action = (row.get("action") or "").strip()
             if not action:
-                errors.append(f"行{row_num}: actionが空です")
+                error_count += 1
+                add_row_error(errors, row_num, "actionが空です")
+                continue
+
+            operator = (row.get("operator") or "AND").strip().upper()
+            if operator not in ("AND", "OR"):
+                error_count += 1
+                add_row_error(errors, row_num, f"operatorはANDまたはORを指定してください: {operator}")
                 continue
 
-            operator = row.get("operator", "AND").strip().upper()
-            is_goal = row.get("is_goal", "FALSE").strip().upper() == "TRUE"
+            is_goal = (row.get("is_goal") or "FALSE").strip().upper() == "TRUE"
 
             new_rules.append({
                 "conditions": conditions,
@@ -206,10 +250,30 @@ async def import_rules_csv(file: UploadFile = File(...)):
             })
 
         except Exception as e:
-            errors.append(f"行{row_num}: {str(e)}")
+            error_count += 1
+            add_row_error(errors, row_num, str(e))
+
+    return new_rules, errors, error_count
+
+
+@router.post("/rules/import")
+async def import_rules_csv(file: UploadFile = File(...)):
+    """CSVファイルからルールをインポート"""
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="CSVファイルを選択してください")
+
+    # アップロードされたファイルを1行ずつ読み込む（BOM付きUTF-8 → Shift-JISの順に試す）
+    new_rules, errors, error_count = await run_in_threadpool(
+        parse_csv_upload, file.file, parse_rule_rows
+    )
 
-    if errors:
-        return {"status": "error", "errors": errors, "parsed_count": len(new_rules)}
+    if error_count:
+        return {
+            "status": "error",
+            "errors": errors,
+            "error_count": error_count,
+            "parsed_count": len(new_rules)
+        }
 
     # プレビューモード（実際には保存しない）
     return {
@@ -224,4 +288,5 @@ async def apply_imported_rules(request: ImportApplyRequest):
     """インポートしたルールを適用"""
     rules_data = {"rules": request.rules}
     save_rules(rules_data)
+    await notify_rules_updated()
     return {"status": "applied", "count": len(request.rules)}
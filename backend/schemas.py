@@ -2,7 +2,7 @@
 Pydantic スキーマ定義
 """
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 
 # ========== 診断関連 ==========
@@ -21,6 +21,11 @@ class GoBackRequest(BaseModel):
     steps: int = 1
 
 
+class WhatIfRequest(BaseModel):
+    session_id: str
+    scenarios: List[Dict[str, str]]  # シナリオごとに 条件 -> 回答（"yes", "no", "unknown"）
+
+
 # ========== ルール管理関連 ==========
 
 class RuleRequest(BaseModel):
@@ -0,0 +1,47 @@
+"""
+診断レスポンスに含める条件の補足
+"""
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, Query
+
+from core import RuleStatus
+from knowledge import get_notes
+
+
+# include_notes の値
+#   current: 現在の質問の補足（current_note）
+#   rules:   加えて、表示中（pending以外）のルールの条件の補足（notes、補足のある条件のみ）
+NOTE_SCOPES = ("current", "rules")
+
+
+def note_scope(
+    include_notes: Optional[str] = Query(None, description="補足を含める範囲（current / rules）")
+) -> Optional[str]:
+    """include_notes クエリパラメータ（診断のエンドポイントの依存関係）"""
+    if include_notes is not None and include_notes not in NOTE_SCOPES:
+        raise HTTPException(status_code=400, detail=f"Invalid include_notes: {include_notes}")
+    return include_notes
+
+
+def notes_response(engine, current_question: Optional[str], include_notes: Optional[str]) -> Dict[str, Any]:
+    """レスポンスに含める補足の項目（include_notes 未指定なら空）
+
+    補足はメモリ上のスナップショット（knowledge.notes）から読む。
+    """
+    if include_notes is None:
+        return {}
+    notes = get_notes()
+    response: Dict[str, Any] = {"current_note": notes.get(current_question, "") if current_question else ""}
+    if include_notes == "rules":
+        _, rule_status = engine.get_display_status_values()
+        visible = {}
+        for (_, _, _, conditions, _, _), status in zip(engine.knowledge_base.display_skeleton, rule_status):
+            if status == RuleStatus.PENDING.value:
+                continue
+            for cond, _ in conditions:
+                note = notes.get(cond)
+                if note:
+                    visible[cond] = note
+        response["notes"] = visible
+    return response
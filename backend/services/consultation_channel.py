@@ -0,0 +1,59 @@
+"""
+診断のWebSocketチャネル - 接続管理とルール状態の差分計算
+"""
+from typing import Any, Dict, List, Set
+
+from fastapi import WebSocket
+
+
+class RuleStatusTracker:
+    """接続ごとに最後に送ったルール状態を覚え、変化したルールだけを返す"""
+
+    def __init__(self):
+        self._last_sent: Dict[str, Dict[str, Any]] = {}
+
+    def reset(self):
+        self._last_sent.clear()
+
+    def changes(self, rules_status: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """前回から変化したルールの表示情報を返す"""
+        changed = []
+        for info in rules_status:
+            if self._last_sent.get(info["id"]) != info:
+                changed.append(info)
+                self._last_sent[info["id"]] = info
+        return changed
+
+
+class ChannelRegistry:
+    """セッションIDごとの接続中WebSocket"""
+
+    def __init__(self):
+        self._channels: Dict[str, Set[WebSocket]] = {}
+
+    def register(self, session_id: str, websocket: WebSocket):
+        self._channels.setdefault(session_id, set()).add(websocket)
+
+    def unregister(self, session_id: str, websocket: WebSocket):
+        channels = self._channels.get(session_id)
+        if channels is None:
+            return
+        channels.discard(websocket)
+        if not channels:
+            del self._channels[session_id]
+
+    @property
+    def connection_count(self) -> int:
+        return sum(len(c) for c in self._channels.values())
+
+    async def broadcast(self, message: Dict[str, Any]):
+        """全接続にメッセージを送る（送信に失敗した接続は無視する）"""
+        for channels in list(self._channels.values()):
+            for websocket in list(channels):
+                try:
+                    await websocket.send_json(message)
+                except Exception:
+                    pass
+
+
+channel_registry = ChannelRegistry()
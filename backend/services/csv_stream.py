@@ -0,0 +1,81 @@
+"""
+CSVのストリーミング出力と逐次読み込み
+"""
+import csv
+import io
+from typing import BinaryIO, Callable, Iterable, Iterator, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# 1チャンクにまとめる行数
+CSV_CHUNK_ROWS = 1000
+
+# インポート時に試す文字コード（BOM付きUTF-8 → Shift-JIS）
+CSV_ENCODINGS = ("utf-8-sig", "cp932")
+
+# レスポンスに含めるエラーの最大件数
+MAX_IMPORT_ERRORS = 100
+
+
+def iter_csv_chunks(
+    header: Sequence[str],
+    rows: Iterable[Sequence],
+    chunk_rows: int = CSV_CHUNK_ROWS
+) -> Iterator[bytes]:
+    """BOM付きUTF-8のCSVをチャンク単位で生成（全体をメモリに載せない）"""
+    buffer = io.StringIO()
+    buffer.write('\ufeff')  # BOM for Excel
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count >= chunk_rows:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _consume_with_encoding(
+    binary_file: BinaryIO,
+    encoding: str,
+    consume: Callable[[Iterator[Tuple[int, dict]]], T]
+) -> T:
+    binary_file.seek(0)
+    text = io.TextIOWrapper(binary_file, encoding=encoding, newline="")
+    try:
+        reader = csv.DictReader(text)
+        return consume(enumerate(reader, start=2))
+    finally:
+        # ラッパーを閉じても元のファイルは閉じない
+        text.detach()
+
+
+def parse_csv_upload(
+    binary_file: BinaryIO,
+    consume: Callable[[Iterator[Tuple[int, dict]]], T]
+) -> T:
+    """アップロードされたCSVを1行ずつ読み込む
+
+    consume には (行番号, 行dict) のイテレータが渡される。
+    文字コードの判定に失敗した場合は先頭から読み直すため、
+    consume は呼び出しのたびに集計を初期化すること。
+    """
+    for encoding in CSV_ENCODINGS[:-1]:
+        try:
+            return _consume_with_encoding(binary_file, encoding, consume)
+        except UnicodeDecodeError:
+            continue
+    return _consume_with_encoding(binary_file, CSV_ENCODINGS[-1], consume)
+
+
+def add_row_error(errors: list, row_num: int, message: str) -> None:
+    """行単位のエラーを追加（上限を超えた分は保持しない）"""
+    if len(errors) < MAX_IMPORT_ERRORS:
+        errors.append(f"行{row_num}: {message}")
@@ -0,0 +1,99 @@
+"""
+rules_status のJSONエンコード - 知識ベースごとにエンコード済みの断片を使う
+
+rules_status はルール数×条件数の入れ子で、1レスポンスの大半を占める。
+セッションによって変わるのはステータスの文字列だけなので、それ以外の部分を
+知識ベースごとにJSON文字列の断片として1回だけ作り、ステータスだけを挟んで連結する。
+"""
+import json
+import threading
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import Response
+
+from knowledge import CompiledKnowledgeBase
+from .http_cache import encode_json
+
+
+# (ルール先頭, [(条件, 条件先頭, 条件末尾), ...], ルール末尾の前半, ルール末尾の後半)
+_RuleFragments = Tuple[str, List[Tuple[str, str, str]], str, str]
+
+_fragments: "weakref.WeakKeyDictionary[CompiledKnowledgeBase, List[_RuleFragments]]" = weakref.WeakKeyDictionary()
+_fragments_lock = threading.Lock()
+
+# payloadの rules_status をこの値にすると、consultation_response がエンコード済みの断片から作る
+DEFERRED_RULES_STATUS = "\x00rules_status\x00"
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def _build_fragments(kb: CompiledKnowledgeBase) -> List[_RuleFragments]:
+    fragments = []
+    for rule_id, index, action, conditions, is_and_rule, operator in kb.display_skeleton:
+        head = f'{{"id":{_dumps(rule_id)},"index":{index},"action":{_dumps(action)},"conditions":['
+        conds = [
+            (cond, f'{{"text":{_dumps(cond)},"status":"', f'","is_derived":{_dumps(is_derived)}}}')
+            for cond, is_derived in conditions
+        ]
+        tail_head = f'],"conclusion":{_dumps(action)},"status":"'
+        tail = f'","is_and_rule":{_dumps(is_and_rule)},"operator":{_dumps(operator)}}}'
+        fragments.append((head, conds, tail_head, tail))
+    return fragments
+
+
+def _get_fragments(kb: CompiledKnowledgeBase) -> List[_RuleFragments]:
+    with _fragments_lock:
+        fragments = _fragments.get(kb)
+        if fragments is None:
+            fragments = _fragments[kb] = _build_fragments(kb)
+        return fragments
+
+
+def encode_rules_status(engine) -> str:
+    """get_rules_display_info() をJSONにしたものと同じ文字列を、dictを作らずに生成"""
+    condition_status, rule_status = engine.get_display_status_values()
+    parts = ["["]
+    for i, (head, conds, tail_head, tail) in enumerate(_get_fragments(engine.knowledge_base)):
+        if i:
+            parts.append(",")
+        parts.append(head)
+        for j, (cond, cond_head, cond_tail) in enumerate(conds):
+            if j:
+                parts.append(",")
+            parts.append(cond_head)
+            parts.append(condition_status[cond])
+            parts.append(cond_tail)
+        parts.append(tail_head)
+        parts.append(rule_status[i])
+        parts.append(tail)
+    parts.append("]")
+    return "".join(parts)
+
+
+def consultation_response(payload: Dict[str, Any], engine: Optional[Any] = None) -> Response:
+    """診断のレスポンスをエンコードして返す
+
+    payloadの rules_status が DEFERRED_RULES_STATUS なら、engineの状態から
+    エンコード済みの断片で rules_status を作って差し込む（キーの順序は保つ）。
+    rules_status の前後のキーを別々にエンコードして連結するので、他の値
+    （クライアントが送ったsession_idなど）の内容には影響されない。
+    """
+    if engine is None or payload.get("rules_status") is not DEFERRED_RULES_STATUS:
+        return Response(content=encode_json(payload), media_type="application/json")
+
+    keys = list(payload)
+    position = keys.index("rules_status")
+    before = encode_json({k: payload[k] for k in keys[:position]})
+    after = encode_json({k: payload[k] for k in keys[position + 1:]})
+    parts = [before[:-1]]
+    if position:
+        parts.append(b",")
+    parts.append(b'"rules_status":')
+    parts.append(encode_rules_status(engine).encode("utf-8"))
+    if len(after) > 2:
+        parts.append(b",")
+    parts.append(after[1:])
+    return Response(content=b"".join(parts), media_type="application/json")
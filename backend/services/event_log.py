@@ -0,0 +1,219 @@
+"""
+診断イベントログ - 開始・回答・戻る・完了などを追記専用のJSON Linesファイルに記録する
+
+リクエスト処理中はメモリ上のキューに積むだけで、ファイルへの書き込みは
+バックグラウンドのスレッドがまとめて行う（件数または時間で書き出す）。
+書き込みが追いつかずキューが一杯になった場合は、書き込み側を起こしたうえで
+そのイベントを捨てて件数を数え、警告をログに出す（記録はasyncのルートから呼ばれるので、
+待つとイベントループ全体が止まり、同じワーカーの全リクエストが遅れる）。
+件数は stats()（GET /api/admin/events）で確認できる。
+
+環境変数:
+    EVENT_LOG_DIR: 出力先ディレクトリ（デフォルト: backend/data/events）
+    EVENT_LOG_ENABLED: "0" で記録しない
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
+
+from knowledge.loader import DATA_DIR
+
+
+EVENT_LOG_DIR = os.environ.get("EVENT_LOG_DIR", os.path.join(DATA_DIR, "events"))
+EVENT_LOG_ENABLED = os.environ.get("EVENT_LOG_ENABLED", "1") != "0"
+
+EVENT_LOG_FILE = "consultation_events.jsonl"
+
+BATCH_SIZE = 200             # この件数たまったら書き出す
+FLUSH_INTERVAL = 1.0         # 最後の書き出しからこの秒数たったら書き出す
+MAX_PENDING = 10000          # キューの上限
+MAX_FILE_BYTES = 50 * 1024 * 1024  # これを超えたらローテーション
+MAX_ROTATED_FILES = 10       # 残しておくローテーション済みファイル数
+DROP_WARNING_INTERVAL = 10.0  # イベントを捨てた警告をログに出す最短の間隔（秒）
+
+logger = logging.getLogger(__name__)
+
+
+class EventLog:
+    """バックグラウンドでまとめて書き出す追記専用のイベントログ"""
+
+    def __init__(self, directory: str = EVENT_LOG_DIR, enabled: bool = EVENT_LOG_ENABLED):
+        self.directory = directory
+        self.enabled = enabled
+        self._pending: Deque[Dict[str, Any]] = deque()
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+        self._closed = False
+        self._flush_requested = False
+        self._in_flight = 0
+        self.written = 0
+        self.dropped = 0
+        self._next_drop_warning = 0.0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.directory, EVENT_LOG_FILE)
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name="event-log-writer", daemon=True)
+            self._writer.start()
+
+    def record(self, event_type: str, session_id: str, **data) -> bool:
+        """イベントをキューに積む（待たない）
+
+        Returns:
+            積めたかどうか（キューが一杯ならFalse）
+        """
+        if not self.enabled:
+            return False
+        event = {
+            "ts": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "type": event_type,
+            "session_id": session_id,
+            **data,
+        }
+        with self._cond:
+            if self._closed:
+                return False
+            self._ensure_writer()
+            if len(self._pending) < MAX_PENDING:
+                self._pending.append(event)
+                if len(self._pending) >= BATCH_SIZE:
+                    self._cond.notify_all()
+                return True
+            # 書き込み側にすぐ書き出させ、このイベントは捨てる
+            self._flush_requested = True
+            self._cond.notify_all()
+            self.dropped += 1
+        self._warn_dropped("event queue is full")
+        return False
+
+    def _warn_dropped(self, reason: str):
+        """イベントを捨てたことを警告する（DROP_WARNING_INTERVAL に1回まで）"""
+        now = time.monotonic()
+        with self._cond:
+            if now < self._next_drop_warning:
+                return
+            self._next_drop_warning = now + DROP_WARNING_INTERVAL
+            dropped = self.dropped
+        logger.warning("Consultation events dropped (%s); %d dropped in total", reason, dropped)
+
+    def _take_batch(self) -> List[Dict[str, Any]]:
+        """書き出すイベントを取り出す（件数・時間・終了要求のいずれかまで待つ）"""
+        with self._cond:
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while not (self._closed or self._flush_requested or len(self._pending) >= BATCH_SIZE):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = list(self._pending)
+            self._pending.clear()
+            self._in_flight = len(batch)
+            self._flush_requested = False
+            self._cond.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take_batch()
+            if batch:
+                try:
+                    self._write(batch)
+                except OSError as e:
+                    # 書き込めなかった分は失われる（診断の処理は止めない）
+                    with self._cond:
+                        self.dropped += len(batch)
+                    self._warn_dropped(f"write failed: {e}")
+            with self._cond:
+                self._in_flight = 0
+                self._cond.notify_all()
+                if self._closed and not self._pending:
+                    return
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        os.makedirs(self.directory, exist_ok=True)
+        data = "".join(json.dumps(e, ensure_ascii=False, separators=(",", ":")) + "\n" for e in batch)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            size = f.tell()
+        self.written += len(batch)
+        if size >= MAX_FILE_BYTES:
+            self._rotate()
+
+    def _rotate(self):
+        """現在のファイルをタイムスタンプ付きの名前に変え、古いものを削除
+
+        複数のワーカーが同じファイルに書いている場合は、別のワーカーが先に
+        ローテーション・削除していることがある（その場合は何もしない）。
+        """
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S%f")
+        base, ext = os.path.splitext(EVENT_LOG_FILE)
+        try:
+            os.replace(self.path, os.path.join(self.directory, f"{base}.{stamp}{ext}"))
+        except FileNotFoundError:
+            return
+
+        rotated = sorted(
+            f for f in os.listdir(self.directory)
+            if f.startswith(base + ".") and f.endswith(ext) and f != EVENT_LOG_FILE
+        )
+        for name in rotated[:-MAX_ROTATED_FILES]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def flush(self, timeout: float = 5.0):
+        """キューに残っているイベントを書き出すまで待つ"""
+        with self._cond:
+            if self._writer is None:
+                return
+            self._flush_requested = True
+            self._cond.notify_all()
+            self._cond.wait_for(
+                lambda: not self._pending and not self._flush_requested and not self._in_flight, timeout
+            )
+
+    def close(self, timeout: float = 5.0):
+        """残りを書き出して書き込みスレッドを止める"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            writer = self._writer
+        if writer is not None:
+            writer.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            pending = len(self._pending)
+        return {"pending": pending, "written": self.written, "dropped": self.dropped}
+
+
+event_log = EventLog()
+
+
+def result_event_data(result: Dict[str, Any]) -> Dict[str, Any]:
+    """InferenceEngine の結果（answer_question / go_back / get_current_state）から記録する項目"""
+    data = {
+        "next_question": result.get("next_question", result.get("current_question")),
+        "is_complete": result.get("is_complete", False),
+    }
+    if "derived_facts" in result:
+        data["derived_fact_count"] = len(result["derived_facts"])
+    return data
+
+
+def completion_event_data(diagnosis_result: Dict[str, Any]) -> Dict[str, Any]:
+    """診断結果から完了イベントに記録する項目（推論ログは含めない）"""
+    return {
+        "applicable_visas": [v["visa"] for v in diagnosis_result.get("applicable_visas", [])],
+        "conditional_visas": [v["visa"] for v in diagnosis_result.get("conditional_visas", [])],
+        "unknown_conditions": diagnosis_result.get("unknown_conditions", []),
+    }
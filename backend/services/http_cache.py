@@ -0,0 +1,131 @@
+"""
+条件付きGET（ETag / If-None-Match）とレスポンスキャッシュ
+"""
+import hashlib
+import json
+import threading
+from typing import Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+
+# エンドポイント名 -> (データのバージョン, エンコード済みbody, ETag)
+_response_cache: Dict[str, Tuple[Hashable, bytes, str]] = {}
+# エンドポイント名 -> (データのバージョン, ETag)  ストリーミング応答用（bodyは保持しない）
+_etag_cache: Dict[str, Tuple[Hashable, str]] = {}
+_cache_lock = threading.Lock()
+
+
+def encode_json(payload) -> bytes:
+    """FastAPIのJSONResponseと同じ形式でエンコード"""
+    return json.dumps(
+        payload,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def make_etag(body: bytes) -> str:
+    """bodyの内容から強いETagを生成（ワーカー間でも同じ値になる）"""
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match ヘッダーがETagに一致するか（弱い比較）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+
+def get_cached_body(name: str, version: Hashable, build: Callable[[], bytes]) -> Tuple[bytes, str]:
+    """バージョンごとにエンコード済みbodyとETagをキャッシュして返す"""
+    with _cache_lock:
+        entry = _response_cache.get(name)
+    if entry is not None and entry[0] == version:
+        return entry[1], entry[2]
+
+    body = build()
+    etag = make_etag(body)
+    with _cache_lock:
+        _response_cache[name] = (version, body, etag)
+    return body, etag
+
+
+def conditional_response(
+    request: Request,
+    name: str,
+    version: Hashable,
+    build: Callable[[], bytes],
+    media_type: str = "application/json",
+    headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """キャッシュ済みbodyを返す。If-None-Matchが一致すれば304を返す
+
+    Args:
+        name: キャッシュのキー（エンドポイント名）
+        version: データのバージョン（変わったらbodyを作り直す）
+        build: bodyを生成する関数
+    """
+    body, etag = get_cached_body(name, version, build)
+    response_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=response_headers)
+
+    if headers:
+        response_headers.update(headers)
+    return Response(content=body, media_type=media_type, headers=response_headers)
+
+
+def get_stream_etag(name: str, version: Hashable, make_chunks: Callable[[], Iterable[bytes]]) -> str:
+    """バージョンごとにストリームの内容からETagを計算してキャッシュ
+
+    チャンクを順にハッシュするだけなので、body全体はメモリに載せない。
+    """
+    with _cache_lock:
+        entry = _etag_cache.get(name)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+
+    hasher = hashlib.blake2b(digest_size=16)
+    for chunk in make_chunks():
+        hasher.update(chunk)
+    etag = '"' + hasher.hexdigest() + '"'
+    with _cache_lock:
+        _etag_cache[name] = (version, etag)
+    return etag
+
+
+def conditional_stream_response(
+    request: Request,
+    name: str,
+    version: Hashable,
+    make_chunks: Callable[[], Iterable[bytes]],
+    media_type: str,
+    headers: Optional[Dict[str, str]] = None
+) -> Response:
+    """大きなbodyをストリーミングで返す。If-None-Matchが一致すれば304を返す
+
+    Args:
+        make_chunks: 呼び出すたびに新しいチャンクのイテレータを返す関数
+    """
+    etag = get_stream_etag(name, version, make_chunks)
+    response_headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=response_headers)
+
+    if headers:
+        response_headers.update(headers)
+    return StreamingResponse(make_chunks(), media_type=media_type, headers=response_headers)
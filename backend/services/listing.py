@@ -0,0 +1,138 @@
+"""
+ルール一覧のページ分割・絞り込み・フィールド指定のパラメータ
+"""
+import base64
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, Query
+
+from core import RuleQuery, RuleStatus
+from .display_json import DEFERRED_RULES_STATUS
+
+
+# GET /api/rules で指定できるフィールド
+RULE_FIELDS = {"conditions", "action", "is_or_rule", "is_goal_action"}
+
+# 診断の rules_status で指定できるフィールド
+RULE_STATUS_FIELDS = {"id", "action", "conditions", "conclusion", "status", "is_and_rule", "operator"}
+
+RULE_STATUS_VALUES = {s.value for s in RuleStatus}
+
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(key: str, after: int) -> str:
+    """次のページのカーソル（知識ベースの内容ハッシュと位置）"""
+    return base64.urlsafe_b64encode(f"{key}:{after}".encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """カーソルを (内容ハッシュ, 位置) に戻す
+
+    Raises:
+        ValueError: 形式が正しくない場合
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        key, after = base64.urlsafe_b64decode(padded.encode("ascii")).decode("ascii").rsplit(":", 1)
+        return key, int(after)
+    except (ValueError, UnicodeError) as e:
+        raise ValueError(f"invalid cursor: {cursor}") from e
+
+
+def parse_fields(fields: Optional[str], allowed: Set[str]) -> Optional[Set[str]]:
+    """カンマ区切りのフィールド指定を解析（未指定ならNone=全て）"""
+    if not fields:
+        return None
+    result = {f.strip() for f in fields.split(",") if f.strip()}
+    unknown = result - allowed
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown field: {sorted(unknown)[0]}")
+    return result
+
+
+def _cursor_position(cursor: Optional[str], content_hash: str) -> int:
+    if not cursor:
+        return -1
+    try:
+        key, after = decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if key != content_hash:
+        # ページの途中でルールが変わった（最初から取り直す必要がある）
+        raise HTTPException(status_code=409, detail="Rules changed since the cursor was issued")
+    return after
+
+
+class RulesStatusParams:
+    """診断レスポンスの rules_status を絞り込むクエリパラメータ
+
+    どれも指定しなければ従来どおり全ルール・全フィールドを返す。
+    """
+
+    def __init__(
+        self,
+        rules_fields: Optional[str] = Query(None, description="返すフィールド（カンマ区切り）"),
+        rules_goal_only: bool = Query(False, description="ゴールルールのみ"),
+        rules_status: Optional[List[str]] = Query(None, description="ルールの評価状態（複数指定可）"),
+        rules_action_prefix: Optional[str] = Query(None, description="結論の前方一致"),
+        rules_limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="最大件数"),
+        rules_cursor: Optional[str] = Query(None, description="前のレスポンスの rules_next_cursor"),
+    ):
+        self.fields = rules_fields
+        self.goal_only = rules_goal_only
+        self.statuses = rules_status
+        self.action_prefix = rules_action_prefix
+        self.limit = rules_limit
+        self.cursor = rules_cursor
+
+    @property
+    def is_default(self) -> bool:
+        return not (self.fields or self.goal_only or self.statuses or self.action_prefix
+                    or self.limit or self.cursor)
+
+    def to_query(self, content_hash: str) -> Optional[RuleQuery]:
+        """RuleQueryに変換（指定がなければNone）"""
+        if self.is_default:
+            return None
+        if self.statuses:
+            invalid = [s for s in self.statuses if s not in RULE_STATUS_VALUES]
+            if invalid:
+                raise HTTPException(status_code=400, detail=f"Invalid rule status: {invalid[0]}")
+        return RuleQuery(
+            goal_only=self.goal_only,
+            statuses=set(self.statuses) if self.statuses else None,
+            action_prefix=self.action_prefix,
+            fields=parse_fields(self.fields, RULE_STATUS_FIELDS),
+            after=_cursor_position(self.cursor, content_hash),
+            limit=self.limit,
+        )
+
+
+def rules_status_response(result: Dict[str, Any], content_hash: str) -> Dict[str, Any]:
+    """エンジンの結果の rules_next_after をカーソルに置き換えたレスポンス項目
+
+    結果に rules_status がなければ（include_rules_status=False）、
+    consultation_response でエンコード済みの断片から作るよう目印を置く。
+    """
+    if "rules_status" not in result:
+        return {"rules_status": DEFERRED_RULES_STATUS}
+    response = {"rules_status": result["rules_status"]}
+    if "rules_next_after" in result:
+        after = result["rules_next_after"]
+        response["rules_next_cursor"] = encode_cursor(content_hash, after) if after is not None else None
+    return response
+
+
+def rule_list_query(
+    goal_only: bool, action_prefix: Optional[str], fields: Optional[str],
+    limit: Optional[int], cursor: Optional[str], content_hash: str
+) -> RuleQuery:
+    """GET /api/rules のパラメータからRuleQueryを作る"""
+    return RuleQuery(
+        goal_only=goal_only,
+        action_prefix=action_prefix,
+        fields=parse_fields(fields, RULE_FIELDS),
+        after=_cursor_position(cursor, content_hash),
+        limit=limit,
+    )
@@ -0,0 +1,215 @@
+"""
+全文検索インデックス - 文字n-gramによるルール・条件・補足の検索
+
+日本語を形態素解析なしで扱えるよう、正規化（NFKC・小文字化）した文字列の
+2文字のn-gram（1文字のクエリは1文字）で転置インデックスを作る。
+ルールや補足が変わったときは、内容が変わった文書だけを登録し直す。
+"""
+import math
+import threading
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, Hashable, List, Mapping, Optional, Tuple
+
+from knowledge import get_knowledge_base, get_rules_version, get_notes, get_notes_version
+
+
+NGRAM_SIZE = 2
+
+# 完全一致（部分文字列として含む）の文書を優先するための加点
+SUBSTRING_BONUS = 10.0
+
+
+def normalize_text(text: str) -> str:
+    """検索用の正規化（全角英数→半角、大文字→小文字、空白の除去）"""
+    return "".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def ngrams(text: str, n: int = NGRAM_SIZE) -> List[str]:
+    """正規化済み文字列のn-gram（n文字未満ならそのまま1つ）"""
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+
+class NgramIndex:
+    """フィールドごとに重みを持つn-gram転置インデックス
+
+    文書はフィールド名 -> テキストのdict。同じ文書IDで登録し直すと置き換える。
+    """
+
+    def __init__(self, field_weights: Mapping[str, float]):
+        self.field_weights = dict(field_weights)
+        self._postings: Dict[str, Dict[Hashable, float]] = {}
+        self._unigrams: Dict[str, Dict[Hashable, float]] = {}
+        self._documents: Dict[Hashable, Dict[str, str]] = {}
+        self._normalized: Dict[Hashable, Dict[str, str]] = {}
+        self._lengths: Dict[Hashable, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def __contains__(self, doc_id: Hashable) -> bool:
+        return doc_id in self._documents
+
+    def document(self, doc_id: Hashable) -> Optional[Dict[str, str]]:
+        return self._documents.get(doc_id)
+
+    def doc_ids(self) -> List[Hashable]:
+        return list(self._documents)
+
+    def _doc_terms(self, normalized: Mapping[str, str]) -> Tuple[Counter, Counter]:
+        bigrams: Counter = Counter()
+        unigrams: Counter = Counter()
+        for field, text in normalized.items():
+            weight = self.field_weights.get(field, 1.0)
+            for gram in ngrams(text):
+                bigrams[gram] += weight
+            for ch in text:
+                unigrams[ch] += weight
+        return bigrams, unigrams
+
+    def add(self, doc_id: Hashable, fields: Mapping[str, str]):
+        """文書を登録（同じIDがあれば置き換え）"""
+        if self._documents.get(doc_id) == fields:
+            return
+        self.remove(doc_id)
+
+        normalized = {f: normalize_text(t) for f, t in fields.items() if t}
+        bigrams, unigrams = self._doc_terms(normalized)
+        for gram, tf in bigrams.items():
+            self._postings.setdefault(gram, {})[doc_id] = tf
+        for ch, tf in unigrams.items():
+            self._unigrams.setdefault(ch, {})[doc_id] = tf
+
+        self._documents[doc_id] = dict(fields)
+        self._normalized[doc_id] = normalized
+        self._lengths[doc_id] = sum(len(t) for t in normalized.values())
+
+    def remove(self, doc_id: Hashable):
+        """文書を削除（なければ何もしない）"""
+        normalized = self._normalized.pop(doc_id, None)
+        if normalized is None:
+            return
+        bigrams, unigrams = self._doc_terms(normalized)
+        for table, terms in ((self._postings, bigrams), (self._unigrams, unigrams)):
+            for term in terms:
+                docs = table.get(term)
+                if docs is not None:
+                    docs.pop(doc_id, None)
+                    if not docs:
+                        del table[term]
+        del self._documents[doc_id]
+        del self._lengths[doc_id]
+
+    def search(self, query: str) -> List[Tuple[Hashable, float]]:
+        """クエリのn-gramを全て含む文書を、スコアの高い順に返す
+
+        スコアはn-gramごとの tf-idf の和を文書の長さで割ったもの。
+        クエリ全体を部分文字列として含む文書には加点する。
+        """
+        normalized = normalize_text(query)
+        if not normalized:
+            return []
+        if len(normalized) < NGRAM_SIZE:
+            table, terms = self._unigrams, [normalized]
+        else:
+            table, terms = self._postings, list(dict.fromkeys(ngrams(normalized)))
+
+        postings = [table.get(term) for term in terms]
+        if any(p is None for p in postings):
+            return []
+        postings.sort(key=len)
+
+        candidates = set(postings[0])
+        for docs in postings[1:]:
+            candidates.intersection_update(docs)
+            if not candidates:
+                return []
+
+        total = len(self._documents)
+        idf = [math.log(1 + total / len(docs)) for docs in postings]
+        results = []
+        for doc_id in candidates:
+            score = sum(docs[doc_id] * w for docs, w in zip(postings, idf))
+            score /= math.sqrt(self._lengths[doc_id] or 1)
+            for field, text in self._normalized[doc_id].items():
+                if normalized in text:
+                    score += SUBSTRING_BONUS * self.field_weights.get(field, 1.0)
+                    break
+            results.append((doc_id, score))
+
+        results.sort(key=lambda r: -r[1])
+        return results
+
+
+class SearchIndexes:
+    """ルールと条件の検索インデックス（バージョンが変わったら差分だけ登録し直す）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # ルール: action -> {action, conditions}
+        self.rules = NgramIndex({"action": 2.0, "conditions": 1.0})
+        # 条件: 条件文 -> {text, note}
+        self.conditions = NgramIndex({"text": 2.0, "note": 1.0})
+        self._rules_version = None
+        self._conditions_version = None
+
+    def _sync_rules(self):
+        version = get_rules_version()
+        if version == self._rules_version:
+            return
+        kb = get_knowledge_base()
+        # 条件の境目をまたぐn-gramができないよう区切り文字を挟む
+        documents = {
+            action: {
+                "action": action,
+                "conditions": " | ".join(c for i in indices for c in kb.rules[i].conditions),
+            }
+            for action, indices in kb.rules_by_action.items()
+        }
+        self._apply(self.rules, documents)
+        self._rules_version = version
+
+    def _sync_conditions(self):
+        version = (get_rules_version(), get_notes_version())
+        if version == self._conditions_version:
+            return
+        notes = get_notes()
+        documents = {
+            cond: {"text": cond, "note": notes.get(cond, "")}
+            for cond in get_knowledge_base().rules_by_condition
+        }
+        self._apply(self.conditions, documents)
+        self._conditions_version = version
+
+    @staticmethod
+    def _apply(index: NgramIndex, documents: Dict[str, Dict[str, str]]):
+        """変わった文書だけを登録・削除"""
+        for doc_id in [d for d in index.doc_ids() if d not in documents]:
+            index.remove(doc_id)
+        for doc_id, fields in documents.items():
+            index.add(doc_id, fields)
+
+    def search_rules(self, query: str) -> List[Tuple[str, float]]:
+        with self._lock:
+            self._sync_rules()
+            return self.rules.search(query)
+
+    def search_conditions(self, query: str) -> List[Tuple[str, float]]:
+        with self._lock:
+            self._sync_conditions()
+            return self.conditions.search(query)
+
+
+search_indexes = SearchIndexes()
+
+
+def paginate(results: List[Any], offset: int, limit: int) -> Dict[str, Any]:
+    """検索結果のページ情報"""
+    return {
+        "total": len(results),
+        "offset": offset,
+        "limit": limit,
+        "has_more": offset + limit < len(results),
+    }
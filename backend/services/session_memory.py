@@ -0,0 +1,197 @@
+"""
+セッションのメモリ使用量 - 診断セッションごとのおおよその大きさと tracemalloc のスナップショット比較
+
+セッションの大きさは sys.getsizeof を参照先までたどって合計したもの。
+知識ベース（Rule・条件文・結論）と列挙型の値は全セッションで共有しているので数えない。
+
+環境変数:
+    MEMORY_SNAPSHOTS: "1" なら tracemalloc のスナップショットを取る・止めるAPIを登録する（デフォルトは "0"）
+"""
+import hashlib
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import OrderedDict
+from enum import Enum
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from core import Rule
+from knowledge import CompiledKnowledgeBase
+
+
+# セッションの大きさの内訳
+MEMORY_COMPONENTS = ("working_memory", "rule_states", "checked_conditions", "reasoning_log")
+
+MAX_SNAPSHOTS = 10  # 保持しておく tracemalloc のスナップショット数
+
+MEMORY_SNAPSHOTS_ENABLED = os.environ.get("MEMORY_SNAPSHOTS", "0") == "1"
+
+SESSION_HASH_LENGTH = 12  # レポートに出すセッションIDのハッシュの桁数
+
+_shared_ids: "weakref.WeakKeyDictionary[CompiledKnowledgeBase, FrozenSet[int]]" = weakref.WeakKeyDictionary()
+_shared_ids_lock = threading.Lock()
+
+
+def _knowledge_base_ids(kb: CompiledKnowledgeBase) -> FrozenSet[int]:
+    """知識ベースが持っている文字列（セッションと共有するもの）のid"""
+    with _shared_ids_lock:
+        ids = _shared_ids.get(kb)
+        if ids is None:
+            objects = []
+            for rule in kb.rules:
+                objects.append(rule.id)
+                objects.append(rule.action)
+                objects.extend(rule.conditions)
+            objects.extend(kb.rules_by_condition)
+            ids = _shared_ids[kb] = frozenset(id(o) for o in objects)
+        return ids
+
+
+def deep_sizeof(obj: Any, seen: set, shared_ids: FrozenSet[int] = frozenset()) -> int:
+    """objから参照をたどった合計サイズ（seenにあるもの・共有しているものは数えない）"""
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        oid = id(o)
+        if oid in seen or oid in shared_ids:
+            continue
+        seen.add(oid)
+        if isinstance(o, (Rule, Enum)):
+            continue
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+    return size
+
+
+def session_footprint(engine) -> Dict[str, int]:
+    """1セッション（InferenceEngine）のおおよその大きさ（バイト）の内訳
+
+    checked_conditions は rule_states の中にあるが、内訳では分けて数える。
+    """
+    shared = _knowledge_base_ids(engine.knowledge_base)
+    seen: set = set()
+    footprint = {
+        "working_memory": deep_sizeof(engine.working_memory, seen, shared),
+        "checked_conditions": sum(
+            deep_sizeof(state.checked_conditions, seen, shared) for state in engine.rule_states.values()
+        ),
+        "rule_states": deep_sizeof(engine.rule_states, seen, shared),
+        "reasoning_log": deep_sizeof(engine.reasoning_log, seen, shared),
+    }
+    footprint = {name: footprint[name] for name in MEMORY_COMPONENTS}
+    footprint["total"] = sum(footprint.values())
+    return footprint
+
+
+def session_hash(session_id: str) -> str:
+    """レポート用のセッションの識別子（セッションIDそのものは出さない）"""
+    return hashlib.blake2b(session_id.encode("utf-8"), digest_size=16).hexdigest()[:SESSION_HASH_LENGTH]
+
+
+def sessions_memory_report(sessions: Iterable[Tuple[str, Any]], top: int = 10) -> Dict[str, Any]:
+    """全セッションの大きさの集計と、大きい順に top 件（セッションはIDのハッシュで示す）"""
+    entries = []
+    totals = dict.fromkeys(MEMORY_COMPONENTS + ("total",), 0)
+    for session_id, engine in sessions:
+        footprint = session_footprint(engine)
+        for name, size in footprint.items():
+            totals[name] += size
+        entries.append({
+            "session_hash": session_hash(session_id),
+            "answered_questions": len(engine.working_memory.answer_history),
+            "reasoning_log_entries": len(engine.reasoning_log),
+            "rules_hash": engine.knowledge_base.content_hash,
+            "bytes": footprint,
+        })
+
+    entries.sort(key=lambda e: -e["bytes"]["total"])
+    count = len(entries)
+    return {
+        "session_count": count,
+        "total_bytes": totals,
+        "average_bytes": {name: size // count for name, size in totals.items()} if count else None,
+        "largest_sessions": entries[:top],
+    }
+
+
+class MemorySnapshots:
+    """tracemalloc のスナップショットを取り、2時点の差分を出す
+
+    最初のスナップショットで tracemalloc を開始する（計測中は処理が遅くなるので、
+    使い終わったら stop() で止める）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshots: "OrderedDict[int, Tuple[Dict[str, Any], tracemalloc.Snapshot]]" = OrderedDict()
+        self._next_id = 1
+
+    def take(self, label: Optional[str] = None) -> Dict[str, Any]:
+        """スナップショットを取る（古いものから MAX_SNAPSHOTS を超えた分は捨てる）"""
+        with self._lock:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            info = {
+                "id": self._next_id,
+                "label": label,
+                "taken_at": time.time(),
+                "traced_bytes": current,
+                "traced_peak_bytes": peak,
+            }
+            self._snapshots[self._next_id] = (info, snapshot)
+            self._next_id += 1
+            while len(self._snapshots) > MAX_SNAPSHOTS:
+                self._snapshots.popitem(last=False)
+            return info
+
+    def list(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [info for info, _ in self._snapshots.values()]
+
+    def diff(self, before_id: int, after_id: int, limit: int = 20) -> Dict[str, Any]:
+        """2つのスナップショットの差分（増えたサイズの大きい順に limit 件、ソースの行ごと）
+
+        Raises:
+            KeyError: スナップショットがない場合
+        """
+        with self._lock:
+            before_info, before = self._snapshots[before_id]
+            after_info, after = self._snapshots[after_id]
+        stats = after.compare_to(before, "lineno")
+        return {
+            "before": before_info,
+            "after": after_info,
+            "size_diff": sum(s.size_diff for s in stats),
+            "top": [
+                {
+                    "location": str(s.traceback[0]) if s.traceback else None,
+                    "size_diff": s.size_diff,
+                    "count_diff": s.count_diff,
+                    "size": s.size,
+                    "count": s.count,
+                }
+                for s in stats[:limit]
+            ],
+        }
+
+    def stop(self):
+        """スナップショットを捨てて tracemalloc を止める"""
+        with self._lock:
+            self._snapshots.clear()
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+
+
+memory_snapshots = MemorySnapshots()
@@ -0,0 +1,152 @@
+"""
+署名付きセッショントークン - 診断の状態をサーバーに持たずにクライアントに預ける
+
+SESSION_MODE=token のとき、診断の状態（知識ベースの版と回答の並び）を
+HMACで署名したトークンにしてレスポンスごとに返し、クライアントは次のリクエストで
+それを送り返す。サーバーはトークンの回答を再生してエンジンを復元するので、
+どのワーカーでもリクエストを処理でき、セッションごとのメモリを持たない。
+再生は回答の並びの先頭部分ごとのキャッシュ（engine/whatif.py）から続きだけを行う。
+
+環境変数:
+    SESSION_MODE: "memory"（デフォルト、サーバー側のsessions）または "token"
+    SESSION_TOKEN_SECRET: 署名の鍵（token のときは必須。全ワーカーで同じ値にする）
+"""
+import base64
+import hashlib
+import hmac
+import os
+from typing import List, Optional, Sequence, Tuple
+
+from engine import InferenceEngine, snapshot_for_answers, answers_of, remember_snapshot
+from knowledge import CompiledKnowledgeBase, get_knowledge_base, rulebase_versions
+
+
+SESSION_MODE = os.environ.get("SESSION_MODE", "memory")
+SESSION_TOKEN_SECRET = os.environ.get("SESSION_TOKEN_SECRET", "")
+SESSION_TOKENS_ENABLED = SESSION_MODE == "token"
+
+TOKEN_VERSION = "v1"
+SIGNATURE_BYTES = 16
+MAX_TOKEN_ANSWERS = 200  # 再生の上限（質問数はこれより十分少ない）
+
+# 回答 <-> トークン中の1文字
+ANSWER_CODES = {"yes": "y", "no": "n", "unknown": "u"}
+ANSWERS_BY_CODE = {code: answer for answer, code in ANSWER_CODES.items()}
+
+
+class SessionTokenError(Exception):
+    """トークンが不正（形式違い・署名不一致・別セッションのもの）"""
+    pass
+
+
+class RulebaseNotAvailableError(SessionTokenError):
+    """トークンの知識ベースの版がこのワーカーにない（ルールが変わった）"""
+    pass
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode("ascii").rstrip("=")
+
+
+def _b64decode(text: str) -> bytes:
+    return base64.urlsafe_b64decode((text + "=" * (-len(text) % 4)).encode("ascii"))
+
+
+class SessionTokens:
+    """セッショントークンの発行と、トークンからのエンジンの復元
+
+    トークンは "v1.<内容>.<署名>"。内容は「内容ハッシュ:条件番号と回答の並び」で、
+    条件番号は16進、回答は y / n / u の1文字（例: "3f..:1ay.7n.2u"）。
+    「戻る」の後は、最後に戻った時点の回答数（16進）を末尾に付ける（例: "3f..:1ay.7n.2u:2"）。
+    署名はセッションIDも含めて計算するので、別のセッションのトークンは使えない。
+    """
+
+    def __init__(self, secret: str):
+        self._key = secret.encode("utf-8")
+
+    def _sign(self, session_id: str, body: str) -> str:
+        message = f"{TOKEN_VERSION}.{session_id}.{body}".encode("utf-8")
+        return _b64encode(hmac.new(self._key, message, hashlib.sha256).digest()[:SIGNATURE_BYTES])
+
+    def encode(
+        self,
+        session_id: str,
+        kb: CompiledKnowledgeBase,
+        answers: Sequence[Tuple[str, str]],
+        rewound_at: Optional[int] = None
+    ) -> str:
+        codes = kb.condition_codes
+        history = ".".join(f"{codes[condition]:x}{ANSWER_CODES.get(answer, 'u')}" for condition, answer in answers)
+        content = f"{kb.content_hash}:{history}"
+        if rewound_at is not None:
+            content += f":{rewound_at:x}"
+        body = _b64encode(content.encode("ascii"))
+        return f"{TOKEN_VERSION}.{body}.{self._sign(session_id, body)}"
+
+    def decode(self, session_id: str, token: str) -> Tuple[str, List[Tuple[int, str]], Optional[int]]:
+        """トークンを検証して (内容ハッシュ, [(条件番号, 回答), ...], 最後に戻った時点の回答数) を返す
+
+        Raises:
+            SessionTokenError: 形式が正しくない、または署名が一致しない場合
+        """
+        try:
+            version, body, signature = token.split(".")
+        except ValueError:
+            raise SessionTokenError("malformed token")
+        if version != TOKEN_VERSION:
+            raise SessionTokenError(f"unsupported token version: {version}")
+        if not hmac.compare_digest(signature, self._sign(session_id, body)):
+            raise SessionTokenError("invalid signature")
+
+        try:
+            content_hash, history, *rewound = _b64decode(body).decode("ascii").split(":")
+            answers = [(int(item[:-1], 16), ANSWERS_BY_CODE[item[-1]]) for item in history.split(".") if item]
+            rewound_at = int(rewound[0], 16) if rewound else None
+        except (ValueError, UnicodeError, KeyError):
+            raise SessionTokenError("malformed token")
+        if len(answers) > MAX_TOKEN_ANSWERS:
+            raise SessionTokenError("too many answers")
+        if len(rewound) > 1 or (rewound_at is not None and rewound_at > len(answers)):
+            raise SessionTokenError("malformed token")
+        return content_hash, answers, rewound_at
+
+    def issue(self, session_id: str, engine: InferenceEngine, remember: bool = True) -> str:
+        """エンジンの状態のトークンを発行
+
+        remember=True ならエンジンを回答の並びのキャッシュに入れる
+        （次のリクエストでの復元を速くする。以後そのエンジンは変更しないこと）。
+        """
+        if remember:
+            remember_snapshot(engine)
+        return self.encode(session_id, engine.knowledge_base, answers_of(engine), engine.rewound_at)
+
+    def restore(self, session_id: str, token: str) -> InferenceEngine:
+        """トークンの状態のエンジン（変更してよい複製）を返す
+
+        Raises:
+            SessionTokenError: トークンが不正な場合
+            RulebaseNotAvailableError: トークンの版の知識ベースがない場合
+        """
+        content_hash, coded, rewound_at = self.decode(session_id, token)
+        kb = _find_knowledge_base(content_hash)
+        if kb is None:
+            raise RulebaseNotAvailableError(f"rulebase not available: {content_hash}")
+        conditions = kb.conditions_by_code
+        if any(code >= len(conditions) for code, _ in coded):
+            raise SessionTokenError("unknown condition")
+        answers = [(conditions[code], answer) for code, answer in coded]
+        return snapshot_for_answers(kb, answers, rewound_at).clone()
+
+
+def _find_knowledge_base(content_hash: str) -> Optional[CompiledKnowledgeBase]:
+    """内容ハッシュの知識ベース（現在のもの、または診断中のセッションが使っている版）"""
+    kb = get_knowledge_base()
+    if kb.content_hash == content_hash:
+        return kb
+    return rulebase_versions.find(content_hash)
+
+
+if SESSION_TOKENS_ENABLED and not SESSION_TOKEN_SECRET:
+    raise RuntimeError("SESSION_MODE=token には SESSION_TOKEN_SECRET の設定が必要です")
+
+session_tokens = SessionTokens(SESSION_TOKEN_SECRET)
@@ -1,10 +1,11 @@
 """
 ルールの整合性チェック機能
 """
-from collections import Counter
-from typing import List
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional
 
-from knowledge import RULES, get_all_rules
+from knowledge import RULES, CompiledKnowledgeBase, get_knowledge_base
 
 
 def find_rule_by_action(action: str):
@@ -12,17 +13,31 @@ def find_rule_by_action(action: str):
     return next((r for r in RULES if r.action == action), None)
 
 
-def check_rules_integrity() -> List[dict]:
-    """ルールの整合性をチェックし、問題のリストを返す"""
-    rules = get_all_rules()
+def _find_cycle(kb: CompiledKnowledgeBase, action: str, visited: set, path: list) -> Optional[List[str]]:
+    """actionから条件をたどって循環参照を探す（同じactionのルールが複数あれば先頭のルール）"""
+    if action in visited:
+        return path + [action]
+    visited.add(action)
+    path.append(action)
+    indices = kb.rules_by_action.get(action)
+    if indices:
+        for cond in kb.rules[indices[0]].conditions:
+            if cond in kb.rules_by_action:
+                cycle = _find_cycle(kb, cond, visited.copy(), path.copy())
+                if cycle:
+                    return cycle
+    return None
 
+
+def _collect_issues(kb: CompiledKnowledgeBase, cycles: Dict[str, Optional[List[str]]]) -> List[dict]:
+    """索引と循環参照の探索結果から問題のリストを組み立てる"""
+    rules = kb.rules
     issues = []
-    all_actions = {r.action for r in RULES}
 
     # 到達不能なルールをチェック
     for rule in rules:
         for cond in rule.conditions:
-            if cond in all_actions and not any(r.action == cond for r in RULES):
+            if cond in kb.rules_by_action and not kb.rules_by_action[cond]:
                 issues.append({
                     "type": "unreachable",
                     "action": rule.action,
@@ -30,22 +45,8 @@ def check_rules_integrity() -> List[dict]:
                 })
 
     # 循環参照をチェック
-    def check_cycle(action: str, visited: set, path: list):
-        if action in visited:
-            return path + [action]
-        visited.add(action)
-        path.append(action)
-        rule = find_rule_by_action(action)
-        if rule:
-            for cond in rule.conditions:
-                if cond in all_actions:
-                    cycle = check_cycle(cond, visited.copy(), path.copy())
-                    if cycle:
-                        return cycle
-        return None
-
     for rule in rules:
-        cycle = check_cycle(rule.action, set(), [])
+        cycle = cycles.get(rule.action)
         if cycle and len(cycle) > 1:
             issues.append({
                 "type": "cycle",
@@ -56,7 +57,7 @@ def check_rules_integrity() -> List[dict]:
     # 孤立ルールをチェック（THENが他で使われていない + ゴールでもない）
     for rule in rules:
         if not rule.is_goal_action:
-            if not any(rule.action in r.conditions for r in RULES if r.action != rule.action):
+            if not any(rules[i].action != rule.action for i in kb.rules_by_condition.get(rule.action, ())):
                 issues.append({
                     "type": "orphan",
                     "action": rule.action,
@@ -64,14 +65,114 @@ def check_rules_integrity() -> List[dict]:
                 })
 
     # actionの一意性をチェック
-    action_counts = Counter(r.action for r in RULES)
-    for action, count in action_counts.items():
-        if count > 1:
+    for action, indices in kb.rules_by_action.items():
+        if len(indices) > 1:
             issues.append({
                 "type": "duplicate_action",
                 "action": action,
-                "count": count,
-                "message": f"THEN「{action}」が{count}回使用されています"
+                "count": len(indices),
+                "message": f"THEN「{action}」が{len(indices)}回使用されています"
             })
 
     return issues
+
+
+def _issue_key(issue: dict) -> tuple:
+    return (issue["type"], issue.get("action"), tuple(issue.get("actions", ())), issue.get("count"))
+
+
+def check_rules_integrity() -> List[dict]:
+    """ルールの整合性をチェックし、問題のリストを返す"""
+    kb = get_knowledge_base()
+    cycles = {action: _find_cycle(kb, action, set(), []) for action in kb.rules_by_action}
+    return _collect_issues(kb, cycles)
+
+
+class IncrementalValidator:
+    """整合性チェックの結果を保持し、1件の編集では影響する部分だけを調べ直す
+
+    重いのは循環参照の探索なので、actionごとの探索結果を保持しておき、
+    編集されたactionに条件をたどって到達するactionだけを探索し直す。
+    それ以外（孤立・重複など）は知識ベースの索引から組み立て直す。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._knowledge_base: Optional[CompiledKnowledgeBase] = None
+        self._cycles: Dict[str, Optional[List[str]]] = {}
+        self._issues: List[dict] = []
+
+    def _rebuild(self, kb: CompiledKnowledgeBase):
+        self._cycles = {action: _find_cycle(kb, action, set(), []) for action in kb.rules_by_action}
+        self._issues = _collect_issues(kb, self._cycles)
+        self._knowledge_base = kb
+
+    def issues(self) -> List[dict]:
+        """現在のルールの問題（ルールが変わっていれば全体を調べ直す）"""
+        kb = get_knowledge_base()
+        with self._lock:
+            if self._knowledge_base is not kb:
+                self._rebuild(kb)
+            return self._issues
+
+    def _affected_actions(self, kb: CompiledKnowledgeBase, changed: Iterable[str]) -> set:
+        """changedに条件をたどって到達するaction（changed自身を含む）"""
+        affected = set()
+        queue = deque(changed)
+        while queue:
+            action = queue.popleft()
+            if action in affected:
+                continue
+            affected.add(action)
+            for i in kb.rules_by_condition.get(action, ()):
+                queue.append(kb.rules[i].action)
+        return affected
+
+    def apply_edit(
+        self,
+        before: Optional[CompiledKnowledgeBase],
+        changed_actions: Iterable[str]
+    ) -> Dict[str, List[dict]]:
+        """1件の編集後の問題を求め、編集で増えた問題と解消した問題を返す
+
+        Args:
+            before: 編集前の知識ベース。ストアの編集関数が返す、実際に編集した版を渡す
+                （編集の前に取得した版では、その間に読み直した他のワーカーの編集が含まれない）。
+                Noneなら編集後の知識ベース全体を調べ直す。
+            changed_actions: 追加・変更・削除されたルールのaction（変更前後とも）
+        """
+        kb = get_knowledge_base()
+        with self._lock:
+            if before is None:
+                previous = self._issues
+                self._rebuild(kb)
+                before = kb
+            else:
+                if self._knowledge_base is not before:
+                    self._rebuild(before)
+                previous = self._issues
+
+            if kb is not before:
+                cycles = {a: c for a, c in self._cycles.items() if a in kb.rules_by_action}
+                for action in self._affected_actions(kb, changed_actions):
+                    if action in kb.rules_by_action:
+                        cycles[action] = _find_cycle(kb, action, set(), [])
+                self._cycles = cycles
+                self._issues = _collect_issues(kb, cycles)
+                self._knowledge_base = kb
+
+            previous_keys = {_issue_key(i) for i in previous}
+            current_keys = {_issue_key(i) for i in self._issues}
+            return {
+                "new_issues": [i for i in self._issues if _issue_key(i) not in previous_keys],
+                "resolved_issues": [i for i in previous if _issue_key(i) not in current_keys],
+                "issue_count": len(self._issues),
+            }
+
+
+incremental_validator = IncrementalValidator()
+
+
+def check_rules_integrity_cached() -> List[dict]:
+    """整合性チェックの結果（ルールが変わるまで保持し、編集時は差分だけ調べ直す）"""
+    return incremental_validator.issues()
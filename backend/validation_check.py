@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ビザ選定エキスパートシステム 整合性チェックの差分更新の照合ツール
+
+ルール編集のAPIと同じ手順（ストアの編集関数 → IncrementalValidator.apply_edit）で
+編集を繰り返し、保持している問題（GET /api/validation/check が返すもの）が
+全体を調べ直した結果と一致するかを確かめます。編集の合間に、別のワーカーが
+rules.json を書き換えた状況（循環参照を含む）も作ります。
+rules.json の一時的な複製に対して行うので、実際のルールは変更しません。
+
+使い方:
+  python validation_check.py [--edits 300] [--seed 0]
+
+相違があれば終了コード1を返します。
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import knowledge.compiled as compiled_module
+import knowledge.loader as loader_module
+from core import Rule
+from knowledge import reload_rules, insert_rule, update_rule, delete_rule, get_knowledge_base
+from knowledge.store import RULE_STORE_BACKEND
+from knowledge.loader import save_rules_to_json
+from services.validation import (
+    check_rules_integrity, check_rules_integrity_cached, incremental_validator, _issue_key
+)
+
+
+def use_temporary_rules_file(directory: str):
+    """rules.json（と rules.kb）の読み書き先を一時ディレクトリの複製に切り替える"""
+    shutil.copy(loader_module.RULES_FILE, os.path.join(directory, "rules.json"))
+    loader_module.DATA_DIR = compiled_module.DATA_DIR = directory
+    loader_module.RULES_FILE = os.path.join(directory, "rules.json")
+    compiled_module.KB_FILE = os.path.join(directory, "rules.kb")
+    reload_rules(force=True)
+
+
+def write_as_other_worker(rules):
+    """別のワーカーの編集（このプロセスのストアを通さずに rules.json を書き換える）"""
+    save_rules_to_json({"rules": [
+        {"conditions": r.conditions, "action": r.action,
+         "is_or_rule": r.is_or_rule, "is_goal_action": r.is_goal_action}
+        for r in rules
+    ]})
+
+
+def same_issues() -> bool:
+    cached = sorted(_issue_key(i) for i in check_rules_integrity_cached())
+    full = sorted(_issue_key(i) for i in check_rules_integrity())
+    return cached == full
+
+
+def random_rule(rng: random.Random, actions, conditions) -> dict:
+    return {
+        "conditions": rng.sample(conditions, rng.randint(1, min(3, len(conditions)))),
+        "action": rng.choice(actions) if rng.random() < 0.5 else f"check{rng.randint(0, 20)}",
+        "is_or_rule": rng.random() < 0.3,
+        "is_goal_action": rng.random() < 0.2,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="整合性チェックの差分更新の照合")
+    parser.add_argument("--edits", type=int, default=300)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if RULE_STORE_BACKEND != "json":
+        print("RULE_STORE=json で実行してください")
+        sys.exit(2)
+
+    rng = random.Random(args.seed)
+    failures = 0
+    with tempfile.TemporaryDirectory() as directory:
+        use_temporary_rules_file(directory)
+        check_rules_integrity_cached()
+
+        for step in range(args.edits):
+            kb = get_knowledge_base()
+            actions = list(kb.rules_by_action)
+            conditions = list(kb.rules_by_condition) + actions
+
+            if step % 5 == 0:
+                # 別のワーカーが循環参照を書き込む（このプロセスはまだ読み直していない）
+                x, y = f"cycle{step}x", f"cycle{step}y"
+                write_as_other_worker(list(kb.rules) + [
+                    Rule(conditions=[y], action=x),
+                    Rule(conditions=[x], action=y),
+                ])
+
+            # ルール編集のAPIと同じ手順
+            operation = rng.choice(("insert", "update", "delete"))
+            if operation == "insert" or len(kb.rules) < 2:
+                rule = random_rule(rng, actions, conditions)
+                _, before = insert_rule(None if rng.random() < 0.5 else rng.randint(0, len(kb.rules)), rule)
+                changed = [rule["action"]]
+            elif operation == "update":
+                rule = random_rule(rng, actions, conditions)
+                previous_action, before = update_rule(rng.randrange(len(kb.rules)), rule)
+                changed = [rule["action"], previous_action]
+            else:
+                deleted_action, before = delete_rule(rng.randrange(len(kb.rules)))
+                changed = [deleted_action]
+            incremental_validator.apply_edit(before, changed)
+
+            if not same_issues():
+                print(f"step {step} ({operation}): cached issues differ from full check")
+                failures += 1
+
+    print(f"{args.edits} edits: {'NG' if failures else 'OK'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
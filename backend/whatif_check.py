@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ビザ選定エキスパートシステム What-if分析の照合ツール
+
+ランダムに回答し、途中で「戻る」を挟んだ診断について、回答を何も差し替えない
+fork（fork_with_answers(engine, {})）が元のエンジンと同じ状態
+（get_current_state()）になるかを確かめます。あわせて、戻った後に回答していれば、
+最後の回答だけを同じ値で差し替えたforkも比べます。
+
+使い方:
+  python whatif_check.py [--consultations 30] [--seed 0]
+
+相違があれば終了コード1を返します。
+"""
+
+import argparse
+import random
+import sys
+
+from engine import InferenceEngine
+from engine.whatif import answers_of, fork_with_answers
+from knowledge import get_knowledge_base
+
+
+def state_of(engine: InferenceEngine):
+    state = engine.get_current_state()
+    result = state.get("diagnosis_result")
+    if result is not None:
+        # 推論ログには取り消した回答の分も残るので、比較しない
+        state["diagnosis_result"] = {k: v for k, v in result.items() if k != "reasoning_log"}
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="What-if分析の照合")
+    parser.add_argument("--consultations", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    kb = get_knowledge_base()
+    rng = random.Random(args.seed)
+    failures = 0
+    for n in range(args.consultations):
+        engine = InferenceEngine(kb)
+        question = engine.start_consultation()
+        steps = 0
+        while question is not None and steps < 60:
+            if engine.working_memory.answer_history and rng.random() < 0.2:
+                engine.go_back(rng.randint(1, 3), include_rules_status=False)
+                question = engine.current_question
+            else:
+                answer = rng.choice(("yes", "no", "unknown"))
+                question = engine.answer_question(question, answer, include_rules_status=False)["next_question"]
+            steps += 1
+
+            expected = state_of(engine)
+            history = answers_of(engine)
+            overrides = [{}]
+            if history and (engine.rewound_at is None or len(history) > engine.rewound_at):
+                overrides.append(dict(history[-1:]))
+            for override in overrides:
+                if state_of(fork_with_answers(engine, override)) != expected:
+                    print(f"consultation {n} step {steps} (rewound_at={engine.rewound_at}, "
+                          f"overrides={override}): fork differs from the engine")
+                    failures += 1
+
+    print(f"{args.consultations} consultations: {'NG' if failures else 'OK'}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
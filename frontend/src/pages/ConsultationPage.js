@@ -14,12 +14,28 @@ function ConsultationPage({ onBack }) {
   const [validationError, setValidationError] = useState(null);
   const [currentNote, setCurrentNote] = useState('');
   const containerRef = useRef(null);
+  // SESSION_MODE=token のサーバーが返すセッショントークン（次のリクエストで送り返す）
+  const sessionTokenRef = useRef(null);
+
+  const requestHeaders = () => {
+    const headers = { 'Content-Type': 'application/json' };
+    if (sessionTokenRef.current) {
+      headers['X-Session-Token'] = sessionTokenRef.current;
+    }
+    return headers;
+  };
+
+  const keepSessionToken = (data) => {
+    if (data.session_token) {
+      sessionTokenRef.current = data.session_token;
+    }
+  };
 
   const startConsultation = async () => {
     setLoading(true);
     setValidationError(null);
     try {
-      const response = await fetch(`${API_BASE}/api/consultation/start`, {
+      const response = await fetch(`${API_BASE}/api/consultation/start?include_notes=current`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ session_id: sessionId })
@@ -34,7 +50,9 @@ function ConsultationPage({ onBack }) {
         return;
       }
 
+      keepSessionToken(data);
       setCurrentQuestion(data.current_question);
+      setCurrentNote(data.current_note || '');
       setRulesStatus(data.rules_status || []);
     } catch (error) {
       console.error('Error starting consultation:', error);
@@ -44,10 +62,34 @@ function ConsultationPage({ onBack }) {
     }
   };
 
+  // 診断を終えたら（ホームに戻る・最初から・ページを閉じる）セッションを終了し、
+  // サーバーが固定しているルールの版を解放する。診断結果から「戻る」ことがあるので、完了時には終了しない
+  const sessionEndedRef = useRef(false);
+  const endSession = () => {
+    if (sessionEndedRef.current) return;
+    sessionEndedRef.current = true;
+    fetch(`${API_BASE}/api/consultation/session/${encodeURIComponent(sessionId)}`, {
+      method: 'DELETE',
+      headers: requestHeaders(),
+      keepalive: true
+    }).catch(() => {});
+  };
+
   useEffect(() => {
     startConsultation();
+    // バックフォワードキャッシュに入る場合は、戻ってきたときに続けられるよう終了しない
+    const onPageHide = (event) => {
+      if (!event.persisted) endSession();
+    };
+    window.addEventListener('pagehide', onPageHide);
+    return () => window.removeEventListener('pagehide', onPageHide);
   }, []);
 
+  const leaveConsultation = () => {
+    endSession();
+    onBack();
+  };
+
   // 現在の質問の条件にスクロール（ルールカード単位で表示）
   useEffect(() => {
     if (containerRef.current && currentQuestion) {
@@ -63,30 +105,20 @@ function ConsultationPage({ onBack }) {
     }
   }, [currentQuestion, rulesStatus]);
 
-  // 現在の質問の補足を取得
-  useEffect(() => {
-    if (currentQuestion) {
-      fetch(`${API_BASE}/api/conditions/note/${encodeURIComponent(currentQuestion)}`)
-        .then(res => res.json())
-        .then(data => setCurrentNote(data.note || ''))
-        .catch(() => setCurrentNote(''));
-    } else {
-      setCurrentNote('');
-    }
-  }, [currentQuestion]);
-
   const answerQuestion = async (answer) => {
     if (loading) return;
     setLoading(true);
     try {
       setAnsweredQuestions(prev => [...prev, { question: currentQuestion, answer }]);
-      const response = await fetch(`${API_BASE}/api/consultation/answer`, {
+      const response = await fetch(`${API_BASE}/api/consultation/answer?include_notes=current`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: requestHeaders(),
         body: JSON.stringify({ session_id: sessionId, answer })
       });
       const data = await response.json();
+      keepSessionToken(data);
       setCurrentQuestion(data.current_question);
+      setCurrentNote(data.current_note || '');
       setRulesStatus(data.rules_status || []);
       setIsComplete(data.is_complete);
       if (data.is_complete && data.diagnosis_result) {
@@ -102,13 +134,15 @@ function ConsultationPage({ onBack }) {
     if (loading) return;
     setLoading(true);
     try {
-      const response = await fetch(`${API_BASE}/api/consultation/back`, {
+      const response = await fetch(`${API_BASE}/api/consultation/back?include_notes=current`, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: requestHeaders(),
         body: JSON.stringify({ session_id: sessionId, steps: 1 })
       });
       const data = await response.json();
+      keepSessionToken(data);
       setCurrentQuestion(data.current_question);
+      setCurrentNote(data.current_note || '');
       setRulesStatus(data.rules_status || []);
       setAnsweredQuestions(data.answered_questions?.map(q => ({
         question: q.condition,
@@ -144,10 +178,10 @@ function ConsultationPage({ onBack }) {
                 ))}
               </ul>
             )}
-            <button className="nav-button" onClick={onBack}>ホームに戻る</button>
+            <button className="nav-button" onClick={leaveConsultation}>ホームに戻る</button>
           </div>
         ) : isComplete ? (
-          <DiagnosisResult result={diagnosisResult} onGoBack={goBack} onRestart={onBack} />
+          <DiagnosisResult result={diagnosisResult} onGoBack={goBack} onRestart={leaveConsultation} />
         ) : (
           <>
             {currentQuestion && (
@@ -167,7 +201,7 @@ function ConsultationPage({ onBack }) {
                   <button className="nav-button" onClick={goBack} disabled={loading || answeredQuestions.length === 0}>
                     &#x2190; 前の質問に戻る
                   </button>
-                  <button className="nav-button" onClick={onBack}>最初から</button>
+                  <button className="nav-button" onClick={leaveConsultation}>最初から</button>
                 </div>
               </div>
             )}